@@ -29,7 +29,8 @@ TODO: wire up the changed event properly. We'll have to update DifferenceCount a
 
 local Utils = require(script.Parent.Parent.Utils);
 local Debug = Utils.new("Log", "ProjectSync: ", false);
-local Compare = require(script.Compare).Compare;
+local CompareModule = require(script.Compare);
+local Compare = CompareModule.Compare;
 local FilesystemModel = require(script.FilesystemModel);
 local StudioModel = require(script.StudioModel);
 
@@ -120,15 +121,19 @@ end
 function ProjectSync:Push(script)
 	Debug("ProjectSync:Push(%s) called", script);
 	local differenceCount = 0;
-	for i, diff in pairs(Compare(self._FilesystemModel, self._StudioModel)) do
+	local diffs = {};
+	for i, diff in pairs(CompareModule.CompareRemote(self._FilesystemModel, self._StudioModel)) do
 		if diff.Comparison ~= "synced" then
 			differenceCount = differenceCount + 1;
 			if not script or (script == (diff.File and diff.File.FullPath) or script == (diff.Script and diff.Script.Object)) then
-				self._RemoteScreenTime = tick() + SCREEN_TIME;
-				diff.Push();
+				table.insert(diffs, diff);
 			end
 		end
 	end
+	if #diffs > 0 then
+		self._RemoteScreenTime = tick() + SCREEN_TIME;
+		CompareModule.PushMany(diffs);
+	end
 	Debug("Setting DifferenceCount to %s%s", differenceCount, self._DifferenceCount ~= differenceCount and " (Changed)" or "");
 	if self._DifferenceCount ~= differenceCount then
 		self._DifferenceCount = differenceCount;
@@ -142,15 +147,19 @@ end
 function ProjectSync:Pull(script)
 	Debug("ProjectSync:Pull(%s) called", script);
 	local differenceCount = 0;
-	for i, diff in pairs(Compare(self._FilesystemModel, self._StudioModel)) do
+	local diffs = {};
+	for i, diff in pairs(CompareModule.CompareRemote(self._FilesystemModel, self._StudioModel)) do
 		if diff.Comparison ~= "synced" then
 			differenceCount = differenceCount + 1;
 			if not script or (script == (diff.File and diff.File.FullPath) or script == (diff.Script and diff.Script.Object)) then
-				self._LocalScreenTime = tick() + SCREEN_TIME;
-				diff.Pull();
+				table.insert(diffs, diff);
 			end
 		end
 	end
+	if #diffs > 0 then
+		self._LocalScreenTime = tick() + SCREEN_TIME;
+		CompareModule.PullMany(diffs);
+	end
 	Debug("Setting DifferenceCount to %s%s", differenceCount, self._DifferenceCount ~= differenceCount and " (Changed)" or "");
 	if self._DifferenceCount ~= differenceCount then
 		self._DifferenceCount = differenceCount;
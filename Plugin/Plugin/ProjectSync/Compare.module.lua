@@ -20,12 +20,44 @@ local MAP_COMPARISONS = {
 	classMismatch = "classMismatch";
 };
 
+--The most files sent in a single read_many/write_many request.
+local BATCH_SIZE = 200;
+
+--While PullMany runs, this maps a path to the result read_many gave for it.
+local Prefetched;
+--While PushMany runs, writes are queued up here rather than sent one at a time.
+local PendingWrites;
+
 local function NoOp()
 
 end
-local function DeleteFile(file, prefix)
-	local success, response = ServerRequests.delete{File=prefix .. file.FullPath};
-	if not success then
+local function Read(path)
+	local result = Prefetched and Prefetched[path];
+	if result then
+		if result.Status == "ok" then
+			return true, { Contents = result.Contents; };
+		else
+			return false, result.Contents;
+		end
+	end
+	return ServerRequests.read{ File = path; };
+end
+local function Write(path, contents, model)
+	if PendingWrites then
+		table.insert(PendingWrites, { Path = path; Contents = contents; Model = model; });
+		return true;
+	end
+	local success, response = ServerRequests.write{ File = path; Contents = contents; Session = model.Session; };
+	if success then
+		model:NoteWrite(path, contents);
+	end
+	return success, response;
+end
+local function DeleteFile(file, prefix, model)
+	local success, response = ServerRequests.delete{File=prefix .. file.FullPath; Session = model.Session; };
+	if success then
+		model:NoteDelete(prefix .. file.FullPath);
+	else
 		Debug("Query failed: %s", response);
 	end
 	return success;
@@ -34,7 +66,7 @@ local function CreateScript(file, root, prefix)
 	local directory, filename = Helpers.SplitFilePath(file.FullPath);
 	local class, name = Helpers.GetSuffix(filename);
 	local obj = Helpers.SUFFIX_CONVERT_TO_OBJECT[class]();
-	local success, response = ServerRequests.read{ File = prefix .. file.FullPath; };
+	local success, response = Read(prefix .. file.FullPath);
 	local newRoot;
 	if success then
 		obj.Source = response.Contents;
@@ -45,9 +77,9 @@ local function CreateScript(file, root, prefix)
 	end
 	return success, newRoot;
 end
-local function CreateFile(script, root, prefix)
+local function CreateFile(script, root, prefix, model)
 	local path = Helpers.GetPath(root, script);
-	local success, response = ServerRequests.write{ File = prefix .. path; Contents = script.Source; };
+	local success, response = Write(prefix .. path, script.Source, model);
 	if not success then
 		Debug("Query failed: %s", response);
 	end
@@ -66,7 +98,7 @@ local function DeleteScript(script)
 	return true;
 end
 local function SyncToScript(file, script, prefix)
-	local success, response = ServerRequests.read{ File = prefix .. file.FullPath; };
+	local success, response = Read(prefix .. file.FullPath);
 	if success then
 		script.Source = response.Contents;
 	else
@@ -74,14 +106,82 @@ local function SyncToScript(file, script, prefix)
 	end
 	return success;
 end
-local function SyncToFile(file, script, prefix)
-	local success, response = ServerRequests.write{ File = prefix .. file.FullPath; Contents = script.Source; };
+local function SyncToFile(file, script, prefix, model)
+	local success, response = Write(prefix .. file.FullPath, script.Source, model);
 	if not success then
 		Debug("Query failed: %s", response);
 	end
 	return success;
 end
 
+--[[ @brief Sends a bulk command for each batch of files, logging any file which failed.
+	@param command The bulk command to send.
+	@param items The files to send.
+	@param encode A function which turns a slice of items into the command's payload.
+	@param onResult A function called with each file's result.
+	@param session The watch session the command is sent on behalf of, if any.
+--]]
+local function SendBatches(command, items, encode, onResult, session)
+	for i = 1, #items, BATCH_SIZE do
+		local batch = {};
+		for j = i, math.min(i + BATCH_SIZE - 1, #items) do
+			table.insert(batch, items[j]);
+		end
+		local success, response = ServerRequests[command]{ Files = encode(batch); Session = session; };
+		local results;
+		if success then
+			results, response = Helpers.DecodeResults(response.Results or "");
+		end
+		if not results then
+			Debug("Query failed: %s", response);
+		else
+			for _, result in ipairs(results) do
+				if result.Status ~= "ok" then
+					Debug("%s failed for %s: %s", command, result.Path, result.Contents);
+				end
+				onResult(result);
+			end
+		end
+	end
+end
+
+--[[ @brief Starts a comparison of a filesystem model against a data model.
+	@param filesystemModel The FilesystemModel
+	@param studioModel The StudioModel
+	@return An (initially empty) array of entries, as returned by Compare.
+	@return A function which adds an entry to the array, given its file entry (or nil), script entry (or nil) & comparison.
+--]]
+local function NewComparison(filesystemModel, studioModel)
+	local root = studioModel.Root;
+	local prefix = filesystemModel.Root .. "/";
+	local s = {};
+	local function add(file, script, comparison)
+		local trueScript = script and script.Object;
+		local push, pull, pullPath = NoOp, NoOp, nil;
+		if comparison == "fileOnly" then
+			push = function() DeleteFile(file, prefix, filesystemModel); end
+			pull = function() local success, newRoot = CreateScript(file, root, prefix); root = newRoot; end;
+			pullPath = prefix .. file.FullPath;
+		elseif comparison == "scriptOnly" then
+			push = function() CreateFile(trueScript, root, prefix, filesystemModel); end;
+			pull = function() DeleteScript(trueScript); end;
+		elseif comparison == "desynced" then
+			push = function() SyncToFile(file, trueScript, prefix, filesystemModel); end;
+			pull = function() SyncToScript(file, trueScript, prefix); end;
+			pullPath = prefix .. file.FullPath;
+		end
+		table.insert(s, {
+			File = file;
+			Script = script;
+			Comparison = comparison;
+			Push = push;
+			Pull = pull;
+			PullPath = pullPath;
+		});
+	end
+	return s, add;
+end
+
 --[[ @brief Compares a filesystem model against a data model.
 	@param filesystemModel The FilesystemModel
 	@param studioModel The StudioModel
@@ -92,61 +192,135 @@ end
 			Comparison = "synced|desynced|fileOnly|scriptOnly";
 			Push = <function to push changes>;
 			Pull = <function to pull changes>;
+			PullPath = <the file Pull reads, if any>;
 		}
 --]]
 function module.Compare(filesystemModel, studioModel)
 	local fs = StudioModel.fromFilesystemModel(filesystemModel);
 	local comparison = fs:Compare(studioModel);
 	fs:Destroy();
-	local root = studioModel.Root;
-	local prefix = filesystemModel.Root .. "/";
 	--Iterate through the comparison making the difference easier to work with.
-	local s = {};
+	local s, add = NewComparison(filesystemModel, studioModel);
 	for i, v in pairs(comparison) do
 		local file;
 		if v.A then file = v.A.Original; end
 		local script = v.B;
-		local trueScript = script and script.Object;
-		local comparison = MAP_COMPARISONS[v.Status];
 		if v.Status == "classMismatch" then
-			table.insert(s, {
-				File = file;
-				Script = nil;
-				Comparison = "fileOnly";
-				Push = function() DeleteFile(file, prefix); end;
-				Pull = function() local success, newRoot = CreateScript(file, root, prefix); root = newRoot; end;
-			});
-			table.insert(s, {
-				File = nil;
-				Script = script;
-				Comparison = "scriptOnly";
-				Push = function() CreateFile(trueScript, root, prefix); end;
-				Pull = function() DeleteScript(trueScript); end;
-			});
+			add(file, nil, "fileOnly");
+			add(nil, script, "scriptOnly");
 		else
-			local push, pull = NoOp, NoOp;
-			if comparison == "fileOnly" then
-				push = function() DeleteFile(file, prefix); end
-				pull = function() local success, newRoot = CreateScript(file, root, prefix); root = newRoot; end;
-			elseif comparison == "scriptOnly" then
-				push = function() CreateFile(trueScript, root, prefix); end;
-				pull = function() DeleteScript(trueScript); end;
-			elseif comparison == "desynced" then
-				push = function() SyncToFile(file, trueScript, prefix); end;
-				pull = function() SyncToScript(file, trueScript, prefix); end;
+			add(file, script, MAP_COMPARISONS[v.Status]);
+		end
+	end
+	return s;
+end
+
+--[[ @brief Like Compare, but the server does the comparing, and only the entries which aren't synced are returned.
+	Only the hashes of our scripts are sent, and only the differences come back, so this is much quicker than
+	Compare for big projects. Servers which don't know the diff command are compared against with Compare.
+	@param filesystemModel The FilesystemModel
+	@param studioModel The StudioModel
+	@return An array of entries, as returned by Compare.
+--]]
+function module.CompareRemote(filesystemModel, studioModel)
+	local root = studioModel.Root;
+	local prefix = filesystemModel.Root .. "/";
+	local scripts = {};
+	local manifest = {};
+	for _, script in pairs(studioModel.Objects) do
+		local path = prefix .. Helpers.GetPath(root, script.Object);
+		scripts[path] = script;
+		table.insert(manifest, path .. " " .. script.Hash);
+	end
+	local suffixes = {};
+	for _, suffix in pairs(Helpers.SUFFIXES) do
+		table.insert(suffixes, suffix);
+	end
+	local success, response = ServerRequests.diff{
+		File = filesystemModel.Root;
+		Suffixes = table.concat(suffixes, " ");
+		Manifest = table.concat(manifest, "\n");
+	};
+	if not success then
+		Debug("diff failed (%s); comparing locally", response);
+		local s = {};
+		for _, diff in ipairs(module.Compare(filesystemModel, studioModel)) do
+			if diff.Comparison ~= "synced" then
+				table.insert(s, diff);
 			end
-			table.insert(s, {
-				File = file;
-				Script = script;
-				Comparison = comparison;
-				Push = push;
-				Pull = pull;
-			});
+		end
+		return s;
+	end
+	local s, add = NewComparison(filesystemModel, studioModel);
+	for line in string.gmatch(response.Differences or "", "[^\n]+") do
+		local comparison, path, hash = string.match(line, "^(%w+) '(.*)' ?(%S*)$");
+		if comparison == "scriptOnly" then
+			add(nil, scripts[path], comparison);
+		elseif comparison then
+			local fullPath = string.sub(path, #prefix + 1);
+			local _, name = Helpers.SplitFilePath(fullPath);
+			local file = { Name = name; Type = "file"; FullPath = fullPath; Hash = hash; };
+			add(file, comparison == "desynced" and scripts[path] or nil, comparison);
+		else
+			Debug("Unexpected diff line: %s", line);
 		end
 	end
 	return s;
 end
 
+--[[ @brief Pushes many entries of a comparison, sending their writes in bulk.
+	@param diffs The entries (from Compare) to push.
+--]]
+function module.PushMany(diffs)
+	PendingWrites = {};
+	local success, err = pcall(function()
+		for _, diff in ipairs(diffs) do
+			diff.Push();
+		end
+	end);
+	local writes = PendingWrites;
+	PendingWrites = nil;
+	local written = {};
+	for _, write in ipairs(writes) do
+		written[write.Path] = write;
+	end
+	local model = writes[1] and writes[1].Model;
+	SendBatches("write_many", writes, Helpers.EncodeFiles, function(result)
+		local write = written[result.Path];
+		if result.Status == "ok" and write then
+			write.Model:NoteWrite(write.Path, write.Contents);
+		end
+	end, model and model.Session);
+	if not success then
+		error(err, 0);
+	end
+end
+
+--[[ @brief Pulls many entries of a comparison, reading their files in bulk.
+	@param diffs The entries (from Compare) to pull.
+--]]
+function module.PullMany(diffs)
+	local paths = {};
+	for _, diff in ipairs(diffs) do
+		if diff.PullPath then
+			table.insert(paths, diff.PullPath);
+		end
+	end
+	Prefetched = {};
+	SendBatches("read_many", paths, function(batch) return table.concat(batch, "\n"); end, function(result)
+		Prefetched[result.Path] = result;
+	end);
+	local success, err = pcall(function()
+		for _, diff in ipairs(diffs) do
+			diff.Pull();
+		end
+	end);
+	Prefetched = nil;
+	if not success then
+		error(err, 0);
+	end
+end
+
 local function GoIntoMockMode()
 	ServerRequests = setmetatable({
 			_write = function(arg)
@@ -158,6 +332,16 @@ local function GoIntoMockMode()
 			_read = function(arg)
 				return true, { Contents = "foobar"; };
 			end;
+			_read_many = function(arg)
+				local results = {};
+				for path in string.gmatch(arg.Files, "[^\n]+") do
+					table.insert(results, string.format("%s\nok\n6\nfoobar", path));
+				end
+				return true, { Results = table.concat(results); };
+			end;
+			_write_many = function(arg)
+				return true, { Results = ""; };
+			end;
 		}, {__index = function(t, i)
 		rawset(t, i, function(arg)
 			Debug("Invoking %s(%t)", i, arg);
@@ -9,11 +9,15 @@ Properties:
 			{ Name = "<folder name>", Type = "folder", FullPath = "<full path>", Parent = <parent>, Children = {<children indexed by name>} }
 		Note that in the case of a folder, children are recursively one of the aforementioned two types.
 	Connected (read-only): when true, we are successfully talking to the server.
+	Session (read-only): the ID of our watch session on the server, or nil if we aren't watching. Requests sent on behalf of this session don't come back to us as changes; see NoteWrite.
 
 Events:
 	Changed(filepath): fires when any file changes (be it added, removed, etc.)
 
 Methods:
+	Reconnect(): brings the tree up to date with the server & starts watching it again. Only what changed since we were last connected is fetched, if the server still remembers.
+	NoteWrite(filePath, contents): updates the tree with a file we wrote to the server.
+	NoteDelete(filePath): updates the tree with a file we deleted from the server.
 	Destroy(): cleans up this instance.
 
 Constructors:
@@ -27,6 +31,8 @@ local Debug = Utils.new("Log", "FilesystemModel: ", false);
 local ServerRequests = require(script.Parent.Parent.ServerRequests);
 local Helpers = require(script.Parent.Helpers);
 
+local POLL_BATCH_SIZE = 500; --The most file changes we ask the server for in a single poll.
+
 local SUFFIXES = Helpers.SUFFIXES;
 local SplitFilePath = Helpers.SplitFilePath;
 local RemoveRoot = Helpers.RemoveRoot;
@@ -39,6 +45,7 @@ FilesystemModel._FileChangedEvent = false;
 FilesystemModel._PropertyChangedEvent = false; --Oops. Changed used to be used for file changes, despite that property changes are canonical for the "Changed" event.
 FilesystemModel._PollKey = false;
 FilesystemModel._Connected = false;
+FilesystemModel._Generation = 0; --The generation of the server's change history which our tree is up to date with.
 
 FilesystemModel.Get.Root = "_Root";
 FilesystemModel.Get.Tree = "_Tree";
@@ -46,6 +53,7 @@ FilesystemModel.Get.Changed = function(self) Utils.Log.Warning("Use FileChanged,
 FilesystemModel.Get.FileChanged = function(self) return self._FileChangedEvent.Event; end
 FilesystemModel.Get.PropertyChanged = function(self) return self._PropertyChangedEvent.Event; end
 FilesystemModel.Get.Connected = "_Connected";
+FilesystemModel.Get.Session = function(self) return self._PollKey or nil; end
 
 --[[ @brief Takes input returned by the `parse` operation and makes it more usable (tables and such).
 	@param tree A set of data where each line has a file path & a hash.
@@ -106,28 +114,23 @@ local function GetEntryInTree(root, path, name)
 	return root.Children[name];
 end
 
---[[ @brief Queries the current state of the file hierarchy on the remote.
+--[[ @brief Agrees upon a hash algorithm with the server.
+
+	The server doesn't remember the agreement; every request names the
+	algorithm instead. Servers which don't understand hash_algorithm use the
+	"length" algorithm.
 --]]
-function FilesystemModel:_QueryServer()
-	local success, parseResult = ServerRequests.parse{
-		File = self._Root;
-		Depth = 0;
-		Hash = true;
+local function NegotiateHashAlgorithm()
+	local success, response = ServerRequests.hash_algorithm{
+		Algorithms = table.concat(Helpers.PREFERRED_HASH_ALGORITHMS, " ");
 	};
-	if success then
-		local parseResult = SimplifyParseResult(parseResult.Tree);
-		local root = { Name = "<root>"; Type = "folder"; FullPath = ""; Children = {}; };
-		for _, line in pairs(parseResult) do
-			Debug("Path: %s", line.Path);
-			local path, file = SplitFilePath(RemoveRoot(line.Path, self._Root));
-			AddEntryToTree(root, path, file, { Name = file; Type = "file"; Hash = line.Hash});
-		end
-		self._Tree = root;
-		self._Connected = true;
-		self._PropertyChangedEvent:Fire("Connected");
+	if success and Helpers.HASH_ALGORITHMS[response.Algorithm] then
+		Helpers.HashAlgorithm = response.Algorithm;
 	else
-		self._Connected = false;
+		Helpers.HashAlgorithm = "length";
 	end
+	ServerRequests.SetHashAlgorithm(Helpers.HashAlgorithm);
+	Debug("Hash algorithm: %s", Helpers.HashAlgorithm);
 end
 
 --[[ @brief Converts the FileChange parameter provided by the server into something more usable.
@@ -162,6 +165,160 @@ local function SimplifyWatchPollResult(text)
 	end
 end
 
+--[[ @brief Converts the FileChanges parameter provided by the server into something more usable.
+	@param text The text provided by the server; each line is a FileChange as understood by SimplifyWatchPollResult.
+	@return A list of tables, each of which is one of the forms returned by SimplifyWatchPollResult.
+--]]
+local function SimplifyWatchPollBatchResult(text)
+	if text == nil or text == "" then
+		return { SimplifyWatchPollResult(text) };
+	end
+	local s = {};
+	for line in string.gmatch(text, "[^\n]+") do
+		table.insert(s, SimplifyWatchPollResult(line));
+	end
+	return s;
+end
+
+--[[ @brief Updates our tree with a single change reported by the server.
+	@param result A table as returned by SimplifyWatchPollResult.
+	@return "healthy" if the server is responding as expected, "failure" if the request failed, or "stop" if we should stop watching.
+--]]
+function FilesystemModel:_ApplyWatchPollResult(result)
+	if result.Mode == "modify" then
+		--Find this object in our tree & update its hash.
+		local path, filename = SplitFilePath(RemoveRoot(result.FilePath, self._Root));
+		local obj = GetEntryInTree(self._Tree, path, filename);
+		if obj then
+			obj.Hash = result.Hash;
+		else
+			AddEntryToTree(self._Tree, path, filename, { Hash = result.Hash; });
+		end
+		self._FileChangedEvent:Fire(path .. "/" .. filename);
+	elseif result.Mode == "error" then
+		if result.Message == "ID_NO_LONGER_VALID" then
+			self._PollKey = false; --we implicitly have stopped watching.
+			--Catch up on whatever we missed & start a new session.
+			spawn(function() self:Reconnect(); end);
+		elseif result.Message == "RESYNC" then
+			--The server lost track of what changed; our session is still good, but our tree can't be trusted.
+			--Changes from here on still come through the session, so a full listing is all we need.
+			self._Generation = 0;
+			spawn(function() self:_QueryServer(); end);
+		else
+			Debug("Unexpected error; terminating connection");
+			return "stop";
+		end
+	elseif result.Mode == "add" then
+		local path, filename = SplitFilePath(RemoveRoot(result.FilePath, self._Root));
+		local entry = { Hash = result.Hash; };
+		AddEntryToTree(self._Tree, path, filename, entry);
+		Debug("New Entry: %t", entry);
+		self._FileChangedEvent:Fire(path .. "/" .. filename);
+	elseif result.Mode == "delete" then
+		local path, filename = SplitFilePath(RemoveRoot(result.FilePath, self._Root));
+		local obj = GetEntryInTree(self._Tree, path, filename);
+		if obj and obj.Parent then
+			obj.Parent.Children[obj.Name] = nil;
+			self._FileChangedEvent:Fire(path .. "/" .. filename);
+		end
+	elseif result.Mode == "timeout" then
+		--Not a big deal! We'll just poll again.
+	elseif result.Mode == "failure" then
+		return "failure";
+	else
+		Debug("Unexpected mode: %s", result.Mode);
+		return "failure";
+	end
+	return "healthy";
+end
+
+--[[ @brief Updates our tree with a file we wrote to the server. The server doesn't report changes made on behalf of our session back to us, so this is how our tree learns of them.
+	@param filePath The path of the file, as sent to the server.
+	@param contents The contents which were written.
+--]]
+function FilesystemModel:NoteWrite(filePath, contents)
+	local path, filename = SplitFilePath(RemoveRoot(filePath, self._Root));
+	local hash = Helpers.HASH_ALGORITHMS[Helpers.HashAlgorithm](contents);
+	local obj = GetEntryInTree(self._Tree, path, filename);
+	if obj then
+		obj.Hash = hash;
+	else
+		AddEntryToTree(self._Tree, path, filename, { Hash = hash; });
+	end
+end
+
+--[[ @brief Updates our tree with a file we deleted from the server.
+	@param filePath The path of the file, as sent to the server.
+--]]
+function FilesystemModel:NoteDelete(filePath)
+	local path, filename = SplitFilePath(RemoveRoot(filePath, self._Root));
+	local obj = GetEntryInTree(self._Tree, path, filename);
+	if obj and obj.Parent then
+		obj.Parent.Children[obj.Name] = nil;
+	end
+end
+
+--[[ @brief Queries the current state of the file hierarchy on the remote.
+
+	If we've queried before, only the files which changed since then are fetched.
+--]]
+function FilesystemModel:_QueryServer()
+	local previousAlgorithm = Helpers.HashAlgorithm;
+	NegotiateHashAlgorithm();
+	if Helpers.HashAlgorithm ~= previousAlgorithm then
+		--Every hash in our tree is stale.
+		self._Generation = 0;
+	end
+	local success, response = ServerRequests.parse_since{
+		File = self._Root;
+		Generation = self._Generation;
+	};
+	if success then
+		local changes = SimplifyWatchPollBatchResult(response.Changes);
+		if response.Mode == "full" or not self._Tree then
+			local root = { Name = "<root>"; Type = "folder"; FullPath = ""; Children = {}; };
+			for _, change in ipairs(changes) do
+				if change.Mode == "add" then
+					local path, file = SplitFilePath(RemoveRoot(change.FilePath, self._Root));
+					AddEntryToTree(root, path, file, { Name = file; Type = "file"; Hash = change.Hash; });
+				end
+			end
+			self._Tree = root;
+		else
+			Debug("Applying %d changes since generation %s", #changes, self._Generation);
+			for _, change in ipairs(changes) do
+				self:_ApplyWatchPollResult(change);
+			end
+		end
+		self._Generation = response.Generation;
+		self._Connected = true;
+		self._PropertyChangedEvent:Fire("Connected");
+		return;
+	end
+	--Servers which predate parse_since only understand parse.
+	local success, parseResult = ServerRequests.parse{
+		File = self._Root;
+		Depth = 0;
+		Hash = true;
+	};
+	if success then
+		local parseResult = SimplifyParseResult(parseResult.Tree);
+		local root = { Name = "<root>"; Type = "folder"; FullPath = ""; Children = {}; };
+		for _, line in pairs(parseResult) do
+			Debug("Path: %s", line.Path);
+			local path, file = SplitFilePath(RemoveRoot(line.Path, self._Root));
+			AddEntryToTree(root, path, file, { Name = file; Type = "file"; Hash = line.Hash});
+		end
+		self._Tree = root;
+		self._Generation = 0;
+		self._Connected = true;
+		self._PropertyChangedEvent:Fire("Connected");
+	else
+		self._Connected = false;
+	end
+end
+
 --[[ @brief Starts watching a file hierarchy on the server.
 --]]
 function FilesystemModel:_StartWatching()
@@ -185,54 +342,25 @@ function FilesystemModel:_StartWatching()
 		local failures = 0;
 		while key == self._PollKey and failures <= 2 do
 			failures = failures + 1;
-			local success, response = ServerRequests.watch_poll{
+			local success, response = ServerRequests.watch_poll_batch{
 				ID = key;
+				MaxCount = POLL_BATCH_SIZE;
 			};
-			Debug("watch_poll results: %s, %s", success, response);
+			Debug("watch_poll_batch results: %s, %s", success, response);
 			if key ~= self._PollKey then break; end
-			Debug("Response: %0t", response);
-			local result = SimplifyWatchPollResult(response.FileChange);
-			Debug("SimplifiedWatchPollResult: %s --> %0t", response.FileChange, result);
-			if result.Mode == "modify" then
-				failures = 0;
-				--Find this object in our tree & update its hash.
-				local path, filename = SplitFilePath(RemoveRoot(result.FilePath, self._Root));
-				local obj = GetEntryInTree(self._Tree, path, filename);
-				if obj then
-					obj.Hash = result.Hash;
-				else
-					AddEntryToTree(self._Tree, path, filename, { Hash = result.Hash; });
-				end
-				self._FileChangedEvent:Fire(path .. "/" .. filename);
-			elseif result.Mode == "error" then
-				if result.Message == "ID_NO_LONGER_VALID" then
-					self._PollKey = false; --we implicitly have stopped watching.
-				else
-					Debug("Unexpected error; terminating connection");
+			local results = SimplifyWatchPollBatchResult(success and response.FileChanges or nil);
+			Debug("SimplifiedWatchPollBatchResult: %0t", results);
+			local stop = false;
+			for _, result in ipairs(results) do
+				local status = self:_ApplyWatchPollResult(result);
+				if status == "healthy" then
+					failures = 0;
+				elseif status == "stop" then
+					stop = true;
 					break;
 				end
-			elseif result.Mode == "add" then
-				failures = 0;
-				local path, filename = SplitFilePath(RemoveRoot(result.FilePath, self._Root));
-				local entry = { Hash = result.Hash; };
-				AddEntryToTree(self._Tree, path, filename, entry);
-				Debug("New Entry: %t", entry);
-				self._FileChangedEvent:Fire(path .. "/" .. filename);
-			elseif result.Mode == "delete" then
-				failures = 0;
-				local path, filename = SplitFilePath(RemoveRoot(result.FilePath, self._Root));
-				local obj = GetEntryInTree(self._Tree, path, filename);
-				if obj and obj.Parent then
-					obj.Parent.Children[obj.Name] = nil;
-					self._FileChangedEvent:Fire(path .. "/" .. filename);
-				end
-			elseif result.Mode == "timeout" then
-				--Not a big deal! We'll just poll again.
-				failures = 0;
-			elseif result.Mode == "failure" then
-			else
-				Debug("Unexpected mode: %s", result.Mode);
 			end
+			if stop then break; end
 		end
 		if key == self._PollKey then
 			self._Connected = false;
@@ -252,6 +380,15 @@ function FilesystemModel:_StopWatching()
 	end
 end
 
+--[[ @brief Brings the tree up to date with the server & starts watching it again.
+--]]
+function FilesystemModel:Reconnect()
+	self:_QueryServer();
+	if self._Connected then
+		self:_StartWatching();
+	end
+end
+
 --[[ @brief Cleans up this instance.
 --]]
 function FilesystemModel:Destroy()
@@ -395,28 +532,32 @@ function FilesystemModel.Test()
 			end
 		end
 	end
+	--@brief Hashes a source string the same way the server will hash the file.
+	local function H(source)
+		return Helpers.HASH_ALGORITHMS[Helpers.HashAlgorithm](source);
+	end
 	local baseExpectation = {
 		Folder = {
-			["Subfolder.server.lua"] = "22";
-			["Script.server.lua"] = "23";
+			["Subfolder.server.lua"] = H('print("Hello world!")\n');
+			["Script.server.lua"] = H("print('Hello, World!');");
 			Subfolder = {
-				["ModuleScript.module.lua"] = "33";
-				["LocalScript.client.lua"] = "22";
+				["ModuleScript.module.lua"] = H("local module = {}\n\nreturn module\n");
+				["LocalScript.client.lua"] = H('print("Hello world!")\n');
 			};
 		};
 	};
 
-	baseExpectation.Folder["Script.server.lua"] = "7";
+	baseExpectation.Folder["Script.server.lua"] = H("foobar\n");
 	SetExpectations(baseExpectation);
 	ServerRequests.write{File = "SyncyTowne/server/testdir2/Folder/Script.server.lua", Contents = "foobar\n"};
 	WaitForExpectations();
 
-	baseExpectation.Folder["Script.server.lua"] = "23";
+	baseExpectation.Folder["Script.server.lua"] = H("print('Hello, World!');");
 	SetExpectations(baseExpectation);
 	ServerRequests.write{File = "SyncyTowne/server/testdir2/Folder/Script.server.lua", Contents = "print('Hello, World!');"};
 	WaitForExpectations();
 
-	baseExpectation.Folder["NewScript.server.lua"] = "7";
+	baseExpectation.Folder["NewScript.server.lua"] = H("foobar\n");
 	SetExpectations(baseExpectation);
 	ServerRequests.write({File = "SyncyTowne/server/testdir2/Folder/NewScript.server.lua", Contents = "foobar\n"; });
 	WaitForExpectations();
@@ -60,15 +60,91 @@ function module.RemoveRoot(path, root)
 	return path:sub(#root + 2);
 end
 
---[[ @brief Converts an instance into a string which kinda/sorta represents it.
+local CRC32_TABLE = {};
+for i = 0, 255 do
+	local c = i;
+	for _ = 1, 8 do
+		if bit32.band(c, 1) == 1 then
+			c = bit32.bxor(0xEDB88320, bit32.rshift(c, 1));
+		else
+			c = bit32.rshift(c, 1);
+		end
+	end
+	CRC32_TABLE[i] = c;
+end
+
+--[[ @brief Computes the CRC-32 of a string (matching the server's crc32 hash algorithm).
+
+	CRLF line endings are hashed as LF.
+	@param source The string to hash.
+	@return The CRC as an 8-digit hex string.
+--]]
+local function Crc32(source)
+	source = string.gsub(source, "\r\n", "\n");
+	local crc = 0xFFFFFFFF;
+	for i = 1, #source do
+		crc = bit32.bxor(bit32.rshift(crc, 8), CRC32_TABLE[bit32.band(bit32.bxor(crc, string.byte(source, i)), 0xFF)]);
+	end
+	return string.format("%08x", bit32.bxor(crc, 0xFFFFFFFF));
+end
+
+--A map of hash algorithm name -> function which hashes a script's source. These must match the server's.
+module.HASH_ALGORITHMS = {
+	crc32 = Crc32;
+	length = function(source) return tostring(string.len(source)); end;
+};
+
+--The preferred hash algorithms, most preferred first. "length" is understood by servers which predate negotiation.
+module.PREFERRED_HASH_ALGORITHMS = { "crc32", "length" };
+
+--The algorithm agreed upon with the server.
+module.HashAlgorithm = "length";
+
+--[[ @brief Converts an instance into a string which represents its source.
 	@param obj A roblox instance
 	@return A string that is the object's hash.
 --]]
 function module.Hash(obj)
-	return tostring(string.len(obj.Source));
+	return module.HASH_ALGORITHMS[module.HashAlgorithm](obj.Source);
 end
 module.GetHash = module.Hash;
 
+--[[ @brief Frames files for a write_many request.
+	@param files An array of tables with Path & Contents keys.
+	@return The request payload.
+--]]
+function module.EncodeFiles(files)
+	local s = {};
+	for i, file in ipairs(files) do
+		table.insert(s, string.format("%s\n%d\n%s", file.Path, #file.Contents, file.Contents));
+	end
+	return table.concat(s);
+end
+
+--[[ @brief Splits a read_many/write_many response into the results for each file.
+	@param text The response text.
+	@return[1] An array of tables with Path, Status ("ok" or "error") & Contents keys.
+	@return[2] nil
+	@return[2] The error string.
+--]]
+function module.DecodeResults(text)
+	local results = {};
+	local i = 1;
+	while i <= #text do
+		local path, status, length, start = string.match(text, "^([^\n]*)\n([^\n]*)\n(%d+)\n()", i);
+		if not path then
+			return nil, Utils.Log.Format("Malformed result header at byte %s", i);
+		end
+		local finish = start + tonumber(length) - 1;
+		if finish > #text then
+			return nil, Utils.Log.Format("Result for %s is truncated", path);
+		end
+		table.insert(results, { Path = path; Status = status; Contents = string.sub(text, start, finish); });
+		i = finish + 1;
+	end
+	return results;
+end
+
 --[[ @brief Determines which suffix a filename has, if any, and removes it.
 
 	Example:
@@ -96,7 +172,7 @@ end
 			another-file-which-is-a-child-of-Folder.txt
 --]]
 function module.BuildFakeFilesystemModel(str)
-	local root = { Tree = { Name = "<root>"; Type = "folder"; FullPath = ""; Parent = nil; Children = {}; }; }
+	local root = { Tree = { Name = "<root>"; Type = "folder"; FullPath = ""; Parent = nil; Children = {}; }; NoteWrite = function() end; NoteDelete = function() end; }
 	local stack = {root.Tree};
 	local lastIndentation;
 	for line in string.gmatch(str, "[^\n]+") do
@@ -17,6 +17,13 @@ for i, v in pairs(commands.Commands) do
 	ServerRequests[v.Name] = requestWrapper.Commands[v.Name];
 end
 
+--[[ @brief Sets the hash algorithm named in every request from now on.
+	@param name The algorithm agreed upon with the server.
+--]]
+function ServerRequests.SetHashAlgorithm(name)
+	requestWrapper.HashAlgorithm = name;
+end
+
 function ServerRequests.Test()
 	ServerRequests.read{File="foo"}
 end
@@ -33,6 +33,56 @@ return [[
 			"ResponseArguments": [
 			]
 		},
+		{
+			"Name": "read_delta",
+			"Arguments": [
+				{
+					"Name": "File",
+					"Type": "FilePath"
+				},
+				{
+					"Name": "Base",
+					"Type": "String"
+				}
+			],
+			"ResponseArguments": [
+				{
+					"Name": "Mode",
+					"Type": "String"
+				},
+				{
+					"Name": "Hash",
+					"Type": "String"
+				},
+				{
+					"Name": "Contents",
+					"Type": "*"
+				}
+			]
+		},
+		{
+			"Name": "write_delta",
+			"Arguments": [
+				{
+					"Name": "File",
+					"Type": "FilePath"
+				},
+				{
+					"Name": "Base",
+					"Type": "String"
+				},
+				{
+					"Name": "Hash",
+					"Type": "String"
+				},
+				{
+					"Name": "Delta",
+					"Type": "*"
+				}
+			],
+			"ResponseArguments": [
+			]
+		},
 		{
 			"Name": "delete",
 			"Arguments": [
@@ -44,6 +94,47 @@ return [[
 			"ResponseArguments": [
 			]
 		},
+		{
+			"Name": "flush",
+			"Arguments": [
+			],
+			"ResponseArguments": [
+				{
+					"Name": "Errors",
+					"Type": "*"
+				}
+			]
+		},
+		{
+			"Name": "read_many",
+			"Arguments": [
+				{
+					"Name": "Files",
+					"Type": "*"
+				}
+			],
+			"ResponseArguments": [
+				{
+					"Name": "Results",
+					"Type": "*"
+				}
+			]
+		},
+		{
+			"Name": "write_many",
+			"Arguments": [
+				{
+					"Name": "Files",
+					"Type": "*"
+				}
+			],
+			"ResponseArguments": [
+				{
+					"Name": "Results",
+					"Type": "*"
+				}
+			]
+		},
 		{
 			"Name": "parse",
 			"Arguments": [
@@ -67,6 +158,79 @@ return [[
 				}
 			]
 		},
+		{
+			"Name": "parse_since",
+			"Arguments": [
+				{
+					"Name": "File",
+					"Type": "FilePath"
+				},
+				{
+					"Name": "Generation",
+					"Type": "Number"
+				}
+			],
+			"ResponseArguments": [
+				{
+					"Name": "Generation",
+					"Type": "Number"
+				},
+				{
+					"Name": "Mode",
+					"Type": "String"
+				},
+				{
+					"Name": "Changes",
+					"Type": "*"
+				}
+			]
+		},
+		{
+			"Name": "diff",
+			"Arguments": [
+				{
+					"Name": "File",
+					"Type": "FilePath"
+				},
+				{
+					"Name": "Suffixes",
+					"Type": "String"
+				},
+				{
+					"Name": "Manifest",
+					"Type": "*"
+				}
+			],
+			"ResponseArguments": [
+				{
+					"Name": "Differences",
+					"Type": "*"
+				}
+			]
+		},
+		{
+			"Name": "hash_tree",
+			"Arguments": [
+				{
+					"Name": "File",
+					"Type": "FilePath"
+				},
+				{
+					"Name": "Suffixes",
+					"Type": "String"
+				},
+				{
+					"Name": "Depth",
+					"Type": "Number"
+				}
+			],
+			"ResponseArguments": [
+				{
+					"Name": "Hashes",
+					"Type": "*"
+				}
+			]
+		},
 		{
 			"Name": "hash",
 			"Arguments": [
@@ -82,6 +246,21 @@ return [[
 				}
 			]
 		},
+		{
+			"Name": "hash_algorithm",
+			"Arguments": [
+				{
+					"Name": "Algorithms",
+					"Type": "String"
+				}
+			],
+			"ResponseArguments": [
+				{
+					"Name": "Algorithm",
+					"Type": "String"
+				}
+			]
+		},
 		{
 			"Name": "watch_start",
 			"Arguments": [
@@ -112,6 +291,25 @@ return [[
 				}
 			]
 		},
+		{
+			"Name": "watch_poll_batch",
+			"Arguments": [
+				{
+					"Name": "ID",
+					"Type": "Number"
+				},
+				{
+					"Name": "MaxCount",
+					"Type": "Number"
+				}
+			],
+			"ResponseArguments": [
+				{
+					"Name": "FileChanges",
+					"Type": "*"
+				}
+			]
+		},
 		{
 			"Name": "watch_stop",
 			"Arguments": [
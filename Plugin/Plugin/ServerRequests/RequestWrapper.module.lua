@@ -11,9 +11,14 @@ Properties:
 		arguments. The function's return values are: (boolean, table) where the
 		boolean indicates if the request succeeded & the table provides all
 		arguments returned by the server. If boolean is false, table will
-		instead be an error string.
+		instead be an error string. If the table has a Session key, the
+		request is made on behalf of that watch session, which then isn't
+		told about the changes the request makes.
 	DestinationAddress (string): the URL on which our webserver is running.
 	DestinationPort (number): the port on which our webserver is running.
+	HashAlgorithm (string): the hash algorithm agreed upon with the server
+		(see hash_algorithm), which every request names. If nil, the server
+		uses "length".
 
 Methods:
 	RegisterCommand(commandDefinition): registers a command so it can be sent
@@ -138,21 +143,34 @@ local RequestWrapper = Utils.new("Class", "RequestWrapper");
 
 RequestWrapper._Commands = {};
 RequestWrapper.DestinationAddress = "http://127.0.0.1:605";
+--Requests at least this many bytes long are sent gzipped; the server decodes them.
+RequestWrapper.CompressionThreshold = 1024;
 
 RequestWrapper.Get.Commands = "_Commands";
+RequestWrapper.Get.HashAlgorithm = "_HashAlgorithm";
+RequestWrapper.Set.HashAlgorithm = function(self, v) self._HashAlgorithm = v; end;
 
 --[[ @brief Issues a command against the remote HTTP server.
 	@param cmd The command we are issuing.
 	@param args The arguments for this command.
+	@param session The ID of the watch session the command is issued on behalf of, if any.
 	@return[1] true
 	@return[1] A string response provided by the server.
 	@return[2] false
 	@return[2] The error string.
 --]]
-function RequestWrapper:_IssueCommand(cmd, args)
+function RequestWrapper:_IssueCommand(cmd, args, session)
 	local url = self.DestinationAddress;
 	local text = cmd .. "\n" .. args;
-	local success, response = pcall(game:GetService("HttpService").PostAsync, game:GetService("HttpService"), url, text);
+	local compress = #text >= self.CompressionThreshold;
+	local headers = nil;
+	if session or self._HashAlgorithm then
+		headers = {
+			["X-SyncyTowne-Session"] = session and tostring(session) or nil;
+			["X-SyncyTowne-Hash-Algorithm"] = self._HashAlgorithm;
+		};
+	end
+	local success, response = pcall(game:GetService("HttpService").PostAsync, game:GetService("HttpService"), url, text, Enum.HttpContentType.TextPlain, compress, headers);
 	Debug("PostAsync(%s, %s) = %s (%s)", url, text, response, success and "success" or "failure");
 	return success, response;
 end
@@ -198,7 +216,7 @@ function RequestWrapper:RegisterCommand(commandDef)
 		end
 
 		--Issue the call to the server.
-		local success, response = self:_IssueCommand(name, argsString);
+		local success, response = self:_IssueCommand(name, argsString, args.Session);
 		if not success then
 			local errString = argsString;
 			Debug("Failure to send command %s due to HTTP failure: %s", name, errString);
@@ -0,0 +1,325 @@
+"""
+An asyncio implementation of the SyncyTowne HTTP server.
+
+server.HttpServer parks a thread on every request, including long polls which can sit idle for
+FileWatchCommandHandler.POLL_TIMEOUT seconds. This server handles every connection on one event loop instead:
+commands are dispatched on the loop, blocking work (disk I/O, hashing) is sent to a thread pool, and long polls
+await futures which the file watchers resolve.
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import http
+import threading
+import time
+from logger import logger
+import commandhandler
+import commandhandler.helpers as helpers
+import compression
+import metrics
+
+class AsyncHttpServer(threading.Thread):
+	"""
+	Runs the event loop on its own thread so it can be started & killed like server.HttpServer.
+	"""
+	MAX_HEADER_COUNT = 100
+	STREAM_CHUNK_SIZE = 16 * 1024  # Streamed responses are sent in chunks of at least this many bytes...
+	STREAM_FLUSH_INTERVAL = .05  # ...unless this many seconds pass first.
+
+	def __init__(self, commandvalidator, port = 605, workers = None, compressor = None):
+		"""
+		:param commandvalidator: the CommandValidator which handles every request.
+		:param port: the port to listen on.
+		:param workers: the number of threads blocking work is done on; defaults to the executor's default.
+		:param compressor: the compression.Compressor responses are compressed with; defaults to a new one.
+		"""
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self._CommandValidator = commandvalidator
+		self.Port = port
+		self.Compressor = compressor or compression.Compressor()
+		commandvalidator.metrics.counter("syncytowne_compression_cache_hits_total", "Compressed responses served from the cache.",
+			function=lambda: self.Compressor.Hits)
+		(self._ReceivedBytes, self._SentBytes) = metrics.traffic(commandvalidator.metrics)
+		self._Executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="AsyncServerWorker")
+		self._Loop = None
+		self._ServeTask = None
+		self._Ready = threading.Event()
+		self._Error = None
+
+	def start(self):
+		"""
+		Starts the server & waits until it's listening.
+		"""
+		threading.Thread.start(self)
+		self._Ready.wait()
+		if self._Error is not None:
+			raise self._Error
+
+	def run(self):
+		self._Loop = asyncio.new_event_loop()
+		self._Loop.set_default_executor(self._Executor)
+		try:
+			self._Loop.run_until_complete(self._Serve())
+		finally:
+			self._Loop.close()
+
+	async def _Serve(self):
+		try:
+			server = await asyncio.start_server(self._HandleConnection, "", self.Port)
+		except Exception as e:
+			self._Error = e
+			self._Ready.set()
+			return
+		self._ServeTask = asyncio.current_task()
+		self._Ready.set()
+		try:
+			async with server:
+				await server.serve_forever()
+		except asyncio.CancelledError:
+			pass
+
+	def kill(self):
+		if self._Loop is not None and self._ServeTask is not None:
+			self._Loop.call_soon_threadsafe(self._ServeTask.cancel)
+			self.join()
+		self._Executor.shutdown(wait=False)
+
+	async def _ReadRequest(self, reader, writer):
+		"""
+		Reads an HTTP request.
+		:return: (method, path, version, headers, body) where headers is a dict keyed by lowercase names, or None
+			if the client went away first.
+		"""
+		requestLine = await reader.readline()
+		if not requestLine:
+			return None
+		try:
+			(method, path, version) = requestLine.decode("latin-1").split()
+		except ValueError:
+			raise commandhandler.HttpException(400, None, "Bad request line {!r}".format(requestLine))
+		headers = {}
+		while True:
+			line = await reader.readline()
+			if line in (b"\r\n", b"\n", b""):
+				break
+			if len(headers) >= self.MAX_HEADER_COUNT:
+				raise commandhandler.HttpException(431)
+			(key, _, value) = line.decode("latin-1").partition(":")
+			headers[key.strip().lower()] = value.strip()
+		# If the client is expecting us to send a "continue", do it.
+		if headers.get("expect", "").lower() == "100-continue":
+			writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+			await writer.drain()
+		body = await reader.readexactly(int(headers.get("content-length", 0)))
+		return (method, path, version, headers, body)
+
+	@staticmethod
+	def _Head(code, headers):
+		lines = ["HTTP/1.1 {} {}".format(code, http.HTTPStatus(code).phrase)]
+		lines.extend("{}: {}".format(key, value) for (key, value) in headers)
+		lines.append("connection: close")
+		return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+	def _SendMetrics(self, writer, path):
+		if path.partition("?")[0] != "/metrics":
+			self._SendError(writer, 404)
+			return
+		body = self._CommandValidator.metrics.render().encode()
+		writer.write(self._Head(200, [("content-type", metrics.CONTENT_TYPE), ("content-length", len(body))]) + body)
+
+	def _SendError(self, writer, code, explanation = None):
+		body = (explanation or "").encode()
+		writer.write(self._Head(code, [("content-type", "text/plain; charset=utf-8"), ("content-length", len(body))]) + body)
+
+	async def _HandleConnection(self, reader, writer):
+		try:
+			try:
+				request = await self._ReadRequest(reader, writer)
+			except commandhandler.HttpException as e:
+				self._SendError(writer, e.code, e.explain)
+				return
+			if request is None:
+				return
+			(method, path, version, headers, body) = request
+			logger.info("{} {} {} from {}", method, path, version, writer.get_extra_info("peername"))
+			if method == "GET":
+				self._SendMetrics(writer, path)
+				return
+			if method != "POST":
+				self._SendError(writer, 501, "Unsupported method {}".format(method))
+				return
+			self._ReceivedBytes.inc(amount=len(body))
+			if headers.get("content-encoding"):
+				try:
+					body = await asyncio.get_running_loop().run_in_executor(None, compression.decode, body, headers["content-encoding"])
+				except commandhandler.HttpException as e:
+					self._SendError(writer, e.code, e.explain)
+					return
+			coding = compression.negotiate(headers.get("accept-encoding"))
+			await self._HandleRequest(reader, writer, version, body, coding, headers.get(helpers.SESSION_HEADER.lower()), headers.get(helpers.HASH_ALGORITHM_HEADER.lower()))
+			await writer.drain()
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		finally:
+			writer.close()
+
+	async def _HandleRequest(self, reader, writer, version, request, coding, origin = None, algorithm = None):
+		"""
+		:param origin: the watch session the request was made on behalf of, if any.
+		:param algorithm: the hash algorithm the client named, if any.
+		"""
+		# Every request gets its own task (& so its own context), which the token is set in.
+		token = helpers.CancellationToken()
+		with helpers.Cancellation(token), helpers.Origin(origin), helpers.HashAlgorithm(algorithm):
+			handling = asyncio.ensure_future(self._CommandValidator.handle_async(request))
+			# The connection is closed after the response, so the client has nothing more to send us; reading
+			# tells us if it goes away.
+			disconnect = asyncio.ensure_future(reader.read(1))
+			try:
+				await asyncio.wait([handling, disconnect], return_when=asyncio.FIRST_COMPLETED)
+				if not handling.done() and not self._Disconnected(disconnect):
+					await asyncio.wait([handling])
+				if not handling.done():
+					logger.info("Client disconnected; cancelling its request")
+					token.cancel()
+					handling.cancel()
+					return
+				try:
+					response = handling.result()
+				except helpers.Cancelled:
+					logger.info("Request cancelled; not responding")
+					return
+				except commandhandler.HttpException as e:
+					logger.warning("", exc_info=e)
+					self._SendError(writer, e.code, e.explain)
+					return
+				except Exception as e:
+					logger.error("", exc_info=e)
+					self._SendError(writer, 500)
+					return
+				if isinstance(response, str):
+					await self._SendBody(writer, response.encode(), coding)
+				else:
+					await self._SendStreamed(writer, version, response, disconnect, token, coding)
+			finally:
+				disconnect.cancel()
+
+	@staticmethod
+	def _Disconnected(disconnect):
+		if not disconnect.done():
+			return False
+		return disconnect.cancelled() or disconnect.exception() is not None or disconnect.result() == b""
+
+	async def _SendBody(self, writer, body, coding, compressed = None):
+		"""
+		Sends a response all at once, compressing it if it's worth it.
+		:param compressed: the body already compressed with the coding, if it has been.
+		"""
+		headers = []
+		if compressed is not None:
+			headers.append(("content-encoding", coding))
+			body = compressed
+		elif coding is not None and len(body) >= self.Compressor.Threshold:
+			# Compressing is CPU bound, so it mustn't hold up the loop.
+			compressed = await asyncio.get_running_loop().run_in_executor(None, self.Compressor.compress, body, coding)
+			if compressed is not None:
+				headers.append(("content-encoding", coding))
+				body = compressed
+		headers.append(("content-length", len(body)))
+		writer.write(self._Head(200, headers) + body)
+		self._SentBytes.inc(amount=len(body))
+
+	def _NextChunk(self, pieces, stream):
+		"""
+		Pulls pieces of a streamed response until there are enough to send. This blocks, so it runs on the executor.
+		:param stream: the compression.StreamCompressor to compress the chunk with, or None.
+		:return: the bytes to send, or None if the response is over.
+		"""
+		buffer = []
+		size = 0
+		flush_time = time.monotonic() + self.STREAM_FLUSH_INTERVAL
+		for piece in pieces:
+			data = piece.encode() if isinstance(piece, str) else piece
+			buffer.append(data)
+			size += len(data)
+			if size >= self.STREAM_CHUNK_SIZE or time.monotonic() >= flush_time:
+				break
+		else:
+			if not buffer:
+				return None
+		data = b"".join(buffer)
+		if stream is not None and data:
+			data = stream.compress(data)
+		return data
+
+	async def _SendStreamed(self, writer, version, pieces, disconnect, token, coding):
+		"""
+		Sends a streamed response using chunked transfer encoding (or, for HTTP/1.0 clients, all at once).
+		"""
+		loop = asyncio.get_running_loop()
+		context = contextvars.copy_context()
+		key = getattr(pieces, "CacheKey", None) if version != "HTTP/1.0" and coding is not None else None
+		try:
+			if key is not None:
+				compressed = self.Compressor.cached(key, coding)
+				if compressed is not None:
+					# We've sent this very response before, so it needn't be generated again.
+					await self._SendBody(writer, b"", coding, compressed)
+					return
+			if version == "HTTP/1.0" or coding is not None:
+				try:
+					if version == "HTTP/1.0":
+						# HTTP/1.0 clients don't understand chunked responses.
+						body = "".join(await loop.run_in_executor(None, context.run, list, pieces)).encode()
+						rest = None
+					else:
+						# A stream which ends before it's worth compressing is sent whole.
+						(body, rest) = await loop.run_in_executor(None, context.run, self.Compressor.buffer, pieces)
+				except helpers.Cancelled:
+					logger.info("Request cancelled; not responding")
+					return
+				except Exception as e:
+					logger.error("", exc_info=e)
+					self._SendError(writer, 500)
+					return
+				if body is not None:
+					await self._SendBody(writer, body, coding)
+					return
+				pieces = rest
+			headers = [("transfer-encoding", "chunked")]
+			stream = None
+			if coding is not None:
+				headers.insert(0, ("content-encoding", coding))
+				stream = self.Compressor.stream(coding, key)
+			writer.write(self._Head(200, headers))
+			try:
+				while not self._Disconnected(disconnect):
+					data = await loop.run_in_executor(None, context.run, self._NextChunk, pieces, stream)
+					if data is None:
+						tail = stream.finish() if stream is not None else b""
+						if tail:
+							writer.write(b"%x\r\n" % len(tail) + tail + b"\r\n")
+							self._SentBytes.inc(amount=len(tail))
+						writer.write(b"0\r\n\r\n")
+						return
+					if data:
+						writer.write(b"%x\r\n" % len(data) + data + b"\r\n")
+						self._SentBytes.inc(amount=len(data))
+						await writer.drain()
+				logger.info("Client disconnected while streaming the response")
+				token.cancel()
+			except helpers.Cancelled:
+				logger.info("Request cancelled while streaming the response")
+			except (ConnectionError, asyncio.CancelledError):
+				raise
+			except Exception as e:
+				# The status line is long gone; all we can do is cut the response short.
+				logger.error("Failed while streaming response", exc_info=e)
+		finally:
+			if hasattr(pieces, "close"):
+				try:
+					await loop.run_in_executor(None, context.run, pieces.close)
+				except ValueError:
+					pass  # We were cancelled while the executor was still generating a piece.
@@ -0,0 +1,64 @@
+"""
+Measures how many commands per second CommandValidator.handle gets through, without any HTTP in the way. The commands
+are cheap ones, so the time is mostly spent parsing requests & building responses.
+
+Usage (from the server directory):
+	python benchmarks/dispatch.py [--seconds S] [--log]
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+import commandhandler
+from logger import logger
+
+# name --> request
+COMMANDS = [
+	("hash", "hash\nprint('hello world')\n"),
+	("read", "read\nfile1.txt"),
+	("write", "write\nscratch.lua\nprint('hello world')\n"),
+	("parse", "parse\nmorefiles\n0\nTrue"),
+	("read_many", "read_many\nfile1.txt\nmorefiles/file2.txt"),
+]
+
+def timeCommand(validator, request, seconds):
+	"""
+	:return: the number of times the request was handled per second.
+	"""
+	count = 0
+	start = time.perf_counter()
+	end = start + seconds
+	while True:
+		# Check the clock every so often, so it isn't what we measure.
+		for i in range(100):
+			validator.handle(request)
+		count += 100
+		now = time.perf_counter()
+		if now >= end:
+			return count / (now - start)
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument("--seconds", type=float, default=2, help="how long to time each command for.")
+	parser.add_argument("--log", action="store_true", help="leave logging on (as the server does) rather than turning it down to warnings.")
+	args = parser.parse_args()
+
+	if not args.log:
+		logger.setLevel(logging.WARNING)
+	source = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "testdir")
+	with tempfile.TemporaryDirectory() as root:
+		shutil.copytree(source, root, dirs_exist_ok=True)
+		validator = commandhandler.create_command_handler(root)
+		for (name, request) in COMMANDS:
+			validator.handle(request)  # Warm up (e.g., the hash index).
+			print("{:<12} {:>10.0f} commands/s".format(name, timeCommand(validator, request, args.seconds)))
+
+if __name__ == "__main__":
+	main()
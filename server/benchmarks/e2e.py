@@ -0,0 +1,384 @@
+"""
+Runs the server end to end against synthetic project trees of game-scale size & writes the timings to a JSON file.
+
+For each tree size, this generates a tree of Lua scripts (seeded, so every run gets the same tree), starts a server on
+it & measures, from several simulated clients at once:
+	* ParseCold: a hashed parse of the whole tree with an empty hash index (the first parse after installing).
+	* ParseWarm: the same parse once the hash index is populated.
+	* ParseConcurrent: the warm parse again, with every client parsing at once.
+	* ReadMany / WriteMany: every file read/written with read_many/write_many in batches (as the plugin does),
+	  split between the clients.
+	* WatchLatency: the time from a file being written to each client's long poll reporting it.
+
+The server runs in this process, so its threads compete with the clients' for the GIL; compare results from the same
+machine & settings only.
+
+Usage (from the server directory):
+	python benchmarks/e2e.py [--sizes N [N ...]] [--clients C] [--server {threaded,async}] [--output FILE]
+		[--compare OLD_FILE] [--workdir DIR]
+"""
+
+import argparse
+import atexit
+import concurrent.futures
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+import commandhandler
+import server
+from logger import logger
+
+SEED = 2015
+BATCH_SIZE = 200  # Files per read_many/write_many, matching the plugin's Compare.BATCH_SIZE.
+FILES_PER_DIRECTORY = 12  # On average.
+MAX_DEPTH = 8
+WATCH_EVENTS = 50  # Files written while measuring WatchLatency...
+WATCH_INTERVAL = .02  # ...one every this many seconds.
+# Generated scripts are dated this long ago. The hash index won't remember files modified within its racy window, so
+# freshly written files would make every parse cold; a real project's scripts are mostly old.
+TREE_AGE = 24 * 60 * 60
+
+# Lines scripts are made of. Real scripts repeat themselves a lot, which matters for anything that compresses them.
+LUA_LINES = [
+	"local ReplicatedStorage = game:GetService(\"ReplicatedStorage\")",
+	"local Players = game:GetService(\"Players\")",
+	"local module = {}",
+	"function module.new(props)",
+	"\tlocal self = setmetatable({}, module)",
+	"\tself.Connections = {}",
+	"\tfor _, child in ipairs(props.Children) do",
+	"\t\ttable.insert(self.Connections, child.Changed:Connect(function(value) self:_OnChanged(child, value) end))",
+	"\tend",
+	"\treturn self",
+	"end",
+	"if not player.Character then player.CharacterAdded:Wait() end",
+	"-- TODO: debounce this once the animation system lands",
+	"local humanoid = character:FindFirstChildOfClass(\"Humanoid\")",
+	"assert(typeof(position) == \"Vector3\", \"expected a Vector3\")",
+	"return module",
+]
+
+##############################
+# Tree Generation
+##############################
+
+def generateTree(root, fileCount, seed = SEED):
+	"""
+	Generates a tree of Lua scripts. Directories nest randomly (each new one goes under a random existing one), so
+	most scripts are a few levels deep & a few are deep. Script sizes are log-normally distributed around 1KiB.
+	:return: a dict describing the tree.
+	"""
+	rng = random.Random(seed)
+	modified = time.time() - TREE_AGE
+	directories = [("", 0)]
+	for i in range(max(1, fileCount // FILES_PER_DIRECTORY) - 1):
+		while True:
+			(parent, depth) = rng.choice(directories)
+			if depth < MAX_DEPTH:
+				break
+		name = "{}{}".format(rng.choice(["Modules", "Systems", "UI", "Shared", "Client", "Server", "Util"]), i)
+		directories.append((parent + "/" + name if parent else name, depth + 1))
+	for (directory, depth) in directories:
+		os.makedirs(os.path.join(root, *directory.split("/")), exist_ok=True)
+	files = []
+	size = 0
+	for i in range(fileCount):
+		(directory, depth) = rng.choice(directories)
+		path = (directory + "/" if directory else "") + "Script{}.lua".format(i)
+		length = min(200 * 1024, max(40, int(rng.lognormvariate(math.log(1024), 1))))
+		lines = []
+		written = 0
+		while written < length:
+			line = rng.choice(LUA_LINES)
+			lines.append(line)
+			written += len(line) + 1
+		contents = "\n".join(lines) + "\n"
+		filepath = os.path.join(root, *path.split("/"))
+		with open(filepath, "w", newline="\n") as f:
+			f.write(contents)
+		os.utime(filepath, (modified, modified))
+		files.append(path)
+		size += len(contents)
+	return {"Files": files, "Directories": len(directories), "Bytes": size, "MaxDepth": max(depth for (_, depth) in directories)}
+
+def loadOrGenerateTree(workdir, fileCount):
+	"""
+	Reuses a tree generated by an earlier run if there is one.
+	"""
+	root = os.path.join(workdir, "tree{}".format(fileCount))
+	manifestPath = os.path.join(workdir, "tree{}.json".format(fileCount))
+	try:
+		with open(manifestPath, "r") as f:
+			manifest = json.loads(f.read())
+		if manifest.get("Seed") == SEED and os.path.isdir(root):
+			return (root, manifest, 0)
+	except (FileNotFoundError, ValueError):
+		pass
+	shutil.rmtree(root, ignore_errors=True)
+	start = time.perf_counter()
+	manifest = generateTree(root, fileCount)
+	manifest["Seed"] = SEED
+	with open(manifestPath, "w") as f:
+		f.write(json.dumps(manifest))
+	return (root, manifest, time.perf_counter() - start)
+
+##############################
+# Clients
+##############################
+
+class Client:
+	"""
+	A simulated plugin: one persistent connection to the server.
+	"""
+	def __init__(self, port):
+		self._Connection = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+
+	def send(self, body):
+		self._Connection.request("POST", "/", body.encode() if isinstance(body, str) else body)
+		response = self._Connection.getresponse()
+		data = response.read()
+		if response.status != 200:
+			raise RuntimeError("{} failed with HTTP {}: {}".format(body[:40], response.status, data[:200]))
+		return data.decode()
+
+	def close(self):
+		self._Connection.close()
+
+def runClients(port, count, work):
+	"""
+	Runs work(client, index) on count clients at once.
+	:return: the list of what each call returned.
+	"""
+	clients = [Client(port) for i in range(count)]
+	try:
+		with concurrent.futures.ThreadPoolExecutor(count) as pool:
+			return list(pool.map(work, clients, range(count)))
+	finally:
+		for client in clients:
+			client.close()
+
+def summarize(samples):
+	samples = sorted(samples)
+	if not samples:
+		return {"Count": 0}
+	return {
+		"Count": len(samples),
+		"Mean": statistics.mean(samples),
+		"Median": statistics.median(samples),
+		"P99": samples[max(0, math.ceil(len(samples) * .99) - 1)],
+		"Max": samples[-1],
+	}
+
+##############################
+# Measurements
+##############################
+
+def measureParse(port, clients):
+	def parse(client, i):
+		start = time.perf_counter()
+		lines = client.send("parse\n\n0\nTrue").count("\n")
+		return (time.perf_counter() - start, lines)
+	results = {}
+	for name in ("ParseCold", "ParseWarm"):
+		(seconds, lines) = runClients(port, 1, parse)[0]
+		results[name] = {"Seconds": seconds, "Files": lines}
+	results["ParseConcurrent"] = summarize([seconds for (seconds, lines) in runClients(port, clients, parse)])
+	return results
+
+def measureBulk(port, clients, files, root):
+	def batches(i):
+		share = files[i::clients]
+		return [share[j:j + BATCH_SIZE] for j in range(0, len(share), BATCH_SIZE)]
+	def read(client, i):
+		size = 0
+		for batch in batches(i):
+			size += len(client.send("read_many\n" + "\n".join(batch)).encode())
+		return size
+	def write(client, i):
+		size = 0
+		for batch in batches(i):
+			frames = []
+			for path in batch:
+				with open(os.path.join(root, *path.split("/")), "rb") as f:
+					contents = f.read()
+				frames.append(b"%s\n%d\n%s" % (path.encode(), len(contents), contents))
+			payload = b"write_many\n" + b"".join(frames)
+			size += len(payload)
+			results = client.send(payload)
+			if "\nerror\n" in results:
+				raise RuntimeError("write_many failed: {}".format(results[:200]))
+		return size
+	results = {}
+	for (name, work) in (("ReadMany", read), ("WriteMany", write)):
+		start = time.perf_counter()
+		size = sum(runClients(port, clients, work))
+		seconds = time.perf_counter() - start
+		results[name] = {"Seconds": seconds, "Bytes": size, "FilesPerSecond": len(files) / seconds, "MiBPerSecond": size / seconds / 2**20}
+	return results
+
+def measureWatchLatency(port, clients, files, root):
+	"""
+	Every client long polls (with watch_poll_batch) while files are written one after another.
+	"""
+	rng = random.Random(SEED)
+	targets = rng.sample(files, min(WATCH_EVENTS, len(files)))
+	written = {}  # A map of path --> time it was written.
+	done = threading.Event()
+	def watch(client, i):
+		id = int(client.send("watch_start\n"))
+		seen = {}  # A map of path --> time this client heard about it.
+		try:
+			ready.wait()
+			while not done.is_set() and len(seen) < len(targets):
+				for line in client.send("watch_poll_batch\n{}\n0".format(id)).split("\n"):
+					if line.count("'") >= 2:
+						path = line.split("'")[1]
+						seen.setdefault(path, time.perf_counter())
+		finally:
+			client.send("watch_stop\n{}".format(id))
+		return seen
+	ready = threading.Barrier(clients + 1)
+	with concurrent.futures.ThreadPoolExecutor(1) as pool:
+		future = pool.submit(runClients, port, clients, watch)
+		ready.wait()
+		time.sleep(.5)  # Let every client's first poll reach the server.
+		for path in targets:
+			with open(os.path.join(root, *path.split("/")), "a") as f:
+				f.write("-- touched\n")
+			written[path] = time.perf_counter()
+			time.sleep(WATCH_INTERVAL)
+		# Give the last changes time to settle & arrive.
+		deadline = time.perf_counter() + 10
+		while not future.done() and time.perf_counter() < deadline:
+			time.sleep(.1)
+		done.set()
+		# Any poll still waiting returns within POLL_TIMEOUT; touching a file wakes them sooner.
+		with open(os.path.join(root, *targets[0].split("/")), "a") as f:
+			f.write("-- touched\n")
+		seen = future.result()
+	latencies = [heard[path] - written[path] for heard in seen for path in targets if path in heard]
+	result = summarize(latencies)
+	result["Clients"] = clients
+	result["Missed"] = clients * len(targets) - len(latencies)
+	return result
+
+def benchmarkTree(args, fileCount, port):
+	(root, manifest, generateSeconds) = loadOrGenerateTree(args.workdir, fileCount)
+	logger.warning("Benchmarking a tree of {} scripts in {} directories ({:.1f} MiB)", fileCount, manifest["Directories"], manifest["Bytes"] / 2**20)
+	result = {
+		"Files": fileCount,
+		"Directories": manifest["Directories"],
+		"Bytes": manifest["Bytes"],
+		"MaxDepth": manifest["MaxDepth"],
+		"GenerateSeconds": generateSeconds,
+	}
+	# Start from an empty hash index so the first parse is cold.
+	indexPath = os.path.join(args.workdir, "hashindex{}.json".format(fileCount))
+	if os.path.exists(indexPath):
+		os.remove(indexPath)
+	validator = commandhandler.create_command_handler(root, indexPath)
+	if args.server == "async":
+		import asyncserver
+		webman = asyncserver.AsyncHttpServer(validator, port)
+	else:
+		webman = server.HttpServer(validator, port)
+	webman.start()
+	try:
+		result.update(measureParse(port, args.clients))
+		result.update(measureBulk(port, args.clients, manifest["Files"], root))
+		result["WatchLatency"] = measureWatchLatency(port, args.clients, manifest["Files"], root)
+	finally:
+		webman.kill()
+	return result
+
+##############################
+# Reporting
+##############################
+
+# (path into a tree's results, label) of the numbers which are compared between runs. Lower is better for all.
+COMPARED = [
+	(("ParseCold", "Seconds"), "cold parse (s)"),
+	(("ParseWarm", "Seconds"), "warm parse (s)"),
+	(("ParseConcurrent", "Median"), "concurrent parse, median (s)"),
+	(("ReadMany", "Seconds"), "read_many (s)"),
+	(("WriteMany", "Seconds"), "write_many (s)"),
+	(("WatchLatency", "Median"), "watch latency, median (s)"),
+	(("WatchLatency", "P99"), "watch latency, p99 (s)"),
+]
+
+def lookup(result, path):
+	for key in path:
+		if not isinstance(result, dict) or key not in result:
+			return None
+		result = result[key]
+	return result
+
+def report(results, previous = None):
+	for (size, result) in results["Trees"].items():
+		print("{} scripts:".format(size))
+		old = lookup(previous, ("Trees", size)) if previous else None
+		for (path, label) in COMPARED:
+			value = lookup(result, path)
+			if value is None:
+				continue
+			line = "  {:<28} {:10.4f}".format(label, value)
+			before = lookup(old, path) if old else None
+			if before:
+				line += "   was {:10.4f} ({:+.1f}%)".format(before, (value - before) / before * 100)
+			print(line)
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="the number of scripts in each tree.")
+	parser.add_argument("--clients", type=int, default=4, help="the number of simulated clients.")
+	parser.add_argument("--server", choices=["threaded", "async"], default="threaded", help="which server to benchmark.")
+	parser.add_argument("--port", type=int, default=6051, help="the port to run the benchmarked server on.")
+	parser.add_argument("--output", default="benchmark-results.json", help="the JSON file to write the results to.")
+	parser.add_argument("--compare", help="a JSON file from an earlier run to compare against.")
+	parser.add_argument("--workdir", help="where the trees are generated; trees here from an earlier run are reused. Defaults to a temporary directory.")
+	parser.add_argument("--log-level", default="warning", help="the server's log level; logging every request slows it down.")
+	args = parser.parse_args()
+
+	logger.setLevel(args.log_level.upper())
+	if args.workdir is None:
+		temporary = tempfile.TemporaryDirectory()
+		args.workdir = temporary.name
+		# The hash indexes are saved at exit, so the directory they're in mustn't go away before then. atexit
+		# functions run last in, first out, so this runs after they're saved.
+		atexit.register(temporary.cleanup)
+	results = {
+		"Meta": {
+			"Time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+			"Python": platform.python_version(),
+			"Platform": platform.platform(),
+			"CPUs": os.cpu_count(),
+			"Server": args.server,
+			"Clients": args.clients,
+			"Seed": SEED,
+		},
+		"Trees": {},
+	}
+	for size in args.sizes:
+		results["Trees"][str(size)] = benchmarkTree(args, size, args.port)
+	with open(args.output, "w") as f:
+		f.write(json.dumps(results, indent="\t"))
+	previous = None
+	if args.compare:
+		with open(args.compare, "r") as f:
+			previous = json.loads(f.read())
+	report(results, previous)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,66 @@
+"""
+Measures the per-request latency of many small reads sent back to back, both over a new connection per request
+(as HTTP/1.0 clients do) and over one persistent connection.
+
+Usage (from the server directory):
+	python benchmarks/keepalive.py [--requests N] [--port PORT]
+"""
+
+import argparse
+import http.client
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+import commandhandler
+import server
+
+def timeRequests(port, count, persistent):
+	"""
+	:return: a list of the latency (in seconds) of each request.
+	"""
+	latencies = []
+	cxn = http.client.HTTPConnection("127.0.0.1", port)
+	try:
+		for i in range(count):
+			if not persistent:
+				cxn.close()
+			start = time.perf_counter()
+			cxn.request("POST", "/", "read\nfile1.txt", {} if persistent else {"Connection": "close"})
+			response = cxn.getresponse()
+			response.read()
+			latencies.append(time.perf_counter() - start)
+	finally:
+		cxn.close()
+	return latencies
+
+def report(name, latencies):
+	latencies = sorted(latencies)
+	print("{:<24} mean {:8.3f} ms   median {:8.3f} ms   p99 {:8.3f} ms".format(
+		name,
+		statistics.mean(latencies) * 1000,
+		statistics.median(latencies) * 1000,
+		latencies[int(len(latencies) * .99) - 1] * 1000))
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument("--requests", type=int, default=2000, help="the number of reads to time for each mode.")
+	parser.add_argument("--port", type=int, default=6050, help="the port to run the benchmarked server on.")
+	args = parser.parse_args()
+
+	root = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "testdir"))
+	webman = server.HttpServer(commandhandler.create_command_handler(root), args.port, maxRequestsPerConnection=args.requests + 1)
+	webman.start()
+	try:
+		# Warm up (e.g., the hash index & the OS's caches) before timing anything.
+		timeRequests(args.port, 50, True)
+		report("connection per request", timeRequests(args.port, args.requests, False))
+		report("persistent connection", timeRequests(args.port, args.requests, True))
+	finally:
+		webman.kill()
+
+if __name__ == "__main__":
+	main()
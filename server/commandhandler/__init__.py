@@ -8,27 +8,66 @@ The individual command handlers are children of this module.
 commandhandler.py contains the common logic for all commands (type validation, etc.) and debugging help.
 """
 
+import os
 from . import commandvalidator as _commandhandler
 
 HttpException = _commandhandler.HttpException
 CommandValidator = _commandhandler.CommandValidator
 
-def create_command_handler(rootPath):
+WATCHER_LINGER_TIME = 10 * 60  # How long (in seconds) a directory is still watched after its last session ends.
+# Where the server persists its index of file hashes, unless it's told otherwise.
+DEFAULT_HASH_INDEX_PATH = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "hashindex.json"))
+
+def create_command_handler(rootPath, hashIndexPath = None, hashWorkers = None, ioWorkers = None, syncWrites = False, writeBehind = False):
 	"""
 	Creates a command handler by importing commands.json & registering all child handlers.
+	:param rootPath: the directory which all file paths are relative to.
+	:param hashIndexPath: where the index of file hashes is persisted (e.g., DEFAULT_HASH_INDEX_PATH). If None, the
+		index only lives in memory.
+	:param hashWorkers: the number of threads parse hashes files with; defaults to the number of CPUs.
+	:param ioWorkers: the number of threads read_many/write_many use; defaults to doing I/O on the request's thread.
+	:param syncWrites: whether writes are made durable (fsynced) before they're acknowledged.
+	:param writeBehind: whether writes are acknowledged once queued & made in the background; see the flush command.
 	"""
 	import json
-	import os
 	commands_file = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir, "generic", "commands.json"))
 	with open(commands_file, "r") as f:
 		commands = json.loads(f.read())
 	validator = CommandValidator(commands, rootPath)
 
+	from . import hashindex
+	index = hashindex.HashIndex(hashIndexPath)
+	index.registerMetrics(validator.metrics)
+	import atexit
+	atexit.register(index.save)
+
+	from . import ignore
+	ignoreFile = ignore.IgnoreFile(rootPath)
+
+	import filewatch
+	# Every handler shares the watchers, which keep the hash index up to date. A watcher outlives its last
+	# session for a while so that parse_since can still tell a reconnecting client what changed. Hidden &
+	# ignored directories are never watched: a .git or node_modules can hold more directories than inotify allows.
+	watchers = filewatch.WatcherPool([index], ignore.IgnoreFilter(rootPath, ignoreFile), lingerTime=WATCHER_LINGER_TIME)
+	validator.metrics.gauge("syncytowne_watchers", "Directory trees being watched.", function=lambda: len(watchers))
+	from . import echo
+	echoes = echo.EchoSuppressor()
+	validator.metrics.counter("syncytowne_echoes_suppressed_total", "File changes kept from the sessions which made them.", function=lambda: echoes.Suppressed)
+
+	from . import blobstore
+	blobs = blobstore.BlobStore()
+	blobs.registerMetrics(validator.metrics)
+
 	from . import readwritehandler
-	validator.register(readwritehandler.RWCommandHandler())
+	readWriteHandler = readwritehandler.RWCommandHandler(index, rootPath, ioWorkers, syncWrites, writeBehind, echoes, blobs)
+	# Registered after index.save, so it runs first & the index hears about every queued write before it's saved.
+	atexit.register(readWriteHandler.close)
+	validator.register(readWriteHandler)
 	from . import hashhandler
-	validator.register(hashhandler.HashCommandHandler(rootPath))
+	validator.register(hashhandler.HashCommandHandler(rootPath, index, hashWorkers, watchers, ignoreFile))
 	from . import filewatchhandler
-	validator.register(filewatchhandler.FileWatchCommandHandler(rootPath))
+	fileWatchHandler = filewatchhandler.FileWatchCommandHandler(rootPath, index, watchers=watchers, ignoreFile=ignoreFile, echoes=echoes)
+	fileWatchHandler.registerMetrics(validator.metrics)
+	validator.register(fileWatchHandler)
 
 	return validator
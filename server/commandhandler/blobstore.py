@@ -0,0 +1,135 @@
+"""
+A bounded store of recent file contents, keyed by their hash.
+
+Once a client has used deltas, every file the server reads or writes is kept here for a while, so that when a
+client next asks for the file (or sends it back) with a small change, only a delta against the version it already
+has needs to be sent; see delta.py. Line endings are made "\n" before contents are stored, as they are when hashing.
+"""
+
+import collections
+import threading
+import unittest
+import commandhandler.helpers as helpers
+
+class BlobStore:
+	"""
+	The least recently used contents are dropped once the store grows past MaxBytes.
+	"""
+	MaxBytes = 64 * 1024 * 1024  # The most characters of contents kept in all.
+	MaxBlobBytes = 4 * 1024 * 1024  # Contents longer than this (in characters, or bytes if undecoded) aren't kept at all.
+
+	def __init__(self, maxBytes = None):
+		if maxBytes is not None:
+			self.MaxBytes = maxBytes
+		self._Blobs = collections.OrderedDict()  # A map of (algorithm, hash) --> contents, least recently used first.
+		self._Bytes = 0
+		self._Lock = threading.Lock()
+		self.Hits = 0
+		self.Misses = 0
+
+	@staticmethod
+	def usable(algorithm = None):
+		"""
+		Checks whether contents can be told apart by their hash. Only a "length" hash can't; with it, two versions
+		of a file are all too likely to have the same hash.
+		:param algorithm: the hash algorithm; defaults to helpers.CurrentHashAlgorithm().
+		"""
+		return (algorithm or helpers.CurrentHashAlgorithm()) != "length"
+
+	@staticmethod
+	def normalize(contents):
+		"""
+		:return: the contents as they're stored: a string with "\n" line endings.
+		"""
+		if not isinstance(contents, str):
+			contents = bytes(contents).decode()
+		return contents.replace("\r\n", "\n")
+
+	def put(self, contents):
+		"""
+		Remembers a version of a file. Contents which won't be kept aren't decoded or hashed.
+		:param contents: a string or UTF-8 encoded bytes-like object.
+		:return: the hash of the contents, or None if they weren't kept.
+		:raise UnicodeDecodeError: if the contents aren't text.
+		"""
+		algorithm = helpers.CurrentHashAlgorithm()
+		if not self.usable(algorithm) or len(contents) > self.MaxBlobBytes:
+			return None
+		contents = self.normalize(contents)
+		hash = helpers.Hash(contents, algorithm)
+		key = (algorithm, hash)
+		with self._Lock:
+			previous = self._Blobs.pop(key, None)
+			if previous is not None:
+				self._Bytes -= len(previous)
+			self._Blobs[key] = contents
+			self._Bytes += len(contents)
+			while self._Bytes > self.MaxBytes:
+				(oldest, blob) = self._Blobs.popitem(last=False)
+				self._Bytes -= len(blob)
+		return hash
+
+	def get(self, hash):
+		"""
+		:return: the contents with a hash (in the current request's algorithm), or None if they aren't in the store.
+		"""
+		key = (helpers.CurrentHashAlgorithm(), hash)
+		with self._Lock:
+			contents = self._Blobs.get(key)
+			if contents is None:
+				self.Misses += 1
+				return None
+			self._Blobs.move_to_end(key)
+			self.Hits += 1
+			return contents
+
+	def __len__(self):
+		return len(self._Blobs)
+
+	def registerMetrics(self, registry):
+		"""
+		Exposes the store's hit rate & size through a metrics.Registry.
+		"""
+		registry.counter("syncytowne_blob_hits_total", "Delta bases found in the blob store.", function=lambda: self.Hits)
+		registry.counter("syncytowne_blob_misses_total", "Delta bases missing from the blob store.", function=lambda: self.Misses)
+		registry.gauge("syncytowne_blob_bytes", "Characters of contents in the blob store.", function=lambda: self._Bytes)
+
+class BlobStoreTestCase(unittest.TestCase):
+	def setUp(self):
+		algorithm = helpers.HashAlgorithm("crc32")
+		algorithm.__enter__()
+		self.addCleanup(algorithm.__exit__, None, None, None)
+
+	def test_put_get(self):
+		store = BlobStore()
+		hash = store.put(b"a\r\nb")
+		self.assertEqual(hash, helpers.Hash("a\nb"))
+		self.assertEqual(store.get(hash), "a\nb")
+		self.assertIsNone(store.get("0"))
+		self.assertRaises(UnicodeDecodeError, store.put, b"\xff")
+		# A client using another algorithm doesn't see it.
+		with helpers.HashAlgorithm("blake2b"):
+			self.assertIsNone(store.get(hash))
+
+	def test_eviction(self):
+		store = BlobStore(8)
+		(a, b) = (store.put("aaaa"), store.put("bbbb"))
+		store.get(a)
+		store.put("cccc")
+		# b was the least recently used.
+		self.assertEqual((store.get(a), store.get(b)), ("aaaa", None))
+		store.put("d" * 9)
+		self.assertEqual(len(store), 0)
+
+	def test_length_is_unusable(self):
+		store = BlobStore()
+		with helpers.HashAlgorithm("length"):
+			self.assertIsNone(store.put("abc"))
+			self.assertIsNone(store.get("3"))
+
+	def test_too_big(self):
+		store = BlobStore()
+		store.MaxBlobBytes = 3
+		self.assertIsNone(store.put(b"abcd"))
+		self.assertIsNotNone(store.put(b"abc"))
+		self.assertEqual(len(store), 1)
@@ -1,8 +1,16 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import inspect
 import json
 import os
+import time
 import unittest
 import logging
+import metrics
 from logger import logger
+from .helpers import Cacheable, Cancelled
 
 class HttpException(Exception):
 	def __init__(self, code, msg = None, explanation = None):
@@ -85,63 +93,165 @@ OUTGOING_TYPE_VALIDATORS = {
 }
 
 class CommandValidator:
+	"""
+	Parses requests & builds responses for the commands defined in commands.json.
+
+	Every command is compiled once, when the CommandValidator is created, into a closure which parses its arguments &
+	one which builds its response, so handling a request does no more than it must.
+	"""
+	def _generateArgumentParser(self, command):
+		name = command.get("Name")
+		# (name, type, validator, whether it takes the rest of the request) for each argument.
+		incoming = []
+		for arg in command.get("Arguments") or []:
+			type = arg.get("Type")
+			validator = INCOMING_TYPE_VALIDATORS.get(type)
+			if validator is None:
+				logger.error("Type {} of {}.{} has no incoming type validator", type, name, arg.get("Name"))
+				validator = self._Unsupported
+			elif type in self.additional_args:
+				validator = functools.partial(self._ValidateWithArgs, validator, self.additional_args[type])
+			incoming.append((arg.get("Name"), type, validator, type == "*"))
+		incoming = tuple(incoming)
+		def parseArguments(cmd, position):
+			"""
+			Parses & validates the arguments of a request.
+			:param cmd: the request, as bytes.
+			:param position: the index in cmd the arguments start at.
+			:return: the list of arguments.
+			"""
+			arguments = []
+			lines = [] if logger.isEnabledFor(logging.INFO) else None
+			for (argName, type, validator, rest) in incoming:
+				if rest:
+					line = memoryview(cmd)[min(position, len(cmd)):]
+					position = len(cmd) + 1
+				else:
+					(line, position) = self._ReadLine(cmd, position)
+				if lines is not None:
+					lines.append(line)
+				try:
+					arguments.append(validator(line))
+				except HttpException:
+					raise
+				except Exception as e:
+					raise HttpException(400, None, "Bad argument {} ({}, type {})\n{}: {}".format(line, argName, type, e.__class__.__name__, str(e)))
+			if lines is not None:
+				logger.info("received command '{}': {}", name, self._DescribeArguments(incoming, lines))
+			return arguments
+		return parseArguments
+
+	@staticmethod
+	def _ValidateWithArgs(validator, additionalArgs, value):
+		return validator(value, *additionalArgs)
+
+	@staticmethod
+	def _Unsupported(value):
+		raise HttpException(500, "Internal error")
+
+	@staticmethod
+	def _DescribeArguments(definitions, lines):
+		debugString = []
+		for ((argName, type, validator, rest), line) in zip(definitions, lines):
+			if not rest:
+				debugString.append("{}: {}".format(argName, line))
+			elif len(line) < 30:
+				debugString.append("{}: {}".format(argName, bytes(line)))
+			else:
+				debugString.append("{}: payload of {} bytes".format(argName, len(line)))
+		return ", ".join(debugString)
+
 	def _generateResponseStringBuilder(self, command):
 		name = command.get("Name")
-		self.commands[name] = command
-		args = command.get("Arguments")
 		responseArgs = command.get("ResponseArguments")
+		# (name, type, validator) for each response argument.
+		outgoing = []
+		for arg in responseArgs:
+			type = arg["Type"]
+			validator = OUTGOING_TYPE_VALIDATORS.get(type)
+			if validator is None:
+				logger.error("Type {} of {}.{} has no outgoing type validator", type, name, arg["Name"])
+				validator = self._Unsupported
+			outgoing.append((arg["Name"], type, validator))
+		outgoing = tuple(outgoing)
+		expected_args = frozenset(arg["Name"] for arg in responseArgs)
 		def createResponseString(**kwargs):
 			"""
 			Validates that all outgoing parameters are correct & present,
 			then sends it out over HTTP.
-			"""
-			debugString = []
 
+			A "*" argument may be given as an iterator of strings rather than a string, in which case the
+			response is returned as an iterator of strings, too.
+			"""
 			try:
 				# Verify every argument is present.
-				expected_args = dict((arg["Name"], True) for arg in responseArgs)
-				for key in kwargs:
-					if key in expected_args:
-						del expected_args[key]
-					else:
+				if kwargs.keys() != expected_args:
+					for key in kwargs.keys() - expected_args:
 						logger.error("Unexpected argument: {}", key)
-						raise HttpException(500, "Internal error")
-				if expected_args:
-					logger.error("Missing arguments to response; expected {}, got {}", responseArgs, kwargs)
+					if expected_args - kwargs.keys():
+						logger.error("Missing arguments to response; expected {}, got {}", responseArgs, kwargs)
 					raise HttpException(500, "Internal error")
 
 				# verify individual responseArgs (that is, types match)
 				# We do this simultaneous to converting to strings (the OUTGOING_TYPE_VALIDATORS should raise exceptions if the types are wrong).
 				response = []
-				for outgoingArgDef in responseArgs:
-					key = outgoingArgDef["Name"]
-					type = outgoingArgDef["Type"]
+				for (key, type, validator) in outgoing:
 					value = kwargs[key]
+					if type == "*" and not isinstance(value, str):
+						# The handler is streaming this argument; it's the last one, so the response is
+						# everything so far followed by whatever the handler generates.
+						if logger.isEnabledFor(logging.INFO):
+							logger.info("sending response '{}': {}", name, self._DescribeResponse(outgoing, response, key))
+						stream = self._StreamResponse(response, validator, value)
+						key = getattr(value, "CacheKey", None)
+						return stream if key is None else Cacheable(stream, (name, tuple(response), key))
 					try:
-						validator = OUTGOING_TYPE_VALIDATORS[type]
-					except Exception as e:
-						logger.error("Type {} has no outgoing type validator", type)
-						raise HttpException(500, "Internal error")
-					try:
-						asString = validator(value)
+						response.append(validator(value))
+					except HttpException:
+						raise
 					except Exception as e:
 						logger.error("Could not convert {} to output string of type {}", value, type)
 						logger.error("{}: {}", e.__class__.__name__, str(e))
 						raise HttpException(500, "Internal error")
-					response.append(asString)
-					if type != "*" or len(asString) < 30:
-						debugString.append("{}: '{}'".format(key, asString))
-					else:
-						debugString.append("{}: string of length {}".format(key, len(asString)))
 
-				logger.info("sending response '{}': {}", name, ", ".join(debugString))
+				if logger.isEnabledFor(logging.INFO):
+					logger.info("sending response '{}': {}", name, self._DescribeResponse(outgoing, response))
 				# build the response string & return the response.
 				return "\n".join(response)
 			except:
-				logger.info("sending response '{}': error")
+				logger.info("sending response '{}': error", name)
 				raise
 		return createResponseString
 
+	@staticmethod
+	def _DescribeResponse(definitions, response, streamed = None):
+		debugString = []
+		for ((key, type, validator), asString) in zip(definitions, response):
+			if type != "*" or len(asString) < 30:
+				debugString.append("{}: '{}'".format(key, asString))
+			else:
+				debugString.append("{}: string of length {}".format(key, len(asString)))
+		if streamed is not None:
+			debugString.append("{}: stream".format(streamed))
+		return ", ".join(debugString)
+
+	@staticmethod
+	def _StreamResponse(leadingArgs, validator, pieces):
+		"""
+		Generates a response whose final argument is streamed.
+		:param leadingArgs: the string forms of every argument before the streamed one.
+		:param validator: the outgoing type validator for the streamed argument.
+		:param pieces: an iterator of strings which make up the streamed argument.
+		"""
+		try:
+			if leadingArgs:
+				yield "\n".join(leadingArgs) + "\n"
+			for piece in pieces:
+				yield validator(piece)
+		finally:
+			if hasattr(pieces, "close"):
+				pieces.close()
+
 	def __init__(self, json, root):
 		self.additional_args = {
 			"FilePath": [root],
@@ -149,9 +259,17 @@ class CommandValidator:
 		}
 		self.commands = {}  # A map of command name --> JSON command details
 		self.handlers = {}  # A map of command name --> callable to handle the command.
+		self.async_handlers = {}  # A map of command name --> coroutine function to handle the command on an event loop.
+		self.parsers = {}  # A map of command name --> callable to parse the command's arguments.
 		self.callbacks = {}  # A map of command name --> callable to create the response string.
+		self.metrics = metrics.Registry()  # The metrics of everything this validator (& its handlers) does.
+		self._RequestCount = self.metrics.counter("syncytowne_requests_total", "Commands handled, by status code.", ("command", "code"))
+		self._RequestLatency = self.metrics.histogram("syncytowne_request_duration_seconds",
+			"How long handlers took to respond (not counting the time to stream a response).", ("command",))
 		for command in json.get("Commands"):
 			name = command.get("Name")
+			self.commands[name] = command
+			self.parsers[name] = self._generateArgumentParser(command)
 			self.callbacks[name] = self._generateResponseStringBuilder(command)
 
 	def _has_proper_arguments(self, sig, cmd):
@@ -180,7 +298,13 @@ class CommandValidator:
 		import inspect
 		logger.debug("registering handler {}", handler)
 		for (key, value) in inspect.getmembers(handler):
-			if key in self.commands:
+			if key.endswith("_async") and key[:-len("_async")] in self.commands and inspect.iscoroutinefunction(value):
+				name = key[:-len("_async")]
+				if self._has_proper_arguments(inspect.signature(value), self.commands[name]):
+					self.async_handlers[name] = value
+				else:
+					logger.error("Handler {}.{} cannot be registered", handler, key)
+			elif key in self.commands:
 				if key not in self.handlers:
 					# ensure it takes the correct number of arguments.
 					if self._has_proper_arguments(inspect.signature(value), self.commands[key]):
@@ -193,56 +317,146 @@ class CommandValidator:
 				pass  # finding methods that don't match any commands is very common.
 
 	def handle(self, cmd):
-		# the first line contains the command.
-		lines = cmd.split("\n")
-		command = lines[0]
-		commandDefinition = self.commands.get(command)
-		if not commandDefinition:
-			raise HttpException(400, None, "Command {} is invalid".format(command))
-		# Loop through the arguments. Any with type "*" means consume a multi-line string. Other types should go through their handlers.
-		argumentsDefinition = commandDefinition.get("Arguments")
-		arguments = []
-		debugString = []
-		if argumentsDefinition:
-			i = 1
-			for arg in argumentsDefinition:
-				name = arg.get("Name")
-				type = arg.get("Type")
-				if type == "*":
-					line = "\n".join(lines[i:])
-					if len(line) < 30:
-						debugString.append("{}: {}".format(name, line))
-					else:
-						debugString.append("{}: string of length {}".format(name, len(line)))
-					i = len(lines)
-				else:
-					line = lines[i]
-					debugString.append("{}: {}".format(name, line))
-					i = i + 1
-				try:
-					arguments.append(INCOMING_TYPE_VALIDATORS[type](line, *self.additional_args.get(type, [])))
-				except HttpException as e:
-					raise
-				except Exception as e:
-					raise HttpException(400, None, "Bad argument {} ({}, type {})\n{}: {}".format(lines[i], name, type, e.__class__.__name__, str(e)))
-		logger.info("received command '{}': {}".format(command, ", ".join(debugString)))
+		"""
+		Handles a command & returns the response as a string.
+		"""
+		response = self.handle_streaming(cmd)
+		if isinstance(response, str):
+			return response
 		try:
-			handler = self.handlers.get(command)
-			if handler:
-				response = handler(*arguments)
-				try:
-					args = dict(**response)
-				except TypeError as e:
-					logger.error("Handler {} must return dictionary", command)
-					raise HttpException(500, "Internal error")
-				return self.callbacks[command](**args)
-			else:
-				raise HttpException(400, None, "Handler for {} not registered".format(command))
-		except HttpException:
+			return "".join(response)
+		except (HttpException, Cancelled):
 			raise
 		except Exception as e:
 			raise HttpException(400, None, "Error during handler:\n{}: {}".format(e.__class__.__name__, str(e)))
 
+	def handle_streaming(self, cmd):
+		"""
+		Handles a command. The response is either a string or, if the handler streams its result, an
+		iterator of strings. Any exception raised while iterating happens after the command has been
+		accepted, so it can't be turned into an HTTP error.
+		"""
+		with self._Measure() as measurement:
+			(command, arguments) = self._ParseCommand(cmd)
+			measurement.Command = command
+			try:
+				handler = self.handlers.get(command)
+				if handler:
+					return self._CreateResponse(command, handler(*self._PreparePayload(handler, arguments)))
+				else:
+					raise HttpException(400, None, "Handler for {} not registered".format(command))
+			except (HttpException, Cancelled):
+				raise
+			except Exception as e:
+				raise HttpException(400, None, "Error during handler:\n{}: {}".format(e.__class__.__name__, str(e)))
+
+	async def handle_async(self, cmd):
+		"""
+		Like handle_streaming, but for use on an asyncio event loop. A handler with an async variant (a
+		coroutine method named <command>_async) is awaited on the loop; any other handler may block, so it is
+		run on the loop's default executor. A streamed response should likewise be iterated off the loop.
+		"""
+		with self._Measure() as measurement:
+			(command, arguments) = self._ParseCommand(cmd)
+			measurement.Command = command
+			try:
+				asyncHandler = self.async_handlers.get(command)
+				handler = self.handlers.get(command)
+				if asyncHandler:
+					response = await asyncHandler(*self._PreparePayload(asyncHandler, arguments))
+				elif handler:
+					arguments = self._PreparePayload(handler, arguments)
+					# Run the handler with our context so it sees the request's cancellation token.
+					context = contextvars.copy_context()
+					response = await asyncio.get_running_loop().run_in_executor(None, functools.partial(context.run, handler, *arguments))
+				else:
+					raise HttpException(400, None, "Handler for {} not registered".format(command))
+				return self._CreateResponse(command, response)
+			except (HttpException, Cancelled, asyncio.CancelledError):
+				raise
+			except Exception as e:
+				raise HttpException(400, None, "Error during handler:\n{}: {}".format(e.__class__.__name__, str(e)))
+
+	class _Measurement:
+		Command = None
+
+	@contextlib.contextmanager
+	def _Measure(self):
+		"""
+		Records the outcome & latency of handling a request. The caller sets the Command of the measurement it's
+		given once it knows which command the request is for.
+		"""
+		measurement = self._Measurement()
+		start = time.perf_counter()
+		code = 200
+		try:
+			yield measurement
+		except HttpException as e:
+			code = e.code
+			raise
+		except (Cancelled, asyncio.CancelledError):
+			code = 499  # The client went away.
+			raise
+		except BaseException:
+			code = 500
+			raise
+		finally:
+			# Don't let garbage requests create metrics for commands which don't exist.
+			command = measurement.Command if measurement.Command in self.commands else "unknown"
+			self._RequestCount.inc(command, code)
+			self._RequestLatency.observe(time.perf_counter() - start, command)
+
+	def _ParseCommand(self, cmd):
+		"""
+		Splits a request into its command & validated arguments. Only the lines which hold arguments are decoded;
+		a "*" argument is left as a memoryview of the request.
+		:param cmd: the request, as a string or bytes.
+		:return: (command name, list of arguments)
+		"""
+		if isinstance(cmd, str):
+			cmd = cmd.encode()
+		# the first line contains the command.
+		(command, position) = self._ReadLine(cmd, 0)
+		parser = self.parsers.get(command)
+		if parser is None:
+			raise HttpException(400, None, "Command {} is invalid".format(command))
+		return (command, parser(cmd, position))
+
+	@staticmethod
+	def _ReadLine(cmd, position):
+		"""
+		:return: (the line of cmd starting at position, the position of the next line)
+		"""
+		if position > len(cmd):
+			raise HttpException(400, None, "Missing argument")
+		end = cmd.find(b"\n", position)
+		if end == -1:
+			end = len(cmd)
+		try:
+			return (cmd[position:end].decode(), end + 1)
+		except UnicodeDecodeError as e:
+			raise HttpException(400, None, "Request isn't valid UTF-8: {}".format(e))
+
+	@staticmethod
+	def _PreparePayload(handler, arguments):
+		"""
+		Decodes a "*" argument unless the handler takes it raw; see helpers.RawPayload.
+		"""
+		if arguments and isinstance(arguments[-1], memoryview) and not getattr(handler, "RawPayload", False):
+			try:
+				return arguments[:-1] + [str(arguments[-1], "utf-8")]
+			except UnicodeDecodeError as e:
+				raise HttpException(400, None, "Payload isn't valid UTF-8: {}".format(e))
+		return arguments
+
+	def _CreateResponse(self, command, response):
+		try:
+			args = dict(**response)
+		except TypeError as e:
+			logger.error("Handler {} must return dictionary", command)
+			raise HttpException(500, "Internal error")
+		return self.callbacks[command](**args)
+
 
 class CommandHandlerTest(unittest.TestCase):
 
@@ -259,3 +473,21 @@ class CommandHandlerTest(unittest.TestCase):
 		self.assertEqual("", validator.handle("write\nfile1.txt\nfoobar"))
 		self.assertEqual("foobar", validator.handle("read\nfile1.txt"))
 
+
+	def test_response_arguments_are_checked(self):
+		validator = CommandValidator({"Commands": [{
+			"Name": "echo",
+			"Arguments": [{"Name": "Count", "Type": "Number"}, {"Name": "Text", "Type": "*"}],
+			"ResponseArguments": [{"Name": "Count", "Type": "Number"}, {"Name": "Text", "Type": "*"}],
+		}]}, ".")
+		class Handler:
+			def echo(self, Count, Text):
+				return {"Count": Count, "Text": Text} if Count else {"Text": Text}
+		validator.register(Handler())
+		self.assertEqual("2\nfoo\nbar", validator.handle("echo\n2\nfoo\nbar"))
+		with self.assertRaises(HttpException) as context:
+			validator.handle("echo\n0\nfoo")
+		self.assertEqual(context.exception.code, 500)
+		with self.assertRaises(HttpException) as context:
+			validator.handle("echo\nfoo\nbar")
+		self.assertEqual(context.exception.code, 400)
@@ -0,0 +1,149 @@
+"""
+Deltas between two versions of a file.
+
+A delta is a series of operations which turn the base version into the new one. They're applied in order,
+from the start of the base:
+	=<n>\n            copy the next n bytes of the base
+	-<n>\n            skip the next n bytes of the base
+	+<n>\n<bytes>     insert n bytes
+Lengths count the bytes of the contents when encoded as UTF-8, and the operations must cover the whole base.
+A small edit to a big file is described by a delta of about the size of the edit, e.g.:
+	=1200\n-1\n+2\nfoo=5000\n
+"""
+
+import difflib
+import re
+import unittest
+
+def _Length(s):
+	return len(s.encode())
+
+def _Common(a, b):
+	"""
+	:return: the number of characters at the start of a & b which are the same.
+	"""
+	n = min(len(a), len(b))
+	i = 0
+	while i < n and a[i] == b[i]:
+		i += 1
+	return i
+
+class _Builder:
+	def __init__(self):
+		self._Parts = []
+		self._Copy = 0
+
+	def copy(self, s):
+		self._Copy += _Length(s)
+
+	def replace(self, old, new):
+		if not old and not new:
+			return
+		if self._Copy:
+			self._Parts.append("={}\n".format(self._Copy))
+			self._Copy = 0
+		if old:
+			self._Parts.append("-{}\n".format(_Length(old)))
+		if new:
+			self._Parts.append("+{}\n{}".format(_Length(new), new))
+
+	def build(self):
+		if self._Copy:
+			self._Parts.append("={}\n".format(self._Copy))
+		return "".join(self._Parts)
+
+def Make(base, contents):
+	"""
+	Describes how a file changed.
+	:param base: the old contents, as a string.
+	:param contents: the new contents, as a string.
+	:return: the delta, as a string.
+	"""
+	builder = _Builder()
+	# Most edits touch a single spot, so the common start & end of the file are split off first...
+	start = _Common(base, contents)
+	end = _Common(base[:start - 1:-1], contents[:start - 1:-1]) if start else _Common(base[::-1], contents[::-1])
+	end = min(end, len(base) - start, len(contents) - start)
+	builder.copy(base[:start])
+	old = base[start:len(base) - end]
+	new = contents[start:len(contents) - end]
+	if "\n" in old and "\n" in new:
+		# ...& whatever is left in between is compared line by line.
+		oldLines = old.splitlines(True)
+		newLines = new.splitlines(True)
+		for (tag, i1, i2, j1, j2) in difflib.SequenceMatcher(None, oldLines, newLines).get_opcodes():
+			if tag == "equal":
+				builder.copy("".join(oldLines[i1:i2]))
+			else:
+				builder.replace("".join(oldLines[i1:i2]), "".join(newLines[j1:j2]))
+	else:
+		builder.replace(old, new)
+	builder.copy(base[len(base) - end:])
+	return builder.build()
+
+_Operation = re.compile(rb"([=+-])(\d+)\n")
+
+def Apply(base, delta):
+	"""
+	Applies a delta.
+	:param base: the contents the delta was made against, as a string.
+	:param delta: the delta, as a string or bytes-like object.
+	:return: the new contents, as a string.
+	:raise ValueError: if the delta is malformed or doesn't fit the base.
+	"""
+	source = base.encode()
+	data = memoryview(delta.encode() if isinstance(delta, str) else delta)
+	parts = []
+	i = 0  # How far into the delta we are...
+	j = 0  # ...& into the base.
+	while i < len(data):
+		operation = _Operation.match(data, i)
+		if operation is None:
+			raise ValueError("Malformed delta operation at byte {}".format(i))
+		(kind, n) = (operation.group(1), int(operation.group(2)))
+		i = operation.end()
+		if kind == b"+":
+			if i + n > len(data):
+				raise ValueError("Delta is truncated")
+			parts.append(data[i:i + n])
+			i += n
+		else:
+			if j + n > len(source):
+				raise ValueError("Delta runs past the end of the base")
+			if kind == b"=":
+				parts.append(source[j:j + n])
+			j += n
+	if j != len(source):
+		raise ValueError("Delta stops {} bytes short of the end of the base".format(len(source) - j))
+	try:
+		return b"".join(parts).decode()
+	except UnicodeDecodeError as e:
+		raise ValueError("Delta doesn't give valid UTF-8: {}".format(e))
+
+class DeltaTestCase(unittest.TestCase):
+	def assertRoundTrip(self, base, contents):
+		delta = Make(base, contents)
+		self.assertEqual(Apply(base, delta), contents)
+		return delta
+
+	def test_small_edit(self):
+		base = "local x = 1\n" * 1000
+		contents = base[:6000] + "été" + base[6001:]
+		self.assertEqual(self.assertRoundTrip(base, contents), "=6000\n-1\n+5\nété=5999\n")
+
+	def test_many_edits(self):
+		base = "".join("line {}\n".format(i) for i in range(100))
+		contents = base.replace("line 10\n", "").replace("line 50\n", "line 50\nnew\n").replace("line 90", "LINE 90")
+		delta = self.assertRoundTrip(base, contents)
+		self.assertLess(len(delta), 100)
+
+	def test_edge_cases(self):
+		for (base, contents) in (("", ""), ("", "new"), ("old", ""), ("same", "same"), ("aaa", "aaaa"), ("abab", "ab"), ("a\nb\n", "b\na\n")):
+			self.assertRoundTrip(base, contents)
+
+	def test_malformed(self):
+		self.assertRaises(ValueError, Apply, "abc", "=2\n")
+		self.assertRaises(ValueError, Apply, "abc", "=4\n")
+		self.assertRaises(ValueError, Apply, "abc", "-3\n+5\nab")
+		self.assertRaises(ValueError, Apply, "abc", "x")
+		self.assertRaises(ValueError, Apply, "é", "=1\n-1\n")
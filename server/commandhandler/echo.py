@@ -0,0 +1,184 @@
+"""
+Keeps clients from being told about their own writes.
+
+A client names its watch session in the X-SyncyTowne-Session header of the requests it sends. When one of those
+requests writes (or deletes) a file, the change is remembered along with the session it came from; once the
+watcher reports the change, it's dropped from that session's polls, but still goes out to every other session.
+"""
+
+import collections
+import os
+import threading
+import time
+import unittest
+import commandhandler.helpers as helpers
+
+def _Signature(info):
+	return (info.st_size, info.st_mtime_ns, info.st_ino)
+
+class _Expected:
+	__slots__ = ("Origin", "Algorithm", "Hash", "Signature", "Time")
+
+	def __init__(self, origin, algorithm, hash, time):
+		self.Origin = origin
+		self.Algorithm = algorithm
+		self.Hash = hash  # None for a delete.
+		self.Signature = None  # The stat signature of the file once it was written.
+		self.Time = time
+
+class EchoSuppressor:
+	"""
+	Remembers the latest change a session made to each file.
+	"""
+	TimeToLive = 5 * 60  # How long (in seconds) to wait for the watcher to report a change.
+	MaxEntries = 20000
+
+	def __init__(self, timeToLive = None, maxEntries = None):
+		if timeToLive is not None:
+			self.TimeToLive = timeToLive
+		if maxEntries is not None:
+			self.MaxEntries = maxEntries
+		self._Expected = collections.OrderedDict()  # A map of absolute path --> _Expected, oldest first.
+		self._Lock = threading.Lock()
+		self.Suppressed = 0  # How many changes were kept from the sessions which made them.
+
+	def expect(self, path, contents, origin):
+		"""
+		Records a change which the current request is about to make.
+		:param path: the absolute path of the file.
+		:param contents: the file's new contents (as a string or bytes-like object), or None if it's being deleted.
+		:param origin: the session the change is on behalf of. If None, nothing is recorded, but any change
+			another session was expecting is forgotten.
+		"""
+		now = time.monotonic()
+		if origin is None:
+			expected = None
+		elif contents is None:
+			expected = _Expected(origin, None, None, now)
+		else:
+			# Hash the bytes which end up on disk, so the hash is the same as the watcher would compute.
+			data = contents.encode() if isinstance(contents, str) else contents
+			algorithm = helpers.CurrentHashAlgorithm()
+			expected = _Expected(origin, algorithm, helpers.Hash(data, algorithm), now)
+		with self._Lock:
+			self._Expected.pop(path, None)
+			if expected is not None:
+				self._Expected[path] = expected
+			while self._Expected:
+				(oldest, entry) = next(iter(self._Expected.items()))
+				if len(self._Expected) <= self.MaxEntries and entry.Time + self.TimeToLive > now:
+					break
+				del self._Expected[oldest]
+
+	def wrote(self, path):
+		"""
+		Notes the state of a file once an expected write has been made, so the change can be recognized
+		without hashing the file.
+		"""
+		with self._Lock:
+			if path not in self._Expected:
+				return
+		try:
+			signature = _Signature(os.stat(path))
+		except OSError:
+			return
+		with self._Lock:
+			expected = self._Expected.get(path)
+			if expected is not None and expected.Hash is not None:
+				expected.Signature = signature
+
+	def isEcho(self, mode, path, origin, hashFile = None):
+		"""
+		Checks whether a change the watcher reported was made on behalf of a session.
+		:param mode: "add", "modify" or "delete".
+		:param origin: the session being told about the change.
+		:param hashFile: hashes a file given its path; used when the file doesn't look the way it did when it was
+			written, to see whether its contents do. Defaults to helpers.HashFile.
+		"""
+		with self._Lock:
+			expected = self._Expected.get(path)
+			if expected is None or expected.Origin != origin or expected.Time + self.TimeToLive <= time.monotonic():
+				return False
+		if expected.Hash is None:
+			echo = mode == "delete" and not os.path.lexists(path)
+		elif mode == "delete":
+			echo = False
+		else:
+			try:
+				echo = expected.Signature is not None and _Signature(os.stat(path)) == expected.Signature
+				if not echo:
+					if hashFile is None or expected.Algorithm != helpers.CurrentHashAlgorithm():
+						echo = helpers.HashFile(path, expected.Algorithm) == expected.Hash
+					else:
+						echo = hashFile(path) == expected.Hash
+			except OSError:
+				echo = False
+		if echo:
+			with self._Lock:
+				self.Suppressed += 1
+		return echo
+
+	def __len__(self):
+		return len(self._Expected)
+
+class EchoSuppressorTestCase(unittest.TestCase):
+	def setUp(self):
+		import tempfile
+		self.dir = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.dir.name, "a.lua")
+		self.echoes = EchoSuppressor()
+
+	def tearDown(self):
+		self.dir.cleanup()
+
+	def write(self, contents, origin):
+		self.echoes.expect(self.path, contents, origin)
+		helpers.WriteFile(self.path, contents)
+		self.echoes.wrote(self.path)
+
+	def test_write(self):
+		self.write("print(1)", "1")
+		self.assertTrue(self.echoes.isEcho("modify", self.path, "1"))
+		self.assertTrue(self.echoes.isEcho("add", self.path, "1"))
+		# Other sessions still hear about it.
+		self.assertFalse(self.echoes.isEcho("modify", self.path, "2"))
+		self.assertFalse(self.echoes.isEcho("delete", self.path, "1"))
+
+	def test_memoryview(self):
+		contents = b"local x = 1\r\n" * (helpers.HASH_CHUNK_SIZE // 7)
+		for algorithm in helpers.HASH_ALGORITHMS:
+			with helpers.HashAlgorithm(algorithm):
+				self.assertEqual(helpers.Hash(memoryview(contents)), helpers.Hash(contents))
+				self.write(memoryview(contents), "1")
+				self.assertTrue(self.echoes.isEcho("modify", self.path, "1"))
+
+	def test_changed_since(self):
+		self.write("print(1)", "1")
+		time.sleep(.01)
+		with open(self.path, "w") as f:
+			f.write("print(22)")
+		self.assertFalse(self.echoes.isEcho("modify", self.path, "1"))
+		# Putting the contents back (e.g., an editor saving them again) matches by hash.
+		with open(self.path, "w") as f:
+			f.write("print(1)")
+		self.assertTrue(self.echoes.isEcho("modify", self.path, "1"))
+
+	def test_other_writer(self):
+		self.write("print(1)", "1")
+		self.write("print(2)", None)
+		self.assertFalse(self.echoes.isEcho("modify", self.path, "1"))
+		self.assertEqual(len(self.echoes), 0)
+
+	def test_delete(self):
+		self.write("print(1)", None)
+		self.echoes.expect(self.path, None, "1")
+		os.remove(self.path)
+		self.assertTrue(self.echoes.isEcho("delete", self.path, "1"))
+		self.assertFalse(self.echoes.isEcho("delete", self.path, "2"))
+
+	def test_expiry(self):
+		self.echoes.MaxEntries = 1
+		self.write("print(1)", "1")
+		self.echoes.expect(os.path.join(self.dir.name, "b.lua"), "", "1")
+		self.assertFalse(self.echoes.isEcho("modify", self.path, "1"))
+		self.assertEqual(len(self.echoes), 1)
@@ -1,66 +1,266 @@
+import asyncio
+import collections
+import contextvars
+import functools
+import inspect
 import os
 import unittest
 import filewatch
 import time
 import queue
+import threading
 import commandhandler.helpers as helpers
 from logger import logger
 
 
+class SessionExpired(KeyError):
+	"""
+	Raised when a session is used after it was removed (e.g., because it expired or was evicted).
+	"""
+
 class SessionTracker:
 	"""
 	A class which creates sessions which have unique IDs. Accessing the session keeps it alive. Any
-	session which hasn't been accessed in a period of time can be cleaned up.
+	session which hasn't been accessed in a period of time is cleaned up by a background reaper, and once
+	there are MaxSessions sessions, adding another cleans up the least recently used one.
 
-	Cleanup logic hasn't been implemented, yet.
+	Clients which crash never stop their sessions, so without this their watchers would run forever.
 	"""
 	ExpiryTime = 60 * 30   # Sessions expire after being neglected for thirty minutes.
-	def __init__(self, cleanup = lambda x: None):
-		self._Sessions = dict()
+	ReapInterval = 60  # How often (in seconds) the reaper looks for expired sessions.
+	MaxSessions = 64
+
+	def __init__(self, cleanup = lambda x: None, expiryTime = None, maxSessions = None):
+		"""
+		:param cleanup: called with a session's value when the session is removed.
+		:param expiryTime: overrides ExpiryTime.
+		:param maxSessions: overrides MaxSessions.
+		"""
+		if expiryTime is not None:
+			self.ExpiryTime = expiryTime
+		if maxSessions is not None:
+			self.MaxSessions = maxSessions
+		self._Sessions = collections.OrderedDict()  # A map of ID --> [value, last access], least recently used first.
 		self._LastIndex = -1
 		self._Cleanup = cleanup
+		self._Lock = threading.Lock()
+		self._Reaper = None
+		self._Stopped = threading.Event()
 
 	def __getitem__(self, i):
-		self._Sessions[i][1] = time.monotonic()
-		return self._Sessions[i][0]
+		with self._Lock:
+			session = self._Sessions.get(i)
+			if session is None:
+				raise SessionExpired(i)
+			session[1] = time.monotonic()
+			self._Sessions.move_to_end(i)
+			return session[0]
 
 	def __contains__(self, i):
 		return i in self._Sessions
 
+	def __len__(self):
+		return len(self._Sessions)
+
+	def values(self):
+		"""
+		:return: a list of every session's value. This doesn't keep the sessions alive.
+		"""
+		with self._Lock:
+			return [session[0] for session in self._Sessions.values()]
+
 	def clean(self):
 		"""
 		Iterates through all sessions and cleans up ones which haven't been accessed in a while.
 		"""
-		for (index, t) in list(self._Sessions.items()):
-			if t[1] + self.ExpiryTime < time.monotonic():
-				logger.warning("file tracking session with ID {} expired", index)
-				self.remove(index)
+		expired = []
+		with self._Lock:
+			now = time.monotonic()
+			# Sessions are in order of last access, so the expired ones are all at the front.
+			for (index, session) in self._Sessions.items():
+				if session[1] + self.ExpiryTime >= now:
+					break
+				expired.append(index)
+		for index in expired:
+			logger.warning("file tracking session with ID {} expired", index)
+			self.remove(index)
 
 	def add(self, value):
 		"""
 		Adds a new session to this object and returns its ID.
 		"""
-		self._LastIndex+=1
-		self._Sessions[self._LastIndex] = [value, time.monotonic()]
-		return self._LastIndex
+		evicted = []
+		with self._Lock:
+			while len(self._Sessions) >= self.MaxSessions:
+				evicted.append(self._Sessions.popitem(last=False))
+			self._LastIndex+=1
+			self._Sessions[self._LastIndex] = [value, time.monotonic()]
+			index = self._LastIndex
+			if self._Reaper is None:
+				self._Reaper = threading.Thread(target=self._Reap, name="SessionReaper", daemon=True)
+				self._Reaper.start()
+		for (evictedIndex, session) in evicted:
+			logger.warning("file tracking session with ID {} evicted to make room for another", evictedIndex)
+			self._Cleanup(session[0])
+		return index
 
 	def remove(self, index):
-		self._Cleanup(self._Sessions[index][0])
-		del self._Sessions[index]
+		with self._Lock:
+			session = self._Sessions.pop(index, None)
+		if session is not None:
+			self._Cleanup(session[0])
+
+	def _Reap(self):
+		while not self._Stopped.wait(self.ReapInterval):
+			try:
+				self.clean()
+			except Exception as e:
+				logger.error("Failed to clean up sessions", exc_info=e)
+
+	def kill(self):
+		"""
+		Stops the reaper.
+		"""
+		self._Stopped.set()
+
+def _CountsPolls(function):
+	"""
+	Decorates a long poll command so FileWatchCommandHandler.ActivePolls counts it while it's waiting.
+	"""
+	if inspect.iscoroutinefunction(function):
+		@functools.wraps(function)
+		async def poll(self, *args):
+			with self._Polling():
+				return await function(self, *args)
+	else:
+		@functools.wraps(function)
+		def poll(self, *args):
+			with self._Polling():
+				return function(self, *args)
+	return poll
+
+class _PollCounter:
+	def __init__(self, handler):
+		self._Handler = handler
+
+	def __enter__(self):
+		with self._Handler._PollLock:
+			self._Handler.ActivePolls += 1
+
+	def __exit__(self, *args):
+		with self._Handler._PollLock:
+			self._Handler.ActivePolls -= 1
 
 class FileWatchCommandHandler:
 	POLL_TIMEOUT = 30
+	MAX_BATCH_COUNT = 1000  # The most changes watch_poll_batch will return at once.
+	MAX_BATCH_BYTES = 256 * 1024  # watch_poll_batch stops adding changes once their paths total this many characters.
 
-	def __init__(self, root):
-		self._FileWatchST = SessionTracker(lambda t: t[0].kill())
+	def __init__(self, root, hashIndex = None, settleTime = None, watchers = None, ignoreFile = None, echoes = None):
+		"""
+		:param root: the directory which all file paths are relative to.
+		:param hashIndex: a HashIndex used to hash changed files.
+		:param settleTime: how long (in seconds) a file must go unchanged before we report it; see filewatch.Coalescer.
+		:param watchers: the filewatch.WatcherPool to subscribe to. If None, one is created which informs hashIndex
+			of changes (and settleTime is used for it).
+		:param ignoreFile: an ignore.IgnoreFile whose rules keep changes from being shared.
+		:param echoes: an echo.EchoSuppressor; a session isn't told about the changes it made itself.
+		"""
+		self._FileWatchST = SessionTracker(lambda subscription: subscription.close())
 		self._Root = root
+		self._HashIndex = hashIndex
+		if watchers is None:
+			# Invalidate the hash index as soon as a change is seen, not only when a session polls for it.
+			watchers = filewatch.WatcherPool([hashIndex] if hashIndex is not None else [], settleTime=settleTime)
+		self._Watchers = watchers
+		self._IgnoreFile = ignoreFile
+		self._Echoes = echoes
+		self.ActivePolls = 0  # The number of long polls being handled right now.
+		self._PollLock = threading.Lock()
+
+	def _Polling(self):
+		return _PollCounter(self)
+
+	def registerMetrics(self, registry):
+		"""
+		Exposes the number of sessions & long polls, and how far behind sessions are, through a metrics.Registry.
+		"""
+		registry.gauge("syncytowne_watch_sessions", "Open file watching sessions.", function=lambda: len(self._FileWatchST))
+		registry.gauge("syncytowne_long_polls_active", "Long polls waiting for file changes.", function=lambda: self.ActivePolls)
+		registry.gauge("syncytowne_watch_queue_depth", "File changes waiting to be polled for, across every session.",
+			function=lambda: sum(subscription.Backlog for subscription in self._FileWatchST.values()))
+
+	def _HashFile(self, filepath):
+		if self._HashIndex is not None:
+			return self._HashIndex.hash(filepath)
+		return helpers.HashFile(filepath)
 
 	def watch_start(self, directory):
-		queue = filewatch.QueueCallbacks()
-		watcher = filewatch.WatchForChanges(directory, queue)
-		id = self._FileWatchST.add((watcher, queue))
+		id = self._FileWatchST.add(self._Watchers.subscribe(directory))
 		return {"ID": id}
 
+	def _NextChange(self, subscription, end_time):
+		"""
+		Waits for the next change that should be shared with the client.
+		:param subscription: the Subscription to read from.
+		:param end_time: the time.monotonic() at which to give up.
+		:return: a (mode, absolute path, relative path) tuple.
+		:raises queue.Empty: if no change came in before end_time.
+		"""
+		while True:
+			change = self._Share(*subscription.get(timeout=end_time - time.monotonic()))
+			if change is not None:
+				return change
+
+	async def _NextChangeAsync(self, subscription, end_time):
+		"""
+		Like _NextChange, but waits on the event loop rather than blocking.
+		"""
+		while True:
+			change = self._Share(*await subscription.get_async(timeout=end_time - time.monotonic()))
+			if change is not None:
+				return change
+
+	def _Share(self, mode, filepath):
+		"""
+		:return: the (mode, absolute path, relative path) tuple to share with the client, or None if the
+			change shouldn't be shared.
+		"""
+		relativeFilepath = helpers.AbsoluteToRelativeFilePath(filepath, self._Root)
+
+		# if the file has any hidden directories in it, don't continue.
+		logger.debug("relativeFilepath: {} (hidden directories: {})", relativeFilepath, [dir for dir in relativeFilepath.split("/") if dir[0] == "."])
+		if len([dir for dir in relativeFilepath.split("/") if dir[0] == "."]):
+			logger.debug("Not sharing {} because it contains hidden directory/file", relativeFilepath)
+			return None
+		if self._IgnoreFile is not None:
+			rules = self._IgnoreFile.rules()
+			if rules and rules.ignoredWithin(relativeFilepath, os.path.isdir(filepath) if mode != "delete" else None):
+				logger.debug("Not sharing {} because it's ignored", relativeFilepath)
+				return None
+		return (mode, filepath, relativeFilepath)
+
+	def _DescribeChange(self, mode, filepath, relativeFilepath, id = None):
+		"""
+		Builds the line which informs the client of a change.
+		:param id: the session the change is for.
+		:return: the line, or None if the change should be ignored: the file couldn't be hashed, or the session
+			made the change itself.
+		"""
+		if self._Echoes is not None and id is not None and self._Echoes.isEcho(mode, filepath, str(id), self._HashFile):
+			logger.debug("Not sharing {} with session {}, which made the change", relativeFilepath, id)
+			return None
+		# Get the hash; failure to do so should cause us to ignore this result.
+		hash = ""
+		if mode == "modify" or mode == "add":
+			try:
+				hash = self._HashFile(filepath)
+				logger.debug("Hash of {}: {}", filepath, hash)
+			except Exception as e:
+				return None
+		return mode + " '" + relativeFilepath + "'" + (" " + hash if hash else "")
+
+	@_CountsPolls
 	def watch_poll(self, id):
 		end_time = time.monotonic() + self.POLL_TIMEOUT
 		if id not in self._FileWatchST:
@@ -70,35 +270,156 @@ class FileWatchCommandHandler:
 
 		try:
 			while True:
-				self._FileWatchST[id][1].Deduplicate()
-				(mode, filepath) = self._FileWatchST[id][1].get(timeout=end_time - time.monotonic())
-				relativeFilepath = helpers.AbsoluteToRelativeFilePath(filepath, self._Root)
-
-				# if the file has any hidden directories in it, don't continue.
-				logger.debug("relativeFilepath: {} (hidden directories: {})", relativeFilepath, [dir for dir in relativeFilepath.split("/") if dir[0] == "."])
-				if len([dir for dir in relativeFilepath.split("/") if dir[0] == "."]):
-					logger.debug("Not sharing {} because it contains hidden directory/file", relativeFilepath)
+				subscription = self._FileWatchST[id]
+				(mode, filepath, relativeFilepath) = self._NextChange(subscription, end_time)
+				line = self._DescribeChange(mode, filepath, relativeFilepath, id)
+				if line is None:
 					continue
 
-				# Get the hash; failure to do so should cause us to ignore this result.
-				hash = ""
-				if mode == "modify" or mode == "add":
-					try:
-						with open(filepath, 'rb') as file:
-							time.sleep(.1)
-							hash = helpers.Hash(file.read())
-							logger.debug("Hash of {}: {}", filepath, hash)
-					except Exception as e:
-						continue
-
 				# Inform the user of the change.
 				return {
-					"FileChange": mode + " '" + relativeFilepath + "'" + (" " + hash if hash else "")
+					"FileChange": line
 				}
 		except queue.Empty as e:
 			return {
 				"FileChange": ""
 			}
+		except filewatch.Overflow:
+			# We lost track of what changed, so the client must look at everything again.
+			return {
+				"FileChange": "error RESYNC",
+			}
+		except SessionExpired:
+			return {
+				"FileChange": "error ID_NO_LONGER_VALID",
+			}
+
+	@_CountsPolls
+	def watch_poll_batch(self, id, maxCount):
+		"""
+		Like watch_poll, but returns every pending change (one per line) rather than just the first. This
+		waits up to POLL_TIMEOUT for the first change, but never waits for more.
+		:param maxCount: the most changes to return; 0 means MAX_BATCH_COUNT.
+		"""
+		end_time = time.monotonic() + self.POLL_TIMEOUT
+		if id not in self._FileWatchST:
+			return {
+				"FileChanges": "error ID_NO_LONGER_VALID",
+			}
+		if maxCount <= 0 or maxCount > self.MAX_BATCH_COUNT:
+			maxCount = self.MAX_BATCH_COUNT
+
+		try:
+			while True:
+				subscription = self._FileWatchST[id]
+				changes = self._CollectBatch(subscription, self._NextChange(subscription, end_time), maxCount)
+				lines = self._DescribeChanges(changes, id)
+				if lines:
+					return {
+						"FileChanges": "\n".join(lines)
+					}
+		except queue.Empty as e:
+			return {
+				"FileChanges": ""
+			}
+		except filewatch.Overflow:
+			# We lost track of what changed, so the client must look at everything again.
+			return {
+				"FileChanges": "error RESYNC",
+			}
+		except SessionExpired:
+			return {
+				"FileChanges": "error ID_NO_LONGER_VALID",
+			}
+
+	def _CollectBatch(self, subscription, first, maxCount):
+		"""
+		Gathers every change that's ready to go out along with the first one, without waiting for more.
+		"""
+		changes = [first]
+		size = len(first[2])
+		while len(changes) < maxCount and size < self.MAX_BATCH_BYTES:
+			try:
+				change = self._NextChange(subscription, time.monotonic())
+			except queue.Empty:
+				break
+			changes.append(change)
+			size += len(change[2])
+		return changes
+
+	def _DescribeChanges(self, changes, id = None):
+		return [line for line in (self._DescribeChange(*change, id) for change in changes) if line is not None]
+
+	@_CountsPolls
+	async def watch_poll_async(self, id):
+		"""
+		Like watch_poll, but the long poll waits on the event loop rather than parking a thread.
+		"""
+		end_time = time.monotonic() + self.POLL_TIMEOUT
+		if id not in self._FileWatchST:
+			return {
+				"FileChange": "error ID_NO_LONGER_VALID",
+			}
+		loop = asyncio.get_running_loop()
+		try:
+			while True:
+				subscription = self._FileWatchST[id]
+				change = await self._NextChangeAsync(subscription, end_time)
+				# Hashing reads the file, so it happens off the loop (in our context, for the request's hash algorithm).
+				line = await loop.run_in_executor(None, contextvars.copy_context().run, self._DescribeChange, *change, id)
+				if line is not None:
+					return {
+						"FileChange": line
+					}
+		except queue.Empty as e:
+			return {
+				"FileChange": ""
+			}
+		except filewatch.Overflow:
+			# We lost track of what changed, so the client must look at everything again.
+			return {
+				"FileChange": "error RESYNC",
+			}
+		except SessionExpired:
+			return {
+				"FileChange": "error ID_NO_LONGER_VALID",
+			}
+
+	@_CountsPolls
+	async def watch_poll_batch_async(self, id, maxCount):
+		"""
+		Like watch_poll_batch, but the long poll waits on the event loop rather than parking a thread.
+		"""
+		end_time = time.monotonic() + self.POLL_TIMEOUT
+		if id not in self._FileWatchST:
+			return {
+				"FileChanges": "error ID_NO_LONGER_VALID",
+			}
+		if maxCount <= 0 or maxCount > self.MAX_BATCH_COUNT:
+			maxCount = self.MAX_BATCH_COUNT
+		loop = asyncio.get_running_loop()
+		try:
+			while True:
+				subscription = self._FileWatchST[id]
+				changes = self._CollectBatch(subscription, await self._NextChangeAsync(subscription, end_time), maxCount)
+				lines = await loop.run_in_executor(None, contextvars.copy_context().run, self._DescribeChanges, changes, id)
+				if lines:
+					return {
+						"FileChanges": "\n".join(lines)
+					}
+		except queue.Empty as e:
+			return {
+				"FileChanges": ""
+			}
+		except filewatch.Overflow:
+			# We lost track of what changed, so the client must look at everything again.
+			return {
+				"FileChanges": "error RESYNC",
+			}
+		except SessionExpired:
+			return {
+				"FileChanges": "error ID_NO_LONGER_VALID",
+			}
 
 	def watch_stop(self, id):
 		if id in self._FileWatchST:
@@ -127,17 +448,78 @@ class FileWatchCommandHandlerTestCase(unittest.TestCase):
 		id = self.handler.handle("watch_start\n.")
 		self.writeFileOnDelay(.1, "file1.txt", "foobar")
 		self.assertEqual(
-			"modify file1.txt 6",
+			"modify 'file1.txt' 6",
 			self.handler.handle("watch_poll\n{}".format(id))
 		)
 		self.handler.handle("watch_stop\n{}".format(id))
 
 	def test_update_hidden_file(self):
 		id = self.handler.handle("watch_start\n.")
+		# Outside of Windows, this is a hidden file named ".git\secretfile.txt" in testdir itself.
+		hidden = os.path.join(self.testdir, ".git\\secretfile.txt")
+		self.addCleanup(lambda: os.remove(hidden) if os.path.isfile(hidden) else None)
 		self.writeFileOnDelay(.1, ".git\\secretfile.txt", "foobar")
 		self.writeFileOnDelay(.2, "file1.txt", "foobar")
 		self.assertEqual(
-			"modify file1.txt 6",
+			"modify 'file1.txt' 6",
 			self.handler.handle("watch_poll\n{}".format(id))
 		)
-		self.handler.handle("watch_stop\n{}".format(id))
\ No newline at end of file
+		self.handler.handle("watch_stop\n{}".format(id))
+
+	def test_poll_batch(self):
+		id = self.handler.handle("watch_start\n.")
+		self.writeFileOnDelay(.1, "file1.txt", "foobar")
+		self.writeFileOnDelay(.1, "morefiles/file2.txt", "")
+		time.sleep(.3)
+		self.assertEqual(
+			set(["modify 'file1.txt' 6", "modify 'morefiles/file2.txt' 0"]),
+			set(self.handler.handle("watch_poll_batch\n{}\n0".format(id)).split("\n"))
+		)
+		self.handler.handle("watch_stop\n{}".format(id))
+
+	def test_resync_on_overflow(self):
+		import tempfile
+		with tempfile.TemporaryDirectory() as root:
+			watchers = filewatch.WatcherPool(settleTime=0)
+			watchers.MaxPending = 1
+			handler = FileWatchCommandHandler(root, watchers=watchers)
+			id = handler.watch_start(root)["ID"]
+			try:
+				for name in ("a.lua", "b.lua"):
+					with open(os.path.join(root, name), "w") as f:
+						f.write("foo")
+				time.sleep(.3)
+				self.assertEqual(handler.watch_poll_batch(id, 0), {"FileChanges": "error RESYNC"})
+				# The session carries on from the latest change.
+				with open(os.path.join(root, "a.lua"), "w") as f:
+					f.write("foobar")
+				self.assertEqual(handler.watch_poll_batch(id, 0), {"FileChanges": "modify 'a.lua' 6"})
+			finally:
+				handler.watch_stop(id)
+				handler._FileWatchST.kill()
+
+class SessionTrackerTestCase(unittest.TestCase):
+	def setUp(self):
+		self.cleaned = []
+		self.tracker = SessionTracker(self.cleaned.append, maxSessions=2)
+
+	def tearDown(self):
+		self.tracker.kill()
+
+	def test_lru_eviction(self):
+		a = self.tracker.add("a")
+		b = self.tracker.add("b")
+		self.tracker[a]  # b is now the least recently used.
+		c = self.tracker.add("c")
+		self.assertEqual(self.cleaned, ["b"])
+		self.assertNotIn(b, self.tracker)
+		self.assertRaises(SessionExpired, self.tracker.__getitem__, b)
+		self.assertEqual(sorted(self.tracker.values()), ["a", "c"])
+
+	def test_reaper(self):
+		self.tracker.ExpiryTime = .1
+		self.tracker.ReapInterval = .05
+		a = self.tracker.add("a")
+		time.sleep(.5)
+		self.assertNotIn(a, self.tracker)
+		self.assertEqual(self.cleaned, ["a"])
@@ -1,42 +1,347 @@
 import commandhandler.helpers as helpers
+import collections
+import concurrent.futures
 import os
+import stat
+import threading
+import time
 import unittest
 from logger import logger
+from . import ignore
+from . import merkle
+from .commandvalidator import HttpException
+
+class _CachedTree:
+	__slots__ = ("Tree", "Generation", "Rules", "Lock")
+
+	def __init__(self):
+		self.Tree = None  # The MerkleTree, with paths relative to the root.
+		self.Generation = 0  # The watcher generation the tree is up to date with.
+		self.Rules = None  # The IgnoreRules the tree was built with.
+		self.Lock = threading.Lock()  # Held by whoever is updating or reading the tree.
 
 class HashCommandHandler:
-	def __init__(self, root):
+	MaxPendingPerWorker = 4  # How many files may be queued for each worker before the walk waits.
+	MaxTrees = 16  # How many directories hash_tree keeps MerkleTrees of.
+	_NoRules = ignore.IgnoreRules()
+
+	def __init__(self, root, hashIndex = None, workers = None, watchers = None, ignoreFile = None):
+		"""
+		:param root: the directory which all file paths are relative to.
+		:param hashIndex: a HashIndex used to avoid rehashing unchanged files.
+		:param workers: the number of threads which hash files for parse; defaults to the number of CPUs.
+		:param watchers: the filewatch.WatcherPool whose history parse_since reads. Without one, parse_since
+			always gives a full listing.
+		:param ignoreFile: an ignore.IgnoreFile whose rules leave files out of parse & parse_since.
+		"""
 		self.root = root
+		self.watchers = watchers
+		self.ignoreFile = ignoreFile
 		self.Hash = lambda s: helpers.Hash(s)
+		self.hashIndex = hashIndex
+		self.workers = workers or os.cpu_count() or 1
+		self._Pool = None
+		self._PoolLock = threading.Lock()
+		self._Trees = collections.OrderedDict()  # A map of (absolute path, suffixes, algorithm) --> _CachedTree, least recently used first.
+		self._TreesLock = threading.Lock()
+
+	def _GetPool(self):
+		with self._PoolLock:
+			if self._Pool is None:
+				self._Pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="HashWorker")
+			return self._Pool
+
+	def _HashFile(self, filepath, stat = None, algorithm = None):
+		if self.hashIndex is not None:
+			return self.hashIndex.hash(filepath, stat, algorithm)
+		return helpers.HashFile(filepath, algorithm)
+
+	def _Rules(self):
+		return self.ignoreFile.rules() if self.ignoreFile is not None else self._NoRules
+
+	def _Walk(self, filepath, depth):
+		"""
+		Finds every file in a tree, skipping hidden & ignored files and directories. Ignored directories aren't
+		descended into.
+		:param filepath: the absolute path to the directory to walk.
+		:param depth: how many levels of directories to descend into; 0 means no limit.
+		:return: an iterator of (relative path, DirEntry) tuples. Files in a directory come before the contents
+			of its subdirectories, and everything is sorted by name.
+		"""
+		rules = self._Rules()
+		stack = [(filepath, helpers.AbsoluteToRelativeFilePath(filepath, self.root), 1)]
+		if rules and stack[0][1] and rules.ignoredWithin(stack[0][1], True):
+			return
+		while stack:
+			(directory, relativeDirectory, level) = stack.pop()
+			prefix = relativeDirectory + "/" if relativeDirectory else ""
+			try:
+				entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+			except OSError:
+				continue
+			subdirectories = []
+			for entry in entries:
+				if entry.name[0:1] == '.':
+					continue
+				path = prefix + entry.name
+				isDirectory = entry.is_dir()
+				if rules and rules.ignored(path, isDirectory):
+					continue
+				if isDirectory:
+					if depth == 0 or level < depth:
+						subdirectories.append((entry.path, path, level + 1))
+				else:
+					yield (path, entry)
+			stack.extend(reversed(subdirectories))
+
+	def _Lines(self, filepath, depth, hash, lineFormat = "{} {}\n"):
+		"""
+		Generates each line of the parse result.
+		:param lineFormat: the format of a line, given the file's relative path & hash.
+		"""
+		if not hash:
+			token = helpers.CurrentCancellationToken()
+			for (path, entry) in self._Walk(filepath, depth):
+				token.check()
+				yield path + "\n"
+			return
+		for (path, hash) in self._Hashes(filepath, depth):
+			yield lineFormat.format(path, hash)
+
+	def _Hashes(self, filepath, depth, include = None):
+		"""
+		Generates a (relative path, hash) tuple for each file in a tree. Files are hashed by a pool of workers,
+		but come out in the order they were found.
+		:param include: if given, only files for which this returns True (given the file's name) are hashed.
+		"""
+		token = helpers.CurrentCancellationToken()
+		# The workers don't share our context, so they're told the request's algorithm.
+		algorithm = helpers.CurrentHashAlgorithm()
+		pool = self._GetPool()
+		maxPending = self.workers * self.MaxPendingPerWorker
+		pending = collections.deque()
+		try:
+			for (path, entry) in self._Walk(filepath, depth):
+				token.check()
+				if include is not None and not include(entry.name):
+					continue
+				pending.append((path, pool.submit(self._HashFile, entry.path, entry.stat(), algorithm)))
+				while len(pending) >= maxPending:
+					(path, future) = pending.popleft()
+					hash = self._Result(path, future)
+					if hash is not None:
+						yield (path, hash)
+			while pending:
+				token.check()
+				(path, future) = pending.popleft()
+				hash = self._Result(path, future)
+				if hash is not None:
+					yield (path, hash)
+		finally:
+			for (path, future) in pending:
+				future.cancel()
+			if self.hashIndex is not None:
+				self.hashIndex.saveSoon()
+
+	@staticmethod
+	def _Result(path, future):
+		try:
+			return future.result()
+		except FileNotFoundError:
+			logger.debug("Parse - {} was deleted before it could be hashed", path)
+			return None
 
 	def parse(self, filepath, depth, hash):
-		returnValue = []
-		for subdir, dirs, files in os.walk(filepath):
-			assert(filepath == subdir[:len(filepath)])
-			trimmed = subdir[len(filepath):]
-			if trimmed and trimmed[0] == os.sep:
-				trimmed = trimmed[1:]
-			dirname = os.path.basename(subdir)
-			if dirname[0:1] == '.' or trimmed.count('/') == depth - 1:
-				for i in range(len(dirs) - 1, -1, -1):
-					del dirs[i]
-			if dirname[0:1] != '.':
-				for file in files:
-					if file[0:1] != '.':
-						logger.debug("Parse - found file at {}, {}, {}", filepath, trimmed, file)
-						path = helpers.AbsoluteToRelativeFilePath(os.path.join(filepath, trimmed, file), self.root)
-						lineContents = [path]
-						if hash:
-							with open(os.path.join(subdir, file),'rb') as file:
-								lineContents.append(self.Hash(file.read()))
-						returnValue.append(" ".join(lineContents) + "\n")
-		return {"Tree": "".join(returnValue)}
+		# The tree is streamed to the client as it's generated.
+		tree = self._Lines(filepath, depth, hash)
+		if self.watchers is not None and os.path.isdir(filepath):
+			# The tree only changes when something within the directory does, so it's the same for as long as the
+			# directory's generation is (& the rules & hash algorithm are).
+			key = (filepath, depth, hash, helpers.CurrentHashAlgorithm(), self._Rules(), self.watchers.generation(filepath))
+			tree = helpers.Cacheable(tree, key)
+		return {"Tree": tree}
+
+	def _Changes(self, changes):
+		"""
+		Generates a line for each change in the form watch_poll uses: "<mode> '<path>' <hash>".
+		:param changes: a list of (mode, absolute path) tuples.
+		"""
+		for (mode, path, hash) in self._ChangedFiles(changes):
+			if hash is None:
+				yield "{} '{}'\n".format(mode, path)
+			else:
+				yield "{} '{}' {}\n".format(mode, path, hash)
+
+	def _ChangedFiles(self, changes, include = None):
+		"""
+		Generates a (mode, relative path, hash) tuple for each file a list of changes affects. The hash is None
+		for a delete (which may be of a directory).
+		:param changes: a list of (mode, absolute path) tuples.
+		:param include: if given, only files for which this returns True (given the file's name) are added or
+			modified; deletes are always generated.
+		"""
+		token = helpers.CurrentCancellationToken()
+		rules = self._Rules()
+		for (mode, filepath) in changes:
+			token.check()
+			relativeFilepath = helpers.AbsoluteToRelativeFilePath(filepath, self.root)
+			if any(part[0:1] == "." for part in relativeFilepath.split("/")):
+				continue
+			if rules and rules.ignoredWithin(relativeFilepath, os.path.isdir(filepath) if mode != "delete" else None):
+				continue
+			if mode != "delete":
+				try:
+					info = os.stat(filepath)
+					if stat.S_ISDIR(info.st_mode):
+						# Files within a directory which was moved in aren't reported individually.
+						if mode == "add":
+							yield from (("add", path, hash) for (path, hash) in self._Hashes(filepath, 0, include))
+						continue
+					if include is None or include(os.path.basename(filepath)):
+						yield (mode, relativeFilepath, self._HashFile(filepath, info))
+					continue
+				except FileNotFoundError:
+					pass  # It's been deleted since.
+				except OSError as e:
+					logger.debug("parse_since - skipping {}: {}", relativeFilepath, e)
+					continue
+			yield ("delete", relativeFilepath, None)
+
+	def parse_since(self, filepath, generation):
+		"""
+		Lists what changed within a directory since a generation returned by an earlier parse_since. If the
+		server's history doesn't reach back that far (or generation is 0), every file is listed as an add
+		instead, and Mode is "full" rather than "changes".
+		"""
+		if self.watchers is None:
+			(changes, next) = (None, 0)
+		else:
+			(changes, next) = self.watchers.changes(filepath, generation)
+		if changes is None:
+			return {"Generation": next, "Mode": "full", "Changes": self._Lines(filepath, 0, True, "add '{}' {}\n")}
+		return {"Generation": next, "Mode": "changes", "Changes": self._Changes(changes)}
+
+	@staticmethod
+	def _ParseManifest(manifest):
+		"""
+		:param manifest: lines in the form parse gives them: "<path> <hash>".
+		:return: a map of path --> hash.
+		"""
+		files = {}
+		for line in manifest.split("\n"):
+			if not line:
+				continue
+			(path, space, hash) = line.rpartition(" ")
+			if not space or not path:
+				raise HttpException(400, None, "Malformed manifest line {!r}".format(line))
+			files[path] = hash
+		return files
+
+	def _Differences(self, filepath, include, manifest):
+		token = helpers.CurrentCancellationToken()
+		for (path, hash) in self._Hashes(filepath, 0, include):
+			theirs = manifest.pop(path, None)
+			if theirs is None:
+				yield "fileOnly '{}' {}\n".format(path, hash)
+			elif theirs != hash:
+				yield "desynced '{}' {}\n".format(path, hash)
+		# Whatever we didn't find is only on the client.
+		for path in sorted(manifest):
+			token.check()
+			yield "scriptOnly '{}'\n".format(path)
+
+	def diff(self, filepath, suffixes, manifest):
+		"""
+		Compares a directory against the client's copy of it, and lists only the files which differ, one per line:
+			fileOnly '<path>' <hash>      the file is only on the server
+			scriptOnly '<path>'           the file is only on the client
+			desynced '<path>' <hash>      the file's contents differ
+		where <hash> is the hash of the server's copy.
+		:param suffixes: the endings (separated by spaces) of the names of the files to compare; the rest are left
+			out. If empty, every file is compared.
+		:param manifest: the client's files, in the form parse gives them: "<path> <hash>" on each line, where
+			paths are relative to the root.
+		"""
+		suffixes = tuple(suffixes.split())
+		include = (lambda name: name.endswith(suffixes)) if suffixes else None
+		return {"Differences": self._Differences(filepath, include, self._ParseManifest(manifest))}
+
+	def _UpdateTree(self, cached, filepath, include):
+		"""
+		Brings a cached tree up to date by applying what the watcher saw change since it was last updated. The
+		tree is built from scratch the first time, or if that history has been lost, or if the ignore rules have
+		changed since.
+		"""
+		rules = self._Rules()
+		if self.watchers is None:
+			(changes, generation) = (None, 0)
+		else:
+			(changes, generation) = self.watchers.changes(filepath, cached.Generation)
+		if changes is None or cached.Tree is None or rules is not cached.Rules:
+			logger.debug("hash_tree - building the tree of {}", filepath)
+			tree = merkle.MerkleTree()
+			for (path, hash) in self._Hashes(filepath, 0, include):
+				tree.set(path, hash)
+			(cached.Tree, cached.Rules) = (tree, rules)
+		else:
+			for (mode, path, hash) in self._ChangedFiles(changes, include):
+				if hash is None:
+					cached.Tree.remove(path)
+				else:
+					cached.Tree.set(path, hash)
+		cached.Generation = generation
+
+	def hash_tree(self, filepath, suffixes, depth):
+		"""
+		Lists the digest (see merkle.py) of a directory & of the directories within it, one per line:
+			'<path>' <digest>
+		A client which computes the same digests for its own directories only needs to look into the ones whose
+		digests differ. The directory comes first, and each directory comes before those within it. Directories
+		with no files within them are left out.
+		The tree of digests is kept between requests & updated from what the watcher sees, so only the files
+		which changed since the last hash_tree of the directory are hashed again.
+		:param suffixes: the endings (separated by spaces) of the names of the files the digests cover; the rest
+			are left out. If empty, every file is covered.
+		:param depth: how many levels of subdirectories to list; 0 means no limit.
+		"""
+		algorithm = helpers.CurrentHashAlgorithm()
+		if algorithm == "length":
+			# Listings with different contents are all too likely to be the same length.
+			raise HttpException(400, None, "hash_tree needs a hash algorithm other than 'length'")
+		suffixes = tuple(suffixes.split())
+		include = (lambda name: name.endswith(suffixes)) if suffixes else None
+		key = (filepath, suffixes, algorithm)
+		with self._TreesLock:
+			cached = self._Trees.pop(key, None) or _CachedTree()
+			self._Trees[key] = cached
+			while len(self._Trees) > self.MaxTrees:
+				self._Trees.popitem(last=False)
+		relativeFilepath = helpers.AbsoluteToRelativeFilePath(filepath, self.root).rstrip("/")
+		with cached.Lock:
+			self._UpdateTree(cached, filepath, include)
+			digests = list(cached.Tree.digests(relativeFilepath, depth))
+		if not digests:
+			digests = [(relativeFilepath, helpers.Hash(""))]
+		return {"Hashes": "".join("'{}' {}\n".format(path, digest) for (path, digest) in digests)}
 
 	def hash(self, contents):
 		logger.info("Hashing string of length {}", len(contents))
 		#import hashlib
 		#return {"Hash": hashlib.md5(contents.encode('utf-8')).hexdigest()}  # md5
 		return {"Hash": self.Hash(contents)}
-		
+
+	def hash_algorithm(self, algorithms):
+		"""
+		Picks the hash algorithm used by every other command. Nothing is changed on the server: the client names
+		the algorithm in the helpers.HASH_ALGORITHM_HEADER of each request it makes from then on.
+		:param algorithms: the names of the algorithms the client can compute, most preferred first,
+			separated by spaces.
+		"""
+		for name in algorithms.split():
+			if name in helpers.HASH_ALGORITHMS:
+				return {"Algorithm": name}
+		raise HttpException(400, None, "None of the hash algorithms '{}' are supported".format(algorithms))
+
 class HashCommandHandlerTestCase(unittest.TestCase):
 	testdir = os.path.join(os.path.dirname(__file__), "..", "testdir")
 
@@ -61,3 +366,142 @@ class HashCommandHandlerTestCase(unittest.TestCase):
 
 	def test_hash(self):
 		self.assertEqual("6", self.handler.handle("hash\nfoobar"))
+
+	def test_hash_algorithm(self):
+		import zlib
+		self.assertEqual("crc32", self.handler.handle("hash_algorithm\nmd4 crc32 length"))
+		# Picking an algorithm doesn't change it for anybody; each request names its own.
+		self.assertEqual("6", self.handler.handle("hash\nfoobar"))
+		with helpers.HashAlgorithm("crc32"):
+			self.assertEqual("{:08x}".format(zlib.crc32(b"foo\nbar")), self.handler.handle("hash\nfoo\r\nbar"))
+			self.assertEqual(
+				"file1.txt {:08x}\n".format(zlib.crc32(b"foobar")),
+				self.handler.handle("parse\n.\n1\nTrue"))
+		with helpers.HashAlgorithm("md4"):
+			self.assertEqual("6", self.handler.handle("hash\nfoobar"))
+
+	def test_streaming_hash(self):
+		# A CRLF split across two chunks must hash the same as LF.
+		import tempfile
+		with tempfile.TemporaryDirectory() as dir:
+			path = os.path.join(dir, "file.txt")
+			with open(path, "wb") as f:
+				f.write(b"a" * (helpers.HASH_CHUNK_SIZE - 1) + b"\r\nb\r")
+			self.assertEqual(
+				helpers.Hash(b"a" * (helpers.HASH_CHUNK_SIZE - 1) + b"\nb\r", "blake2b"),
+				helpers.HashFile(path, "blake2b"))
+
+	def test_parallel_parse_is_ordered(self):
+		from commandhandler.hashindex import HashIndex
+		handler = HashCommandHandler(os.path.realpath(self.testdir), HashIndex(), workers=4)
+		handler.MaxPendingPerWorker = 1
+		self.assertEqual(
+			self.handler.handle("parse\n.\n0\nTrue"),
+			"".join(handler.parse(os.path.realpath(self.testdir), 0, True)["Tree"]))
+
+	def test_parse_depth(self):
+		self.assertEqual(
+			"file1.txt\nmorefiles/file2.txt\nmorefiles/file3.txt\n",
+			self.handler.handle("parse\n.\n2\nFalse"))
+
+	def test_parse_ignored(self):
+		import tempfile
+		from unittest import mock
+		with tempfile.TemporaryDirectory() as root:
+			for path in ("a.lua", "out.log", "keep.log", "node_modules/x/y.lua", "src/build/z.lua", "src/b.lua"):
+				os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+				with open(os.path.join(root, path), "w") as f:
+					f.write("")
+			with open(os.path.join(root, ignore.FILENAME), "w") as f:
+				f.write("node_modules/\nbuild/\n*.log\n!keep.log\n")
+			handler = HashCommandHandler(root, ignoreFile=ignore.IgnoreFile(root))
+			with mock.patch("os.scandir", wraps=os.scandir) as scandir:
+				self.assertEqual("a.lua\nkeep.log\nsrc/b.lua\n", "".join(handler.parse(root, 0, False)["Tree"]))
+			# Ignored directories are never read.
+			self.assertEqual(sorted(call.args[0] for call in scandir.call_args_list), [root, os.path.join(root, "src")])
+			self.assertEqual("", "".join(handler.parse(os.path.join(root, "node_modules", "x"), 0, False)["Tree"]))
+			changes = [("modify", os.path.join(root, "out.log")), ("delete", os.path.join(root, "src", "build", "z.lua")), ("delete", os.path.join(root, "src", "b.lua"))]
+			self.assertEqual("delete 'src/b.lua'\n", "".join(handler._Changes(changes)))
+
+	def test_diff(self):
+		self.assertEqual(
+			"fileOnly 'morefiles/file3.txt' 0\ndesynced 'subdir1/subdir2/file4.txt' 0\nscriptOnly 'morefiles/new.txt'\n",
+			self.handler.handle("diff\n.\n2.txt 3.txt 4.txt\nmorefiles/file2.txt 0\nsubdir1/subdir2/file4.txt 5\nmorefiles/new.txt 3\nmorefiles/file2.txt 0"))
+		self.assertEqual("", self.handler.handle("diff\nmorefiles\n\nmorefiles/file2.txt 0\nmorefiles/file3.txt 0"))
+		self.assertRaises(HttpException, self.handler.handle, "diff\n.\n\nno-hash")
+
+	def test_hash_tree(self):
+		self.assertRaises(HttpException, self.handler.handle, "hash_tree\n.\n\n0")
+		with helpers.HashAlgorithm("crc32"):
+			crc = lambda s: helpers.Hash(s, "crc32")
+			morefiles = crc("file2.txt {0}\nfile3.txt {0}\n".format(crc("")))
+			subdir2 = crc("file4.txt {}\n".format(crc("")))
+			subdir1 = crc("subdir2/ {}\n".format(subdir2))
+			root = crc("file1.txt {}\nmorefiles/ {}\nsubdir1/ {}\n".format(crc("foobar"), morefiles, subdir1))
+			self.assertEqual(
+				"'' {}\n'morefiles' {}\n'subdir1' {}\n".format(root, morefiles, subdir1),
+				self.handler.handle("hash_tree\n.\n\n1"))
+			self.assertEqual("'subdir1/subdir2' {}\n".format(subdir2), self.handler.handle("hash_tree\nsubdir1/subdir2/\n4.txt\n0"))
+			self.assertEqual("'morefiles' {}\n".format(crc("")), self.handler.handle("hash_tree\nmorefiles\n.lua\n0"))
+		with helpers.HashAlgorithm("blake2b"):
+			# A client using another algorithm gets a tree of its own.
+			self.assertEqual(32, len(self.handler.handle("hash_tree\n.\n\n1").split("\n")[0].split(" ")[1]))
+
+	def test_hash_tree_is_incremental(self):
+		import tempfile
+		import filewatch
+		from unittest import mock
+		with tempfile.TemporaryDirectory() as root:
+			root = os.path.realpath(root)
+			for path in ("a.lua", "src/b.lua", "lib/c.lua"):
+				os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+				with open(os.path.join(root, path), "w") as f:
+					f.write(path)
+			watchers = filewatch.WatcherPool(lingerTime=5)
+			handler = HashCommandHandler(root, watchers=watchers)
+			try:
+				with helpers.HashAlgorithm("crc32"):
+					before = dict(line.rsplit(" ", 1) for line in handler.hash_tree(root, "", 0)["Hashes"].splitlines())
+					time.sleep(.2)  # Give the watcher a moment to start.
+					with open(os.path.join(root, "src", "b.lua"), "w") as f:
+						f.write("changed")
+					with mock.patch.object(handler, "_Hashes", wraps=handler._Hashes) as hashes:
+						end_time = time.monotonic() + 2
+						while time.monotonic() < end_time:
+							after = dict(line.rsplit(" ", 1) for line in handler.hash_tree(root, "", 0)["Hashes"].splitlines())
+							if after != before:
+								break
+							time.sleep(.05)
+						# Only the changed file was hashed again.
+						self.assertEqual(hashes.call_count, 0)
+					self.assertNotEqual(before["''"], after["''"])
+					self.assertNotEqual(before["'src'"], after["'src'"])
+					self.assertEqual(before["'lib'"], after["'lib'"])
+			finally:
+				for watcher in list(watchers._Watchers.values()):
+					watcher.kill()
+
+	def test_parse_cancelled(self):
+		token = helpers.CancellationToken()
+		token.cancel()
+		with helpers.Cancellation(token):
+			self.assertRaises(helpers.Cancelled, self.handler.handle, "parse\n.\n0\nTrue")
+
+	def test_parse_since(self):
+		(generation, mode, changes) = self.handler.handle("parse_since\nmorefiles\n0").split("\n", 2)
+		self.assertEqual(mode, "full")
+		self.assertEqual(changes, "add 'morefiles/file2.txt' 0\nadd 'morefiles/file3.txt' 0\n")
+		time.sleep(.2)  # Give the watcher a moment to start.
+		with open(os.path.join(self.testdir, "morefiles", "file2.txt"), "w") as f:
+			f.write("")
+		end_time = time.monotonic() + 2
+		while time.monotonic() < end_time:
+			(next, mode, changes) = self.handler.handle("parse_since\nmorefiles\n{}".format(generation)).split("\n", 2)
+			if changes:
+				break
+			time.sleep(.05)
+		self.assertEqual(mode, "changes")
+		self.assertEqual(changes, "modify 'morefiles/file2.txt' 0\n")
+		self.assertGreater(int(next), int(generation))
+		# A generation the server has no history for gets a full listing.
+		self.assertEqual(self.handler.handle("parse_since\nmorefiles\n1").split("\n")[1], "full")
@@ -0,0 +1,277 @@
+"""
+A persistent cache of file content hashes.
+
+Every entry remembers the size, modification time & inode of the file at the time it was hashed. As long
+as a stat of the file still gives back the same values, the stored hash is reused and the file is never
+opened. The index is saved to disk so that it survives restarts of the server.
+"""
+
+import json
+import os
+import threading
+import time
+import unittest
+import commandhandler.helpers as helpers
+from logger import logger
+
+
+class HashIndex:
+	"""
+	Maps absolute file paths to the hash of their contents.
+
+	This also implements the filewatch.Callbacks interface so it can be subscribed to a file watcher; any
+	notification for a path drops the entries for that path.
+	"""
+	Version = 2
+	RacyWindow = 2 * 10**9  # Files modified this recently (in ns) are hashed, but not remembered.
+	SaveDelay = 5  # How long (in seconds) saveSoon waits, so a burst of parses only saves the index once.
+
+	def __init__(self, path = None):
+		"""
+		:param path: the file the index is persisted to. If None, the index only lives in memory.
+		"""
+		self._Path = path
+		self._Entries = {}  # A map of absolute path --> (size, mtime_ns, inode, algorithm, hash)
+		# The directories with entries within them, so a directory's entries can be found without looking at all
+		# of them: a map of directory --> the paths of its entries...
+		self._Files = {}
+		# ...& a map of directory --> the subdirectories of it which have entries within them.
+		self._Subdirectories = {}
+		self._Lock = threading.Lock()
+		self._Dirty = False
+		self._SaveTimer = None
+		self.Hits = 0  # How many hashes were answered from the index...
+		self.Misses = 0  # ...& how many needed the file to be read.
+		if path:
+			self.load()
+
+	def load(self):
+		"""
+		Reads the index from disk. A missing or unreadable index file leaves the index empty.
+		"""
+		try:
+			with open(self._Path, "r") as f:
+				data = json.loads(f.read())
+		except FileNotFoundError:
+			return
+		except Exception as e:
+			logger.warning("Discarding unreadable hash index {}: {}", self._Path, e)
+			return
+		if data.get("Version") != self.Version:
+			logger.info("Discarding hash index {} with version {}", self._Path, data.get("Version"))
+			return
+		with self._Lock:
+			self._Entries = {}
+			self._Files = {}
+			self._Subdirectories = {}
+			for (path, entry) in data.get("Entries", {}).items():
+				self._Set(path, tuple(entry))
+			self._Dirty = False
+		logger.info("Loaded {} entries from hash index {}", len(self._Entries), self._Path)
+
+	def _Set(self, path, entry):
+		if path not in self._Entries:
+			directory = os.path.dirname(path)
+			self._Files.setdefault(directory, set()).add(path)
+			# Note the directory within each of the directories it's within, until one already knows of it.
+			parent = os.path.dirname(directory)
+			while parent != directory:
+				subdirectories = self._Subdirectories.setdefault(parent, set())
+				if directory in subdirectories:
+					break
+				subdirectories.add(directory)
+				(directory, parent) = (parent, os.path.dirname(parent))
+		self._Entries[path] = entry
+
+	def _Pop(self, path):
+		"""
+		:return: whether the path had an entry.
+		"""
+		if self._Entries.pop(path, None) is None:
+			return False
+		directory = os.path.dirname(path)
+		files = self._Files[directory]
+		files.discard(path)
+		if not files:
+			del self._Files[directory]
+		# Forget the directories which no longer have anything within them.
+		parent = os.path.dirname(directory)
+		while parent != directory and directory not in self._Files and directory not in self._Subdirectories:
+			subdirectories = self._Subdirectories[parent]
+			subdirectories.discard(directory)
+			if subdirectories:
+				break
+			del self._Subdirectories[parent]
+			(directory, parent) = (parent, os.path.dirname(parent))
+		return True
+
+	def save(self):
+		"""
+		Writes the index to disk if anything changed since it was last loaded/saved.
+		"""
+		if not self._Path:
+			return
+		with self._Lock:
+			self._SaveTimer = None
+			if not self._Dirty:
+				return
+			data = {"Version": self.Version, "Entries": self._Entries}
+			contents = json.dumps(data)
+			self._Dirty = False
+		temp = self._Path + ".tmp"
+		try:
+			with open(temp, "w") as f:
+				f.write(contents)
+			os.replace(temp, self._Path)
+		except Exception as e:
+			logger.warning("Failed to save hash index {}: {}", self._Path, e)
+			with self._Lock:
+				self._Dirty = True
+
+	def saveSoon(self):
+		"""
+		Saves the index SaveDelay seconds from now, if anything has changed by then & a save isn't already due.
+		"""
+		if not self._Path:
+			return
+		with self._Lock:
+			if not self._Dirty or self._SaveTimer is not None:
+				return
+			self._SaveTimer = threading.Timer(self.SaveDelay, self.save)
+			self._SaveTimer.daemon = True
+			self._SaveTimer.start()
+
+	def hash(self, filepath, stat = None, algorithm = None):
+		"""
+		Gets the hash of a file, reading it only if it has changed since it was last hashed.
+		:param filepath: the absolute path to the file.
+		:param stat: the result of os.stat(filepath), if the caller already has it.
+		:param algorithm: the hash algorithm to use; defaults to helpers.CurrentHashAlgorithm().
+		:return: the hash of the file's contents.
+		"""
+		if stat is None:
+			stat = os.stat(filepath)
+		key = (stat.st_size, stat.st_mtime_ns, stat.st_ino, algorithm or helpers.CurrentHashAlgorithm())
+		with self._Lock:
+			entry = self._Entries.get(filepath)
+			if entry is not None and entry[0:4] == key:
+				self.Hits += 1
+				return entry[4]
+			self.Misses += 1
+		value = helpers.HashFile(filepath, key[3])
+		# A file modified within the racy window could be modified again without changing its mtime,
+		# so we can't trust a stat match for it later on.
+		with self._Lock:
+			if time.time_ns() - stat.st_mtime_ns > self.RacyWindow:
+				self._Set(filepath, key + (value,))
+				self._Dirty = True
+			elif self._Pop(filepath):
+				self._Dirty = True
+		return value
+
+	def invalidate(self, filepath):
+		"""
+		Forgets the hash of a file, or of every file within a directory. This never looks at the disk, and only
+		looks at the entries within a directory if it has any.
+		"""
+		with self._Lock:
+			if self._Pop(filepath):
+				self._Dirty = True
+				return
+			directories = [filepath]
+			paths = []
+			while directories:
+				directory = directories.pop()
+				paths.extend(self._Files.get(directory, ()))
+				directories.extend(self._Subdirectories.get(directory, ()))
+			for path in paths:
+				self._Pop(path)
+				self._Dirty = True
+
+	def __len__(self):
+		return len(self._Entries)
+
+	def registerMetrics(self, registry):
+		"""
+		Exposes the index's hit rate & size through a metrics.Registry.
+		"""
+		registry.counter("syncytowne_hash_cache_hits_total", "Hashes answered from the hash index.", function=lambda: self.Hits)
+		registry.counter("syncytowne_hash_cache_misses_total", "Hashes which needed the file to be read.", function=lambda: self.Misses)
+		registry.gauge("syncytowne_hash_cache_entries", "Files in the hash index.", function=lambda: len(self))
+
+	def onAdd(self, filename):
+		self.invalidate(filename)
+	def onDelete(self, filename):
+		self.invalidate(filename)
+	def onModify(self, filename):
+		self.invalidate(filename)
+	def onRename(self, old, new):
+		self.invalidate(old)
+		self.invalidate(new)
+
+class HashIndexTestCase(unittest.TestCase):
+	def setUp(self):
+		import tempfile
+		self.dir = tempfile.TemporaryDirectory()
+		self.file = os.path.join(self.dir.name, "file.txt")
+		self.writeFile("foobar")
+
+	def tearDown(self):
+		self.dir.cleanup()
+
+	def writeFile(self, contents):
+		with open(self.file, "w") as f:
+			f.write(contents)
+		# Push the modification time out of the racy window.
+		old = time.time() - 60
+		os.utime(self.file, (old, old))
+
+	def test_warm_hash_does_not_read(self):
+		from unittest import mock
+		index = HashIndex()
+		with mock.patch.object(helpers, "HashFile", wraps=helpers.HashFile) as hash:
+			self.assertEqual(index.hash(self.file), index.hash(self.file))
+			self.assertEqual(hash.call_count, 1)
+
+	def test_changed_file_is_rehashed(self):
+		index = HashIndex()
+		self.assertEqual("6", index.hash(self.file))
+		self.writeFile("foo")
+		self.assertEqual("3", index.hash(self.file))
+
+	def test_invalidate(self):
+		from unittest import mock
+		index = HashIndex()
+		index.hash(self.file)
+		index.invalidate(os.path.join(self.dir.name, "missing.txt"))
+		self.assertEqual(len(index), 1)
+		index.invalidate(os.path.dirname(self.dir.name))
+		self.assertEqual(len(index), 0)
+		self.assertEqual((index._Files, index._Subdirectories), ({}, {}))
+		with mock.patch.object(helpers, "HashFile", wraps=helpers.HashFile) as hash:
+			index.hash(self.file)
+			self.assertEqual(hash.call_count, 1)
+
+	def test_persistence(self):
+		path = os.path.join(self.dir.name, "index.json")
+		index = HashIndex(path)
+		index.hash(self.file)
+		index.save()
+		loaded = HashIndex(path)
+		self.assertEqual(len(loaded), 1)
+		loaded.invalidate(self.dir.name)
+		self.assertEqual(len(loaded), 0)
+
+	def test_save_soon(self):
+		from unittest import mock
+		path = os.path.join(self.dir.name, "index.json")
+		index = HashIndex(path)
+		index.SaveDelay = .1
+		with mock.patch.object(index, "save", wraps=index.save) as save:
+			index.saveSoon()  # Nothing has changed yet.
+			index.hash(self.file)
+			index.saveSoon()
+			index.saveSoon()
+			time.sleep(.3)
+			self.assertEqual(save.call_count, 1)
+		self.assertEqual(len(HashIndex(path)), 1)
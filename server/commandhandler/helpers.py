@@ -1,12 +1,206 @@
 import os
+import hashlib
+import itertools
+import stat
+import zlib
+import threading
+import contextlib
+import contextvars
 from logger import logger
 
-def Hash(s):
-	l = len([c for c in s if c != 10])
-	other = len([c for c in s if c == 10])
-	logger.debug("length: {} (excluded {} bytes)", l, other)
-	return str(l)
+HASH_CHUNK_SIZE = 64 * 1024  # Files are hashed this many bytes at a time.
 
+class LengthHasher:
+	"""
+	The original hash: the number of bytes which aren't newlines. Different contents of the same length
+	collide, so this is only used with clients which don't negotiate a better algorithm.
+	"""
+	def __init__(self):
+		self._Length = 0
+	def update(self, data):
+		self._Length += len(data) - data.count(b"\n")
+	def hexdigest(self):
+		return str(self._Length)
+
+class Crc32Hasher:
+	"""
+	CRC-32 (as computed by zlib). This is cheap enough for the plugin to compute in Lua.
+	"""
+	def __init__(self):
+		self._Crc = 0
+	def update(self, data):
+		self._Crc = zlib.crc32(data, self._Crc)
+	def hexdigest(self):
+		return "{:08x}".format(self._Crc)
+
+class NewlineNormalizingHasher:
+	"""
+	Wraps another hasher so that CRLF line endings are hashed as LF. Studio always uses LF, but files may
+	have been written with CRLF (e.g., by Python's text mode on Windows).
+	"""
+	def __init__(self, hasher):
+		self._Hasher = hasher
+		self._PendingCR = False
+	def update(self, data):
+		if self._PendingCR:
+			self._PendingCR = False
+			if data[0:1] != b"\n":
+				self._Hasher.update(b"\r")
+		if data.endswith(b"\r"):
+			# This may be the first half of a CRLF split across two chunks.
+			self._PendingCR = True
+			data = data[:-1]
+		if data.find(b"\r") != -1:
+			data = data.replace(b"\r\n", b"\n")
+		self._Hasher.update(data)
+	def hexdigest(self):
+		if self._PendingCR:
+			self._PendingCR = False
+			self._Hasher.update(b"\r")
+		return self._Hasher.hexdigest()
+
+# A map of algorithm name --> function which creates a hasher. A hasher has update(bytes) & hexdigest().
+HASH_ALGORITHMS = {
+	"length": LengthHasher,
+	"crc32": lambda: NewlineNormalizingHasher(Crc32Hasher()),
+	"blake2b": lambda: NewlineNormalizingHasher(hashlib.blake2b(digest_size=16)),
+}
+
+def Hash(s, algorithm = None):
+	"""
+	Hashes a string or bytes-like object.
+	:param s: the contents to hash. Strings are hashed as UTF-8, except by the "length" algorithm, which
+		(for compatibility) counts every character of a string.
+	:param algorithm: the name of the algorithm to use; defaults to CurrentHashAlgorithm().
+	"""
+	algorithm = algorithm or _CurrentHashAlgorithm.get()
+	if isinstance(s, str):
+		if algorithm == "length":
+			return str(len(s))
+		s = s.encode("utf-8")
+	hasher = HASH_ALGORITHMS[algorithm]()
+	if isinstance(s, (bytes, bytearray)):
+		hasher.update(s)
+	else:
+		# The hashers need bytes' methods, so anything else (e.g., a memoryview of a request) is hashed a chunk at
+		# a time rather than copied whole.
+		view = memoryview(s).cast("B")
+		for start in range(0, len(view), HASH_CHUNK_SIZE):
+			hasher.update(bytes(view[start:start + HASH_CHUNK_SIZE]))
+	return hasher.hexdigest()
+
+def HashFile(filepath, algorithm = None):
+	"""
+	Hashes the contents of a file without reading the whole thing into memory.
+	:param filepath: the path to the file.
+	:param algorithm: the name of the algorithm to use; defaults to CurrentHashAlgorithm().
+	"""
+	hasher = HASH_ALGORITHMS[algorithm or _CurrentHashAlgorithm.get()]()
+	buffer = bytearray(HASH_CHUNK_SIZE)
+	with open(filepath, 'rb') as file:
+		while True:
+			n = file.readinto(buffer)
+			if not n:
+				break
+			hasher.update(buffer if n == len(buffer) else buffer[:n])
+	return hasher.hexdigest()
+
+
+def RawPayload(function):
+	"""
+	Marks a command handler as taking its "*" argument as a memoryview of the request's bytes rather than as a
+	string. This saves decoding (& copying) large payloads, and lets them hold data which isn't UTF-8.
+	"""
+	function.RawPayload = True
+	return function
+
+class Cacheable:
+	"""
+	A streamed response (or the streamed part of one) which is the same whenever its CacheKey is, so what's made of
+	it (e.g., its compressed form) may be cached under that key.
+	"""
+	def __init__(self, pieces, key):
+		"""
+		:param pieces: an iterator of strings.
+		:param key: a hashable value which changes whenever the pieces would.
+		"""
+		self._Pieces = pieces
+		self.CacheKey = key
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		return next(self._Pieces)
+
+	def close(self):
+		if hasattr(self._Pieces, "close"):
+			self._Pieces.close()
+
+def WriteFile(filepath, contents, sync = False):
+	"""
+	Replaces a file with a string (as UTF-8, with the platform's line endings), or with a bytes-like object byte
+	for byte, without copying it.
+
+	The contents are written to a hidden temporary file next to the target, which is then renamed over it, so
+	anyone reading the file sees either the old contents or the new, never half of each.
+	:param sync: whether to fsync the contents before the rename. The rename itself is only durable once the
+		directory has been synced too; see SyncDirectory.
+	"""
+	(directory, name) = os.path.split(filepath)
+	temporary = os.path.join(directory, ".{}.{}.{}.tmp".format(name, os.getpid(), next(_TemporaryNames)))
+	# The file is created the way open() would create it (i.e., subject to the umask).
+	fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o666)
+	try:
+		if isinstance(contents, str):
+			f = open(fd, "w", encoding="utf-8")
+		else:
+			# Raw payloads may be binary, so they're never newline-translated.
+			f = open(fd, "wb")
+		with f:
+			f.write(contents)
+			if sync:
+				f.flush()
+				os.fsync(f.fileno())
+		try:
+			os.chmod(temporary, stat.S_IMODE(os.stat(filepath).st_mode))
+		except FileNotFoundError:
+			pass
+		os.replace(temporary, filepath)
+	except BaseException:
+		try:
+			os.remove(temporary)
+		except OSError:
+			pass
+		raise
+
+_TemporaryNames = itertools.count()
+
+def SyncFile(filepath):
+	"""
+	Flushes whatever has been written to a file to the disk.
+	"""
+	fd = os.open(filepath, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+def SyncDirectory(directory):
+	"""
+	Makes the files which were created in (or renamed into) a directory durable. Does nothing where directories
+	can't be synced (i.e., on Windows, where renames don't need it).
+	"""
+	try:
+		fd = os.open(directory, os.O_RDONLY)
+	except OSError:
+		return
+	try:
+		os.fsync(fd)
+	except OSError:
+		pass
+	finally:
+		os.close(fd)
 
 def RelativeToAbsoluteFilePath(rel_path, root):
 	"""
@@ -26,3 +220,100 @@ def AbsoluteToRelativeFilePath(filepath, root):
 	relative = '/'.join(relative.split(os.sep))
 	logger.debug("Filepath {} relative to root {} is {}", filepath, root, relative)
 	return relative
+
+
+class Cancelled(Exception):
+	"""
+	Raised inside a command handler when the client which made the request has gone away.
+	"""
+
+class CancellationToken:
+	"""
+	Tells long-running work that its result is no longer wanted.
+	"""
+	def __init__(self):
+		self._Event = threading.Event()
+
+	def cancel(self):
+		self._Event.set()
+
+	@property
+	def Cancelled(self):
+		return self._Event.is_set()
+
+	def check(self):
+		"""
+		Raises Cancelled if this token has been cancelled.
+		"""
+		if self._Event.is_set():
+			raise Cancelled()
+
+# The token for the request currently being handled. By default, it is never cancelled.
+_CurrentCancellationToken = contextvars.ContextVar("CancellationToken", default=CancellationToken())
+
+def CurrentCancellationToken():
+	"""
+	Gets the cancellation token of the request being handled on this thread.
+	"""
+	return _CurrentCancellationToken.get()
+
+@contextlib.contextmanager
+def Cancellation(token):
+	"""
+	Makes token the CurrentCancellationToken for the duration of a with block.
+	"""
+	reset = _CurrentCancellationToken.set(token)
+	try:
+		yield token
+	finally:
+		_CurrentCancellationToken.reset(reset)
+
+# The header a client names its watch session in, so it isn't told about changes it made itself.
+SESSION_HEADER = "X-SyncyTowne-Session"
+
+# The watch session the request currently being handled was made on behalf of, if any.
+_CurrentOrigin = contextvars.ContextVar("Origin", default=None)
+
+def CurrentOrigin():
+	"""
+	Gets the watch session the request being handled on this thread was made on behalf of, or None.
+	"""
+	return _CurrentOrigin.get()
+
+@contextlib.contextmanager
+def Origin(session):
+	"""
+	Makes session the CurrentOrigin for the duration of a with block.
+	:param session: the value of the request's SESSION_HEADER, or None.
+	"""
+	reset = _CurrentOrigin.set(session or None)
+	try:
+		yield session
+	finally:
+		_CurrentOrigin.reset(reset)
+
+# The header a client names the hash algorithm it agreed upon (see hash_algorithm) in. The server keeps no record
+# of the agreement, so clients which agreed upon different algorithms can share it.
+HASH_ALGORITHM_HEADER = "X-SyncyTowne-Hash-Algorithm"
+
+# The hash algorithm of the request currently being handled. Clients which don't name one use "length".
+_CurrentHashAlgorithm = contextvars.ContextVar("HashAlgorithm", default="length")
+
+def CurrentHashAlgorithm():
+	"""
+	Gets the hash algorithm of the request being handled on this thread.
+	"""
+	return _CurrentHashAlgorithm.get()
+
+@contextlib.contextmanager
+def HashAlgorithm(name):
+	"""
+	Makes name the CurrentHashAlgorithm for the duration of a with block.
+	:param name: the value of the request's HASH_ALGORITHM_HEADER, or None. An algorithm the server doesn't know
+		is treated as "length", as it is by servers which predate the header.
+	"""
+	reset = _CurrentHashAlgorithm.set(name if name in HASH_ALGORITHMS else "length")
+	try:
+		yield name
+	finally:
+		_CurrentHashAlgorithm.reset(reset)
@@ -0,0 +1,319 @@
+"""
+Rules for which files the server keeps to itself.
+
+The rules are read from a .syncignore file in the root directory, which uses the same syntax as a .gitignore:
+	# a comment
+	node_modules/     a directory called node_modules, wherever it is
+	/build            build (a file or a directory) in the root only
+	*.log             any file ending in .log
+	docs/**/*.md      any .md file anywhere within docs
+	!keep.log         an exception to an earlier rule
+Anything a rule matches is left out of parse & file watching. An ignored directory is never descended into, so
+(as with git) a rule can't bring back a file within a directory that's ignored.
+"""
+
+import os
+import re
+import threading
+import time
+import unittest
+import filewatch
+from logger import logger
+
+FILENAME = ".syncignore"
+
+def _Translate(pattern):
+	"""
+	Converts the glob of a rule into a regular expression which matches a whole path relative to the root.
+	:param pattern: the glob, without any leading "!" or trailing "/".
+	"""
+	# A glob with a slash in it is relative to the root; otherwise it matches a name at any level.
+	anchored = "/" in pattern
+	if pattern[0:1] == "/":
+		pattern = pattern[1:]
+	regex = "" if anchored else "(?:.*/)?"
+	i = 0
+	while i < len(pattern):
+		c = pattern[i]
+		if pattern.startswith("**", i) and (i == 0 or pattern[i - 1] == "/"):
+			if pattern.startswith("/", i + 2):
+				regex += "(?:.*/)?"  # "**/" matches zero or more directories.
+				i += 3
+				continue
+			if i + 2 == len(pattern):
+				regex += ".*"  # A trailing "/**" matches everything within.
+				i += 2
+				continue
+		if c == "*":
+			while pattern.startswith("*", i + 1):
+				i += 1
+			regex += "[^/]*"
+		elif c == "?":
+			regex += "[^/]"
+		elif c == "[":
+			negated = pattern[i + 1:i + 2] in ("!", "^")
+			start = i + 2 if negated else i + 1
+			# A "]" straight after the "[" (or "[!") is part of the class rather than its end.
+			end = pattern.find("]", start + 1)
+			if end < 0:
+				regex += re.escape(c)  # An unclosed (or empty) "[" is just a "[".
+			else:
+				contents = pattern[start:end].replace("\\", "\\\\").replace("[", "\\[").replace("]", "\\]")
+				regex += "[" + ("^" if negated else "") + contents + "]"
+				i = end
+		elif c == "\\" and i + 1 < len(pattern):
+			i += 1
+			regex += re.escape(pattern[i])
+		else:
+			regex += re.escape(c)
+		i += 1
+	return regex
+
+def _Parse(line):
+	"""
+	:return: a (regex, negated, directoryOnly) tuple, or None if the line isn't a rule.
+	"""
+	line = line.rstrip("\r\n")
+	# Trailing spaces are dropped unless they're escaped.
+	stripped = line.rstrip(" ")
+	if stripped.endswith("\\") and len(stripped) < len(line):
+		stripped += " "
+	line = stripped
+	if not line or line[0] == "#":
+		return None
+	negated = line[0] == "!"
+	if negated:
+		line = line[1:]
+	elif line[0] == "\\":
+		line = line[1:]  # "\!" & "\#" start a glob with a literal "!" or "#".
+	directoryOnly = line.endswith("/")
+	line = line.rstrip("/")
+	if not line:
+		return None
+	return (_Translate(line), negated, directoryOnly)
+
+class IgnoreRules:
+	"""
+	A compiled set of rules. Paths are relative to the root and separated by "/".
+	"""
+	def __init__(self, lines = ()):
+		self._Rules = []  # (regex, compiled regex, negated, directoryOnly) for each rule.
+		for line in lines:
+			rule = _Parse(line)
+			if rule is None:
+				continue
+			(regex, negated, directoryOnly) = rule
+			# A rule which doesn't make sense (e.g., "[z-a]") is skipped rather than taking every other rule with it.
+			try:
+				compiled = re.compile(regex, re.DOTALL)
+			except re.error as e:
+				logger.warning("Skipping malformed {} rule {!r}: {}", FILENAME, line.rstrip("\r\n"), e)
+				continue
+			self._Rules.append((regex, compiled, negated, directoryOnly))
+		self._Negated = any(negated for (regex, compiled, negated, directoryOnly) in self._Rules)
+		if self._Negated:
+			# The last rule which matches a path decides whether it's ignored, so each must be tried in turn.
+			self._Ordered = [(compiled, negated, directoryOnly) for (regex, compiled, negated, directoryOnly) in reversed(self._Rules)]
+		else:
+			# Without exceptions, a path is ignored if any rule matches it, so they can all be tried at once.
+			self._Files = self._Combine([regex for (regex, compiled, negated, directoryOnly) in self._Rules if not directoryOnly])
+			self._Directories = self._Combine([regex for (regex, compiled, negated, directoryOnly) in self._Rules])
+
+	@staticmethod
+	def _Combine(regexes):
+		if not regexes:
+			return None
+		return re.compile("|".join("(?:{})".format(regex) for regex in regexes), re.DOTALL)
+
+	def __bool__(self):
+		return len(self._Rules) > 0
+
+	def ignored(self, path, isDirectory):
+		"""
+		Checks a path against the rules, without regard to the directories it's within.
+		:param isDirectory: whether the path is a directory, or None if that isn't known (e.g., it's been deleted),
+			in which case the path is ignored if it would be either way.
+		"""
+		if isDirectory is None:
+			return self.ignored(path, False) or self.ignored(path, True)
+		if not self._Negated:
+			regex = self._Directories if isDirectory else self._Files
+			return regex is not None and regex.fullmatch(path) is not None
+		for (regex, negated, directoryOnly) in self._Ordered:
+			if (isDirectory or not directoryOnly) and regex.fullmatch(path):
+				return not negated
+		return False
+
+	def ignoredWithin(self, path, isDirectory = None):
+		"""
+		Checks whether a path, or any directory it's within, is ignored.
+		"""
+		if not self._Rules:
+			return False
+		parts = path.split("/")
+		for i in range(1, len(parts)):
+			if self.ignored("/".join(parts[:i]), True):
+				return True
+		return self.ignored(path, isDirectory)
+
+class IgnoreFile:
+	"""
+	The rules in a root's .syncignore. The file is compiled when it's first needed & again whenever it changes.
+	"""
+	def __init__(self, root, filename = FILENAME):
+		self.Path = os.path.join(root, filename)
+		self._Signature = None
+		self._Rules = IgnoreRules()
+		self._Lock = threading.Lock()
+
+	def rules(self):
+		"""
+		:return: the current IgnoreRules.
+		"""
+		try:
+			info = os.stat(self.Path)
+			signature = (info.st_size, info.st_mtime_ns, info.st_ino)
+		except OSError:
+			signature = None
+		with self._Lock:
+			if signature != self._Signature:
+				self._Rules = self._Load() if signature is not None else IgnoreRules()
+				self._Signature = signature
+			return self._Rules
+
+	def _Load(self):
+		try:
+			with open(self.Path, "r", encoding="utf-8", errors="replace") as f:
+				return IgnoreRules(f.readlines())
+		except OSError:
+			return IgnoreRules()
+
+class IgnoreFilter(filewatch.Filter):
+	"""
+	A file watcher filter which rejects hidden & ignored files, so the watchers never descend into a .git,
+	node_modules or excluded directory.
+	"""
+	RulesInterval = 1  # How often (in seconds) the .syncignore is checked for changes while filtering.
+
+	def __init__(self, root, ignoreFile):
+		"""
+		:param root: the directory which the rules are relative to.
+		:param ignoreFile: the IgnoreFile for the root.
+		"""
+		self._Prefix = os.path.join(root, "")
+		self._IgnoreFile = ignoreFile
+		self._Rules = ignoreFile.rules()
+		self._CheckedAt = time.monotonic()
+
+	def version(self):
+		self._Rules = self._IgnoreFile.rules()
+		self._CheckedAt = time.monotonic()
+		return self._Rules
+
+	def _CurrentRules(self):
+		if time.monotonic() - self._CheckedAt >= self.RulesInterval:
+			return self.version()
+		return self._Rules
+
+	def __call__(self, filename):
+		if not filename.startswith(self._Prefix):
+			return True
+		path = filename[len(self._Prefix):].replace(os.sep, "/")
+		if any(part.startswith(".") for part in path.split("/")):
+			return False
+		rules = self._CurrentRules()
+		if not rules:
+			return True
+		asFile = rules.ignoredWithin(path, False)
+		asDirectory = rules.ignoredWithin(path, True)
+		if asFile == asDirectory:
+			return not asFile
+		return not rules.ignoredWithin(path, os.path.isdir(filename))
+
+class IgnoreRulesTestCase(unittest.TestCase):
+	def test_names(self):
+		rules = IgnoreRules(["# a comment", "", "node_modules/", "*.log"])
+		self.assertTrue(rules.ignored("node_modules", True))
+		self.assertTrue(rules.ignored("a/b/node_modules", True))
+		self.assertFalse(rules.ignored("node_modules", False))
+		self.assertTrue(rules.ignored("out.log", False))
+		self.assertTrue(rules.ignored("logs/out.log", False))
+		self.assertFalse(rules.ignored("out.log.txt", False))
+		self.assertFalse(rules.ignored("# a comment", False))
+
+	def test_anchored(self):
+		rules = IgnoreRules(["/build", "docs/*.md", "a/**/b", "src/**"])
+		self.assertTrue(rules.ignored("build", True))
+		self.assertFalse(rules.ignored("sub/build", True))
+		self.assertTrue(rules.ignored("docs/readme.md", False))
+		self.assertFalse(rules.ignored("docs/sub/readme.md", False))
+		self.assertTrue(rules.ignored("a/b", False))
+		self.assertTrue(rules.ignored("a/x/y/b", False))
+		self.assertTrue(rules.ignored("src/x/y.lua", False))
+		self.assertFalse(rules.ignored("src", True))
+
+	def test_negation(self):
+		rules = IgnoreRules(["*.log", "!keep.log", "[!a]?.txt"])
+		self.assertTrue(rules.ignored("out.log", False))
+		self.assertFalse(rules.ignored("keep.log", False))
+		self.assertTrue(rules.ignored("bc.txt", False))
+		self.assertFalse(rules.ignored("ac.txt", False))
+
+	def test_malformed(self):
+		rules = IgnoreRules(["a[]b", "[z-a].lua", "[]]", "x[!]y]", "*.log"])
+		# An empty "[" is a literal...
+		self.assertTrue(rules.ignored("a[]b", False))
+		# ...a "]" first in a class is part of it...
+		self.assertTrue(rules.ignored("]", False))
+		self.assertTrue(rules.ignored("xz", False))
+		self.assertFalse(rules.ignored("x]", False))
+		# ...& a rule which can't be compiled is skipped, leaving the rest.
+		self.assertFalse(rules.ignored("b.lua", False))
+		self.assertTrue(rules.ignored("out.log", False))
+		self.assertTrue(IgnoreRules(["!a[]b", "[z-a].lua", "*.log"]).ignored("out.log", False))
+
+	def test_within(self):
+		rules = IgnoreRules(["build/"])
+		self.assertTrue(rules.ignoredWithin("src/build/out.lua"))
+		self.assertFalse(rules.ignoredWithin("src/build", False))
+		self.assertTrue(rules.ignoredWithin("src/build", True))
+		self.assertFalse(IgnoreRules().ignoredWithin("src/build/out.lua"))
+
+	def test_file_is_reloaded(self):
+		import tempfile
+		with tempfile.TemporaryDirectory() as root:
+			ignoreFile = IgnoreFile(root)
+			self.assertFalse(ignoreFile.rules())
+			with open(os.path.join(root, FILENAME), "w") as f:
+				f.write("*.log\n")
+			self.assertTrue(ignoreFile.rules().ignored("out.log", False))
+			self.assertIs(ignoreFile.rules(), ignoreFile.rules())
+			with open(os.path.join(root, FILENAME), "w") as f:
+				f.write("*.txt\n*.md\n")
+			self.assertFalse(ignoreFile.rules().ignored("out.log", False))
+			self.assertTrue(ignoreFile.rules().ignored("out.md", False))
+
+	def test_filter(self):
+		import tempfile
+		with tempfile.TemporaryDirectory() as root:
+			with open(os.path.join(root, FILENAME), "w") as f:
+				f.write("node_modules/\nbuild/\n*.log\n")
+			with open(os.path.join(root, "build"), "w") as f:
+				f.write("not a directory")
+			os.mkdir(os.path.join(root, "node_modules"))
+			filter = IgnoreFilter(root, IgnoreFile(root))
+			self.assertTrue(filter(os.path.join(root, "src", "main.lua")))
+			self.assertFalse(filter(os.path.join(root, ".git")))
+			self.assertFalse(filter(os.path.join(root, "src", ".hidden", "main.lua")))
+			self.assertFalse(filter(os.path.join(root, "node_modules")))
+			self.assertFalse(filter(os.path.join(root, "src", "node_modules", "x.js")))
+			self.assertFalse(filter(os.path.join(root, "out.log")))
+			# The "build/" rule only applies to directories.
+			self.assertTrue(filter(os.path.join(root, "build")))
+			# Only the path within the root is checked.
+			self.assertTrue(filter(os.path.join(root, "src")))
+			version = filter.version()
+			with open(os.path.join(root, FILENAME), "w") as f:
+				f.write("src/\n")
+			self.assertIsNot(filter.version(), version)
+			self.assertFalse(filter(os.path.join(root, "src", "main.lua")))
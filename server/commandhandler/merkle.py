@@ -0,0 +1,152 @@
+"""
+Aggregate hashes of directory trees.
+
+The digest of a directory hashes a listing of what's directly within it, sorted by name:
+	<name> <hash>\n       for each file
+	<name>/ <digest>\n    for each subdirectory
+using the agreed hash algorithm. Directories with no files anywhere within them are left out of their parent's
+listing. Two trees have the same digest when (barring collisions) they hold the same files with the same
+contents, so a client can compare the digests of its own directories against the server's & only descend into
+the ones which differ.
+"""
+
+import unittest
+import commandhandler.helpers as helpers
+
+class _Directory:
+	__slots__ = ("Files", "Directories", "Digest")
+
+	def __init__(self):
+		self.Files = {}  # A map of name --> hash
+		self.Directories = {}  # A map of name --> _Directory
+		self.Digest = None  # None until it's computed & whenever anything within the directory changes.
+
+class MerkleTree:
+	"""
+	The files within a directory & the digests of every directory within it. Paths are relative to the tree's
+	directory and separated by "/".
+
+	Changing a file only invalidates the digests of the directories it's within; they're recomputed (from the
+	digests of their subdirectories which didn't change) the next time they're needed. A tree isn't thread safe;
+	whoever owns it must serialize access.
+	"""
+	def __init__(self, algorithm = None):
+		"""
+		:param algorithm: the hash algorithm every file hash & digest is in; defaults to
+			helpers.CurrentHashAlgorithm().
+		"""
+		self.Algorithm = algorithm or helpers.CurrentHashAlgorithm()
+		self._Root = _Directory()
+
+	def _Find(self, parts, create = False):
+		"""
+		:return: the directory at a path (given as a list of names), or None if there isn't one. Every directory
+			along the way has its digest invalidated if create is True.
+		"""
+		directory = self._Root
+		if create:
+			directory.Digest = None
+		for name in parts:
+			child = directory.Directories.get(name)
+			if child is None:
+				if not create:
+					return None
+				directory.Files.pop(name, None)  # A file which has been replaced by a directory.
+				child = directory.Directories[name] = _Directory()
+			if create:
+				child.Digest = None
+			directory = child
+		return directory
+
+	def set(self, path, hash):
+		"""
+		Adds a file to the tree, or changes its hash.
+		"""
+		parts = path.split("/")
+		directory = self._Find(parts[:-1], True)
+		directory.Directories.pop(parts[-1], None)
+		directory.Files[parts[-1]] = hash
+
+	def remove(self, path):
+		"""
+		Removes a file or directory from the tree, along with any directories this leaves empty.
+		"""
+		parts = path.split("/")
+		directories = [self._Root]
+		for name in parts[:-1]:
+			directories.append(directories[-1].Directories.get(name))
+			if directories[-1] is None:
+				return
+		parent = directories[-1]
+		if parent.Files.pop(parts[-1], None) is None and parent.Directories.pop(parts[-1], None) is None:
+			return
+		for directory in directories:
+			directory.Digest = None
+		# Prune whatever directories are now empty, deepest first.
+		for i in range(len(directories) - 1, 0, -1):
+			if directories[i].Files or directories[i].Directories:
+				break
+			del directories[i - 1].Directories[parts[i - 1]]
+
+	def _Digest(self, directory):
+		if directory.Digest is None:
+			entries = [(name, "{} {}\n".format(name, hash)) for (name, hash) in directory.Files.items()]
+			entries.extend((name, "{}/ {}\n".format(name, self._Digest(child))) for (name, child) in directory.Directories.items())
+			entries.sort()
+			directory.Digest = helpers.Hash("".join(line for (name, line) in entries), self.Algorithm)
+		return directory.Digest
+
+	def digests(self, path = "", depth = 0):
+		"""
+		Generates the digest of a directory & of the directories within it.
+		:param path: the directory to start at; "" is the tree's own directory.
+		:param depth: how many levels of subdirectories to include; 0 means no limit.
+		:return: an iterator of (path, digest) tuples, sorted by path, where a directory comes before the
+			directories within it. Nothing is generated if the directory has no files within it (unless it's the
+			tree's own directory).
+		"""
+		directory = self._Find(path.split("/") if path else [])
+		if directory is None:
+			return
+		stack = [(path, directory, 0)]
+		while stack:
+			(path, directory, level) = stack.pop()
+			yield (path, self._Digest(directory))
+			if depth == 0 or level < depth:
+				prefix = path + "/" if path else ""
+				stack.extend((prefix + name, directory.Directories[name], level + 1) for name in sorted(directory.Directories, reverse=True))
+
+class MerkleTreeTestCase(unittest.TestCase):
+	def setUp(self):
+		self.tree = MerkleTree("crc32")
+		for path in ("a.lua", "src/b.lua", "src/sub/c.lua"):
+			self.tree.set(path, helpers.Hash(path, "crc32"))
+
+	def test_digest(self):
+		sub = helpers.Hash("c.lua {}\n".format(helpers.Hash("src/sub/c.lua", "crc32")), "crc32")
+		src = helpers.Hash("b.lua {}\nsub/ {}\n".format(helpers.Hash("src/b.lua", "crc32"), sub), "crc32")
+		root = helpers.Hash("a.lua {}\nsrc/ {}\n".format(helpers.Hash("a.lua", "crc32"), src), "crc32")
+		self.assertEqual(list(self.tree.digests()), [("", root), ("src", src), ("src/sub", sub)])
+		self.assertEqual(list(self.tree.digests(depth=1)), [("", root), ("src", src)])
+		self.assertEqual(list(self.tree.digests("src/sub")), [("src/sub", sub)])
+		self.assertEqual(list(self.tree.digests("missing")), [])
+
+	def test_change(self):
+		before = dict(self.tree.digests())
+		self.tree.set("src/b.lua", "0")
+		after = dict(self.tree.digests())
+		self.assertNotEqual(before[""], after[""])
+		self.assertNotEqual(before["src"], after["src"])
+		self.assertEqual(before["src/sub"], after["src/sub"])
+		self.tree.set("src/b.lua", helpers.Hash("src/b.lua", "crc32"))
+		self.assertEqual(before, dict(self.tree.digests()))
+
+	def test_remove(self):
+		before = dict(self.tree.digests())
+		self.tree.set("src/sub/d/e.lua", "0")
+		self.tree.remove("src/sub/d/e.lua")
+		self.assertEqual(before, dict(self.tree.digests()))
+		self.tree.remove("src/sub/c.lua")
+		self.assertEqual(list(self.tree.digests("src", 1))[1:], [])
+		self.tree.remove("src")
+		self.assertEqual([path for (path, digest) in self.tree.digests()], [""])
@@ -1,25 +1,638 @@
+import collections
+import concurrent.futures
+import contextvars
 import os
+import re
+import threading
+import time
+import unittest
+import commandhandler.helpers as helpers
+from logger import logger
+from . import delta
+from .commandvalidator import HttpException, validate_incoming_file
+
+class WriteBehindQueue:
+	"""
+	Writes files on a thread of its own, so a write can be acknowledged before it reaches the disk.
+
+	A file which is written again before its last write was made only gets written once, with the latest
+	contents. Files are otherwise written in the order they were queued.
+	"""
+	Delay = .05  # How long (in seconds) to wait for more writes before writing out what's queued.
+	MaxPendingBytes = 64 * 1024 * 1024  # Queueing a write waits while this much is waiting to be written.
+	MaxErrors = 1000  # How many failed writes are kept for flush to report; older ones are only logged.
+
+	def __init__(self, write, sync = False):
+		"""
+		:param write: called with (path, contents) to write a file.
+		:param sync: whether to sync the directories of each batch of files once they've been written.
+		"""
+		self._Write = write
+		self._Sync = sync
+		self._Pending = collections.OrderedDict()  # A map of path --> contents, in the order they were written.
+		self._PendingBytes = 0
+		self._Writing = {}  # The batch being written: a map of path --> contents.
+		self._Errors = collections.deque()  # (path, message) for each write which failed since the last flush.
+		self._Flushing = 0  # How many flushes are waiting on us.
+		self._Condition = threading.Condition()
+		self._Thread = None
+		self._Closed = False
+
+	def put(self, path, contents):
+		"""
+		Queues a write.
+		:param contents: a string or bytes-like object. The contents are copied, as the write outlives the request.
+		"""
+		if not isinstance(contents, str):
+			contents = bytes(contents)
+		with self._Condition:
+			while self._PendingBytes > self.MaxPendingBytes and not self._Closed:
+				self._Condition.wait()
+			previous = self._Pending.pop(path, None)
+			if previous is not None:
+				self._PendingBytes -= len(previous)
+			self._Pending[path] = contents
+			self._PendingBytes += len(contents)
+			if self._Thread is None:
+				self._Thread = threading.Thread(target=self._Run, name="WriteBehind", daemon=True)
+				self._Thread.start()
+			self._Condition.notify_all()
+
+	def get(self, path):
+		"""
+		:return: the contents of the path's queued (or in progress) write, or None if there isn't one.
+		"""
+		with self._Condition:
+			contents = self._Pending.get(path)
+			return contents if contents is not None else self._Writing.get(path)
+
+	def discard(self, path):
+		"""
+		Drops the queued write to a path, waiting for the write to finish if it's already being made.
+		:return: True if a write to the path was queued.
+		"""
+		with self._Condition:
+			contents = self._Pending.pop(path, None)
+			if contents is not None:
+				self._PendingBytes -= len(contents)
+				self._Condition.notify_all()
+			while path in self._Writing:
+				self._Condition.wait()
+			return contents is not None
+
+	def flush(self):
+		"""
+		Waits for every write queued so far to be made.
+		:return: a list of (path, message) tuples describing each write which failed since the last flush.
+		"""
+		with self._Condition:
+			self._Flushing += 1
+			self._Condition.notify_all()
+			try:
+				while self._Pending or self._Writing:
+					self._Condition.wait()
+			finally:
+				self._Flushing -= 1
+			(errors, self._Errors) = (list(self._Errors), collections.deque())
+			return errors
+
+	def close(self):
+		"""
+		Writes out whatever is queued & stops the thread.
+		"""
+		errors = self.flush()
+		for (path, message) in errors:
+			logger.error("Write to {} was lost: {}", path, message)
+		with self._Condition:
+			self._Closed = True
+			self._Condition.notify_all()
+
+	def _Run(self):
+		while True:
+			with self._Condition:
+				while not self._Pending and not self._Closed:
+					self._Condition.wait()
+				if not self._Pending:
+					return
+				# Give a burst of writes (e.g., an editor saving the same file repeatedly) a moment to coalesce.
+				end_time = time.monotonic() + self.Delay
+				while not self._Flushing and not self._Closed and time.monotonic() < end_time:
+					self._Condition.wait(end_time - time.monotonic())
+				batch = list(self._Pending.items())
+				self._Pending.clear()
+				self._PendingBytes = 0
+				self._Writing = dict(batch)
+				self._Condition.notify_all()
+			errors = []
+			directories = set()
+			for (path, contents) in batch:
+				try:
+					self._Write(path, contents)
+					directories.add(os.path.dirname(path))
+				except Exception as e:
+					logger.warning("Write to {} failed: {}: {}", path, e.__class__.__name__, e)
+					errors.append((path, "{}: {}".format(e.__class__.__name__, str(e))))
+			if self._Sync:
+				for directory in directories:
+					helpers.SyncDirectory(directory)
+			with self._Condition:
+				self._Writing = {}
+				self._Errors.extend(errors)
+				while len(self._Errors) > self.MaxErrors:
+					(path, message) = self._Errors.popleft()
+					logger.error("Write to {} was lost, & no flush was made to report it: {}", path, message)
+				self._Condition.notify_all()
 
 class RWCommandHandler:
 	"""
 	Handles the read/write commands.
+
+	read_many & write_many move many files in one request. Each file in their payloads is framed as:
+		<path>\n<length>\n<contents>
+	and each file in their responses as:
+		<path>\n<status>\n<length>\n<contents>
+	where <length> is the size of <contents> in bytes when encoded as UTF-8 and <status> is "ok" or "error".
+	For an error, <contents> is the error message; a successful write has no contents.
+
+	Files are written atomically (see helpers.WriteFile). With write-behind on, writes are acknowledged as soon
+	as they're queued; reads still see them straight away, and flush waits for them to be made.
+
+	read_delta & write_delta move only what changed since a version of the file the client & server both have,
+	which is named by its hash. Once a client has used them, the server keeps the versions it recently read or
+	wrote in a blob store.
 	"""
+	STREAM_THRESHOLD = 1024 * 1024  # Files at least this many bytes are streamed to the client.
+	STREAM_CHUNK_SIZE = 64 * 1024
+	MaxPendingPerWorker = 4  # How many files read_many may have queued for each worker.
+	MaxUnsynced = 4096  # How many written files may wait for a flush to sync them before they're synced anyway.
+
+	def __init__(self, hashIndex = None, root = None, workers = None, sync = False, writeBehind = False, echoes = None, blobs = None):
+		"""
+		:param hashIndex: a HashIndex which is told about every file this handler changes.
+		:param root: the directory which paths in read_many/write_many are relative to.
+		:param workers: the number of threads read_many/write_many do disk I/O on; by default files are
+			read/written one after another.
+		:param sync: whether every write is made durable before it's acknowledged. Otherwise, only flush makes
+			writes durable.
+		:param writeBehind: whether writes are queued & made on a thread of their own (see WriteBehindQueue).
+		:param echoes: an echo.EchoSuppressor which is told about every change a watch session makes.
+		:param blobs: a blobstore.BlobStore which keeps the contents of the files read & written, as bases for
+			read_delta & write_delta. Without one, there are never any bases.
+		"""
+		self.hashIndex = hashIndex
+		self.root = root
+		self.workers = workers or 1
+		self.sync = sync
+		self.echoes = echoes
+		self.blobs = blobs
+		self._DeltasUsed = False  # Whether read_delta or write_delta has been used; until then, nothing is remembered.
+		self._Pool = None
+		self._PoolLock = threading.Lock()
+		self._WriteBehind = WriteBehindQueue(self._WriteNow, sync) if writeBehind else None
+		self._Unsynced = set()  # Files written since the last flush which haven't been synced.
+		self._UnsyncedLock = threading.Lock()
+
+	def _GetPool(self):
+		with self._PoolLock:
+			if self._Pool is None:
+				self._Pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="IOWorker")
+			return self._Pool
+
+	def _Pending(self, File):
+		"""
+		:return: the contents of a write to the file which hasn't been made yet, as a string, or None.
+		"""
+		if self._WriteBehind is None:
+			return None
+		contents = self._WriteBehind.get(File)
+		return contents.decode() if isinstance(contents, bytes) else contents
+
+	def _Read(self, File):
+		contents = self._Pending(File)
+		if contents is None:
+			with open(File, "r", encoding="utf-8") as f:
+				contents = f.read()
+		self._Remember(contents)
+		return contents
+
+	def _Remember(self, contents):
+		"""
+		Keeps a version of a file in the blob store.
+		:return: the hash of the contents, or None if they weren't kept.
+		"""
+		if self.blobs is None or not self._DeltasUsed:
+			return None
+		try:
+			return self.blobs.put(contents)
+		except UnicodeDecodeError:
+			return None  # Binary files are never sent as deltas.
+
+	def _Write(self, File, Contents, directories = None, origin = None):
+		"""
+		:param directories: if given (and writes are synced), the directory of the file is added to this set to be
+			synced later, rather than synced straight away.
+		:param origin: the watch session the write was made on behalf of, if any.
+		"""
+		if self.echoes is not None:
+			self.echoes.expect(File, Contents, origin)
+		self._Remember(Contents)
+		if self._WriteBehind is not None:
+			self._WriteBehind.put(File, Contents)
+			return
+		self._WriteNow(File, Contents)
+		if self.sync:
+			if directories is None:
+				helpers.SyncDirectory(os.path.dirname(File))
+			else:
+				directories.add(os.path.dirname(File))
+
+	def _WriteNow(self, File, Contents):
+		# Ensure all the necessary folders exist
+		if os.path.dirname(File):
+			os.makedirs(os.path.dirname(File), exist_ok=True)
+		# Write to the file.
+		helpers.WriteFile(File, Contents, self.sync)
+		if self.echoes is not None:
+			self.echoes.wrote(File)
+		if self.hashIndex is not None:
+			self.hashIndex.invalidate(File)
+		if not self.sync:
+			with self._UnsyncedLock:
+				self._Unsynced.add(File)
+				if len(self._Unsynced) < self.MaxUnsynced:
+					return
+				# A client which never flushes mustn't make the set grow forever, so it's synced now instead.
+				(unsynced, self._Unsynced) = (self._Unsynced, set())
+			self._SyncFiles(unsynced)
+
 	def read(self, File):
-		with open(File, "r") as f:
+		contents = self._Pending(File)
+		if contents is not None:
+			return {
+				"Contents": contents
+			}
+		f = open(File, "r", encoding="utf-8")
+		if os.fstat(f.fileno()).st_size >= self.STREAM_THRESHOLD:
+			return {
+				"Contents": self._ReadChunks(f)
+			}
+		with f:
 			contents = f.read()
+		self._Remember(contents)
 		return {
 			"Contents": contents
 		}
 
+	def _ReadChunks(self, f):
+		with f:
+			while True:
+				chunk = f.read(self.STREAM_CHUNK_SIZE)
+				if not chunk:
+					break
+				yield chunk
+
+	@helpers.RawPayload
 	def write(self, File, Contents):
-		# Ensure all the necessary folders exist
-		if os.path.dirname(File):
-			os.makedirs(os.path.dirname(File), exist_ok=True)
-		# Write to the file.
-		with open(File, "w") as f:
-			f.write(Contents)
+		self._Write(File, Contents, origin=helpers.CurrentOrigin())
+		return {}
+
+	def _Bases(self):
+		if self.blobs is None or not self.blobs.usable():
+			raise HttpException(400, None, "Deltas need a hash algorithm other than 'length'")
+		self._DeltasUsed = True
+		return self.blobs
+
+	def read_delta(self, File, Base):
+		"""
+		Reads a file as a delta (see delta.py) against an earlier version of it.
+		:param Base: the hash of the version the client has.
+		:return: Mode is "delta" & Contents the delta if the server still has the base; otherwise Mode is "full" &
+			Contents the whole file. Hash is the hash of the file as it is now, so the client can check the
+			result. Line endings are "\n" either way.
+		"""
+		blobs = self._Bases()
+		contents = self._Pending(File)
+		if contents is None:
+			with open(File, "r", encoding="utf-8") as f:
+				contents = f.read()
+		contents = blobs.normalize(contents)
+		hash = blobs.put(contents) or helpers.Hash(contents)
+		base = blobs.get(Base)
+		if base is None:
+			return {"Mode": "full", "Hash": hash, "Contents": contents}
+		return {"Mode": "delta", "Hash": hash, "Contents": delta.Make(base, contents)}
+
+	def write_delta(self, File, Base, Hash, Delta):
+		"""
+		Writes a file given a delta (see delta.py) against an earlier version of it.
+		:param Base: the hash of the version the delta was made against. If the server doesn't have it (any more),
+			the write fails with a 409 & the client should write the whole file instead.
+		:param Hash: the hash of the file once the delta is applied; the write fails with a 409 if it doesn't match.
+		"""
+		blobs = self._Bases()
+		base = blobs.get(Base)
+		if base is None:
+			raise HttpException(409, None, "No version with hash {} to apply the delta to".format(Base))
+		try:
+			contents = delta.Apply(base, Delta)
+		except ValueError as e:
+			raise HttpException(400, None, str(e))
+		if helpers.Hash(contents) != Hash:
+			raise HttpException(409, None, "The delta gave contents with hash {}, not {}".format(helpers.Hash(contents), Hash))
+		self._Write(File, contents, origin=helpers.CurrentOrigin())
 		return {}
 
 	def delete(self, File):
-		os.remove(File)
+		if self.echoes is not None:
+			self.echoes.expect(File, None, helpers.CurrentOrigin())
+		pending = self._WriteBehind is not None and self._WriteBehind.discard(File)
+		try:
+			os.remove(File)
+		except FileNotFoundError:
+			# The file was never written; as far as the client knows, it was.
+			if not pending:
+				raise
+		if self.sync:
+			helpers.SyncDirectory(os.path.dirname(File))
+		if self.hashIndex is not None:
+			self.hashIndex.invalidate(File)
 		return {}
+
+	def flush(self):
+		"""
+		Waits for every write made so far to reach the disk, and reports any queued writes which failed.
+		"""
+		errors = self._WriteBehind.flush() if self._WriteBehind is not None else []
+		with self._UnsyncedLock:
+			(unsynced, self._Unsynced) = (self._Unsynced, set())
+		self._SyncFiles(unsynced)
+		return {"Errors": "".join(self._Frame(helpers.AbsoluteToRelativeFilePath(path, self.root) if self.root else path, "error", message) for (path, message) in errors)}
+
+	@staticmethod
+	def _SyncFiles(paths):
+		for path in paths:
+			try:
+				helpers.SyncFile(path)
+			except FileNotFoundError:
+				pass  # It's been deleted since.
+		for directory in set(os.path.dirname(path) for path in paths):
+			helpers.SyncDirectory(directory)
+
+	def close(self):
+		"""
+		Writes out any queued writes.
+		"""
+		if self._WriteBehind is not None:
+			self._WriteBehind.close()
+
+	@staticmethod
+	def _Frame(path, status, contents):
+		return "{}\n{}\n{}\n{}".format(path, status, len(contents.encode()), contents)
+
+	_FrameHeader = re.compile(rb"([^\n]*)\n(\d+)\n")
+
+	@classmethod
+	def _ParseFrames(cls, payload):
+		"""
+		Splits a write_many payload into (path, contents) tuples. The contents are views into the payload.
+		:param payload: a bytes-like object (or string).
+		"""
+		data = memoryview(payload.encode() if isinstance(payload, str) else payload)
+		files = []
+		i = 0
+		while i < len(data):
+			header = cls._FrameHeader.match(data, i)
+			if header is None:
+				raise HttpException(400, None, "Malformed file header at byte {}".format(i))
+			try:
+				path = header.group(1).decode()
+			except UnicodeDecodeError:
+				raise HttpException(400, None, "Malformed file header at byte {}".format(i))
+			end = header.end() + int(header.group(2))
+			if end > len(data):
+				raise HttpException(400, None, "File {} is truncated".format(path))
+			files.append((path, data[header.end():end]))
+			i = end
+		return files
+
+	def _Resolve(self, path):
+		if self.root is None:
+			raise HttpException(500, "Internal error")
+		return validate_incoming_file(path, self.root)
+
+	def _Run(self, jobs):
+		"""
+		Runs each (path, function) job & generates a framed result for each, in order.
+		:param jobs: an iterable of (path, function) tuples; a function returns the contents to send back.
+		"""
+		token = helpers.CurrentCancellationToken()
+		def run(path, function):
+			try:
+				return self._Frame(path, "ok", function())
+			except HttpException as e:
+				return self._Frame(path, "error", str(e.explain))
+			except Exception as e:
+				return self._Frame(path, "error", "{}: {}".format(e.__class__.__name__, str(e)))
+		if self.workers == 1:
+			for (path, function) in jobs:
+				token.check()
+				yield run(path, function)
+			return
+		pool = self._GetPool()
+		pending = collections.deque()
+		try:
+			for (path, function) in jobs:
+				token.check()
+				# Each job runs in a copy of our context, so it sees the request's hash algorithm.
+				pending.append(pool.submit(contextvars.copy_context().run, run, path, function))
+				while len(pending) >= self.workers * self.MaxPendingPerWorker:
+					yield pending.popleft().result()
+			while pending:
+				token.check()
+				yield pending.popleft().result()
+		finally:
+			for future in pending:
+				future.cancel()
+
+	def read_many(self, Files):
+		"""
+		Reads many files at once.
+		:param Files: the relative paths of the files, one per line.
+		"""
+		def job(path):
+			return lambda: self._Read(self._Resolve(path))
+		paths = [path for path in Files.split("\n") if path]
+		return {"Results": self._Run((path, job(path)) for path in paths)}
+
+	@helpers.RawPayload
+	def write_many(self, Files):
+		"""
+		Writes many files at once.
+		:param Files: the framed paths & contents of the files.
+		"""
+		directories = set()  # The directories to sync once every file is written.
+		def job(path, contents):
+			def write():
+				self._Write(self._Resolve(path), contents, directories, helpers.CurrentOrigin())
+				return ""
+			return write
+		def superseded():
+			return ""
+		files = self._ParseFrames(Files)
+		# The files are written in parallel, so when a file is named more than once, only its last frame is written
+		# (& the others succeed without doing anything), as if the frames were written one after another.
+		key = lambda path: os.path.normcase(os.path.normpath(path))
+		last = dict((key(path), i) for (i, (path, contents)) in enumerate(files))
+		jobs = ((path, job(path, contents) if last[key(path)] == i else superseded) for (i, (path, contents)) in enumerate(files))
+		return {"Results": self._SyncAfter(self._Run(jobs), directories)}
+
+	@staticmethod
+	def _SyncAfter(results, directories):
+		yield from results
+		for directory in directories:
+			helpers.SyncDirectory(directory)
+
+class RWCommandHandlerTestCase(unittest.TestCase):
+	def setUp(self):
+		import tempfile
+		self.dir = tempfile.TemporaryDirectory()
+		self.handler = RWCommandHandler(root=self.dir.name)
+
+	def tearDown(self):
+		self.dir.cleanup()
+
+	def frame(self, *files):
+		return "".join("{}\n{}\n{}".format(path, len(contents.encode()), contents) for (path, contents) in files)
+
+	def test_round_trip(self):
+		for workers in (1, 4):
+			self.handler.workers = workers
+			files = [("a.lua", "print('a')\n"), ("sub/b.lua", "multi\nline\n\n"), ("c.lua", "été")]
+			self.assertEqual(
+				"".join(RWCommandHandler._Frame(path, "ok", "") for (path, contents) in files),
+				"".join(self.handler.write_many(self.frame(*files))["Results"]))
+			self.assertEqual(
+				"".join(RWCommandHandler._Frame(path, "ok", contents) for (path, contents) in files),
+				"".join(self.handler.read_many("\n".join(path for (path, contents) in files))["Results"]))
+
+	def test_per_file_status(self):
+		list(self.handler.write_many(self.frame(("a.lua", "foo")))["Results"])
+		results = list(self.handler.read_many("a.lua\nmissing.lua\n../outside.lua")["Results"])
+		self.assertEqual(results[0], RWCommandHandler._Frame("a.lua", "ok", "foo"))
+		self.assertTrue(results[1].startswith("missing.lua\nerror\n"))
+		self.assertTrue(results[2].startswith("../outside.lua\nerror\n"))
+
+	def test_binary_write(self):
+		contents = bytes(range(256)) + b"a\nb\r\nc\xff\xfe\xc3("
+		payload = b"asset.bin\n" + str(len(contents)).encode() + b"\n" + contents
+		list(self.handler.write_many(memoryview(payload))["Results"])
+		self.handler.write(os.path.join(self.dir.name, "direct.bin"), memoryview(contents))
+		for name in ("asset.bin", "direct.bin"):
+			with open(os.path.join(self.dir.name, name), "rb") as f:
+				self.assertEqual(f.read(), contents)
+
+	def test_repeated_path(self):
+		from unittest import mock
+		self.handler.workers = 4
+		with mock.patch.object(self.handler, "_Write", wraps=self.handler._Write) as write:
+			results = "".join(self.handler.write_many(self.frame(("a.lua", "1"), ("b.lua", "b"), ("./a.lua", "2"), ("a.lua", "3")))["Results"])
+		self.assertEqual(results, "".join(RWCommandHandler._Frame(path, "ok", "") for path in ("a.lua", "b.lua", "./a.lua", "a.lua")))
+		self.assertEqual(write.call_count, 2)
+		self.assertEqual(self.handler.read(os.path.join(self.dir.name, "a.lua"))["Contents"], "3")
+
+	def test_truncated_payload(self):
+		self.assertRaises(HttpException, self.handler.write_many, "a.lua\n10\nfoo")
+		self.assertRaises(HttpException, self.handler.write_many, "a.lua\nfoo")
+
+	def test_atomic_write(self):
+		path = os.path.join(self.dir.name, "a.lua")
+		self.handler.write(path, "old")
+		os.chmod(path, 0o640)
+		self.handler.sync = True
+		self.handler.write(path, memoryview(b"new"))
+		self.assertEqual(self.handler.read(path)["Contents"], "new")
+		self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+		# The temporary file was renamed over the target.
+		self.assertEqual(os.listdir(self.dir.name), ["a.lua"])
+
+	def test_write_behind(self):
+		handler = RWCommandHandler(root=self.dir.name, writeBehind=True)
+		writes = []
+		write = handler._WriteBehind._Write
+		handler._WriteBehind._Write = lambda path, contents: (writes.append(path), write(path, contents))
+		a = os.path.join(self.dir.name, "a.lua")
+		b = os.path.join(self.dir.name, "sub", "b.lua")
+		for i in range(5):
+			handler.write(a, memoryview("a{}".format(i).encode()))
+		list(handler.write_many(self.frame(("sub/b.lua", "b")))["Results"])
+		# Queued writes are seen by reads straight away...
+		self.assertEqual(handler.read(a)["Contents"], "a4")
+		self.assertEqual("".join(handler.read_many("sub/b.lua")["Results"]), RWCommandHandler._Frame("sub/b.lua", "ok", "b"))
+		self.assertEqual(handler.flush()["Errors"], "")
+		# ...and repeated writes to a file are only made once.
+		self.assertEqual(writes, [a, b])
+		with open(a) as f:
+			self.assertEqual(f.read(), "a4")
+		# Deleting a file which is still queued drops the write.
+		handler._WriteBehind.Delay = 60
+		handler.write(os.path.join(self.dir.name, "c.lua"), "c")
+		handler.delete(os.path.join(self.dir.name, "c.lua"))
+		handler.flush()
+		self.assertFalse(os.path.exists(os.path.join(self.dir.name, "c.lua")))
+		# Failed writes are reported by flush.
+		os.makedirs(os.path.join(self.dir.name, "dir.lua"))
+		handler.write(os.path.join(self.dir.name, "dir.lua"), "d")
+		self.assertTrue(handler.flush()["Errors"].startswith("dir.lua\nerror\n"))
+		# Only the latest failures are kept for a flush to report.
+		handler._WriteBehind.MaxErrors = 2
+		for name in ("e.lua", "f.lua", "g.lua"):
+			os.makedirs(os.path.join(self.dir.name, name))
+			handler.write(os.path.join(self.dir.name, name), "x")
+		handler._WriteBehind.Delay = 0
+		errors = handler.flush()["Errors"]
+		self.assertTrue(errors.startswith("f.lua\nerror\n"))
+		self.assertIn("g.lua\nerror\n", errors)
+		self.assertNotIn("e.lua", errors)
+		handler.close()
+
+	def test_unsynced_is_bounded(self):
+		from unittest import mock
+		self.handler.MaxUnsynced = 3
+		with mock.patch.object(helpers, "SyncFile") as syncFile:
+			for name in ("a.lua", "b.lua", "c.lua", "d.lua"):
+				self.handler.write(os.path.join(self.dir.name, name), "x")
+			# The third write synced what had built up, rather than leaving it for a flush.
+			self.assertEqual(syncFile.call_count, 3)
+			self.assertEqual(len(self.handler._Unsynced), 1)
+			self.handler.flush()
+			self.assertEqual(syncFile.call_count, 4)
+
+	def test_delta(self):
+		from . import blobstore
+		handler = RWCommandHandler(root=self.dir.name, blobs=blobstore.BlobStore())
+		path = os.path.join(self.dir.name, "a.lua")
+		base = "local x = 1\n" * 1000
+		handler.write(path, base)
+		self.assertRaises(HttpException, handler.read_delta, path, "12000")
+		with helpers.HashAlgorithm("crc32"):
+			# Nothing is kept until a client uses deltas...
+			handler.write(path, base)
+			self.assertEqual(len(handler.blobs), 0)
+			baseHash = helpers.Hash(base)
+			self.assertEqual(handler.read_delta(path, "0")["Mode"], "full")
+			# ...& from then on, what's read or written is.
+			# A small edit on the server's side comes back as a small delta...
+			with open(path, "w") as f:
+				f.write(base.replace("x = 1", "x = 2", 1))
+			result = handler.read_delta(path, baseHash)
+			self.assertEqual((result["Mode"], result["Contents"]), ("delta", "=10\n-1\n+1\n2=11989\n"))
+			self.assertEqual(result["Hash"], helpers.Hash(base.replace("x = 1", "x = 2", 1)))
+			# ...& a base the server doesn't have gets the whole file.
+			self.assertEqual(handler.read_delta(path, "0")["Mode"], "full")
+			# A small edit on the client's side is sent the same way.
+			contents = base + "return x\n"
+			handler.write_delta(path, baseHash, helpers.Hash(contents), delta.Make(base, contents))
+			self.assertEqual(handler.read(path)["Contents"], contents)
+			self.assertRaises(HttpException, handler.write_delta, path, baseHash, "0", delta.Make(base, contents))
+			self.assertRaises(HttpException, handler.write_delta, path, "0", helpers.Hash(contents), "")
+			self.assertRaises(HttpException, handler.write_delta, path, baseHash, helpers.Hash(contents), "=1\n")
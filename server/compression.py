@@ -0,0 +1,238 @@
+"""
+Content-coding negotiation for the SyncyTowne HTTP servers.
+
+Request bodies may arrive gzip or deflate encoded (see decode), and responses are compressed with whichever of
+those the client prefers (see negotiate & Compressor). Lua source compresses well, which matters when the server
+is tunnelled over a slow link; tiny bodies aren't worth the CPU time & are sent as is.
+"""
+
+import collections
+import functools
+import hashlib
+import itertools
+import threading
+import zlib
+import commandhandler
+
+# The zlib window bits for each content-coding we speak, in order of preference.
+# HTTP's "deflate" is the zlib format (RFC 1950), not a raw deflate stream.
+CODINGS = collections.OrderedDict([
+	("gzip", 16 + zlib.MAX_WBITS),
+	("deflate", zlib.MAX_WBITS),
+])
+
+MAX_DECODED_SIZE = 256 * 1024 * 1024  # Compressed requests which inflate past this many bytes are refused.
+
+def negotiate(acceptEncoding):
+	"""
+	Picks the content-coding to send a response in.
+	:param acceptEncoding: the value of the request's Accept-Encoding header, or None.
+	:return: a key of CODINGS, or None if the response shouldn't be compressed.
+	"""
+	if not acceptEncoding:
+		return None
+	qualities = {}
+	for item in acceptEncoding.split(","):
+		(coding, *params) = item.split(";")
+		quality = 1.0
+		for param in params:
+			(key, _, value) = param.partition("=")
+			if key.strip().lower() == "q":
+				try:
+					quality = float(value)
+				except ValueError:
+					quality = 0.0
+		qualities[coding.strip().lower()] = quality
+	best = None
+	bestQuality = 0
+	for coding in CODINGS:
+		quality = qualities.get(coding, qualities.get("*", 0))
+		if quality > bestQuality:
+			(best, bestQuality) = (coding, quality)
+	return best
+
+def decode(body, contentEncoding, maxSize = MAX_DECODED_SIZE):
+	"""
+	Undoes the content-codings applied to a request body.
+	:param body: the body as sent.
+	:param contentEncoding: the value of the request's Content-Encoding header, or None.
+	:param maxSize: the largest decoded body we'll accept, in bytes.
+	:return: the decoded body.
+	:raises HttpException: if a coding isn't supported or the body can't be decoded.
+	"""
+	if not contentEncoding:
+		return body
+	# Codings are listed in the order they were applied.
+	for coding in reversed([c.strip().lower() for c in contentEncoding.split(",")]):
+		if coding in ("", "identity"):
+			continue
+		if coding not in CODINGS:
+			raise commandhandler.HttpException(415, None, "Unsupported content-coding {}".format(coding))
+		body = _Inflate(body, coding, CODINGS[coding], maxSize)
+	return body
+
+def _Inflate(body, coding, wbits, maxSize):
+	try:
+		decompressor = zlib.decompressobj(wbits)
+		data = decompressor.decompress(body, maxSize + 1)
+	except zlib.error as e:
+		if coding != "deflate" or wbits < 0:
+			raise commandhandler.HttpException(400, None, "Malformed {} body: {}".format(coding, e))
+		# Some clients send "deflate" bodies without the zlib wrapper.
+		return _Inflate(body, coding, -zlib.MAX_WBITS, maxSize)
+	if len(data) > maxSize:
+		raise commandhandler.HttpException(413, None, "Body inflates past {} bytes".format(maxSize))
+	if not decompressor.eof:
+		raise commandhandler.HttpException(400, None, "Truncated {} body".format(coding))
+	return data
+
+class StreamCompressor:
+	"""
+	Compresses a response which is sent in chunks. Every chunk is flushed, so the client can decompress each one as
+	it arrives rather than waiting for the whole response.
+	"""
+	def __init__(self, coding, level, store = None, maxSize = 0):
+		"""
+		:param store: if given, called with the whole compressed response once it's finished, unless it's more than
+			maxSize bytes.
+		"""
+		self._Compressor = zlib.compressobj(level, zlib.DEFLATED, CODINGS[coding])
+		self._Store = store
+		self._MaxSize = maxSize
+		self._Compressed = []  # What's been compressed so far, while it's still going to be stored.
+		self._Size = 0
+
+	def _Keep(self, data):
+		if self._Store is None:
+			return data
+		self._Compressed.append(data)
+		self._Size += len(data)
+		if self._Size > self._MaxSize:
+			(self._Store, self._Compressed) = (None, [])
+		return data
+
+	def compress(self, data):
+		return self._Keep(self._Compressor.compress(data) + self._Compressor.flush(zlib.Z_SYNC_FLUSH))
+
+	def finish(self):
+		"""
+		:return: the bytes which end the compressed stream.
+		"""
+		tail = self._Keep(self._Compressor.flush())
+		if self._Store is not None:
+			self._Store(b"".join(self._Compressed))
+			(self._Store, self._Compressed) = (None, [])
+		return tail
+
+class Compressor:
+	"""
+	Compresses response bodies, caching the results by the digest of the body. Unchanged responses (e.g., the read
+	of a file no-one has touched) are therefore compressed once, no matter how often they're requested.
+
+	Streamed responses are compressed as they're sent (see stream), so the client gets the first of them as soon as
+	it can. Only those with a CacheKey (see helpers.Cacheable) are cached, under that key, as they can't be told
+	apart by their digest until they've been generated in full.
+	"""
+	Threshold = 1024  # Bodies smaller than this many bytes are sent uncompressed.
+	Level = 6
+	CacheSize = 32 * 1024 * 1024  # The most compressed bytes the cache holds.
+
+	def __init__(self, threshold = None, level = None, cacheSize = None):
+		if threshold is not None:
+			self.Threshold = threshold
+		if level is not None:
+			self.Level = level
+		if cacheSize is not None:
+			self.CacheSize = cacheSize
+		self._Cache = collections.OrderedDict()  # A map of (coding, digest or cache key) --> compressed body
+		self._CacheBytes = 0
+		self._Lock = threading.Lock()
+		self.Hits = 0
+		self.Misses = 0
+
+	def compress(self, body, coding):
+		"""
+		:param body: the response body, as bytes.
+		:param coding: a key of CODINGS, or None.
+		:return: the compressed body, or None if the body should be sent as is.
+		"""
+		if coding is None or len(body) < self.Threshold:
+			return None
+		key = hashlib.blake2b(body, digest_size=16).digest()
+		compressed = self.cached(key, coding)
+		if compressed is not None:
+			return compressed
+		compressor = zlib.compressobj(self.Level, zlib.DEFLATED, CODINGS[coding])
+		compressed = compressor.compress(body) + compressor.flush()
+		self._Store((coding, key), compressed)
+		return compressed
+
+	def cached(self, key, coding):
+		"""
+		:param key: the digest of a body, or the CacheKey of a streamed response.
+		:return: the compressed body cached under the key, or None if there isn't one.
+		"""
+		key = (coding, key)
+		with self._Lock:
+			compressed = self._Cache.get(key)
+			if compressed is None:
+				self.Misses += 1
+				return None
+			self._Cache.move_to_end(key)
+			self.Hits += 1
+			return compressed
+
+	def _Store(self, key, compressed):
+		if len(compressed) > self.CacheSize:
+			return
+		with self._Lock:
+			if key not in self._Cache:
+				self._Cache[key] = compressed
+				self._CacheBytes += len(compressed)
+			while self._CacheBytes > self.CacheSize:
+				(_, evicted) = self._Cache.popitem(last=False)
+				self._CacheBytes -= len(evicted)
+
+	def stream(self, coding, key = None):
+		"""
+		:param key: the CacheKey of the response, if it has one; once it's been compressed in full, it's cached
+			under this.
+		"""
+		store = None if key is None else functools.partial(self._Store, (coding, key))
+		return StreamCompressor(coding, self.Level, store, self.CacheSize)
+
+	def buffer(self, pieces):
+		"""
+		Reads a streamed response until it ends or grows big enough to be worth compressing (see Threshold), so a
+		short one can be sent whole & uncompressed, while a long one starts being compressed & sent straight away.
+		:param pieces: an iterator of strings (or bytes).
+		:return: (body, None) if the response ended, where body is the whole response as bytes; otherwise
+			(None, rest) where rest generates the whole response (including what was already read).
+		"""
+		buffered = []
+		size = 0
+		for piece in pieces:
+			data = piece.encode() if isinstance(piece, str) else piece
+			buffered.append(data)
+			size += len(data)
+			if size >= self.Threshold:
+				return (None, _Resumed(buffered, pieces))
+		return (b"".join(buffered), None)
+
+class _Resumed:
+	"""
+	Generates the pieces of a streamed response which Compressor.buffer read ahead of, then the rest of them.
+	"""
+	def __init__(self, buffered, pieces):
+		self._Iterator = itertools.chain(buffered, pieces)
+		self._Pieces = pieces
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		return next(self._Iterator)
+
+	def close(self):
+		if hasattr(self._Pieces, "close"):
+			self._Pieces.close()
@@ -2,12 +2,23 @@
 File that contains logic related to watching a directory for code changes.
 """
 
+import asyncio
 import os
+import sys
 import threading
 import queue
+import collections
+import select
+import struct
+import time
+from logger import logger
 
-import win32file
-import win32con
+try:
+	import win32file
+	import win32con
+except ImportError:
+	win32file = None
+	win32con = None
 
 ACTIONS = {
 	1 : "Created",
@@ -57,6 +68,26 @@ class PrintCallbacks(Callbacks):
 	def onRename(self, filename):
 		print("onRename: {}".format(filename))
 
+class MultiCallbacks(Callbacks):
+	"""
+	Callbacks which forward every file change notification to several other callbacks.
+	"""
+	def __init__(self, *callbacks):
+		self.Callbacks = callbacks
+
+	def onAdd(self, filename):
+		for callbacks in self.Callbacks:
+			callbacks.onAdd(filename)
+	def onDelete(self, filename):
+		for callbacks in self.Callbacks:
+			callbacks.onDelete(filename)
+	def onModify(self, filename):
+		for callbacks in self.Callbacks:
+			callbacks.onModify(filename)
+	def onRename(self, old, new):
+		for callbacks in self.Callbacks:
+			callbacks.onRename(old, new)
+
 class QueueCallbacks(queue.Queue):
 	"""
 	Callbacks which put all file change notifications into a synchronized queue.
@@ -73,35 +104,18 @@ class QueueCallbacks(queue.Queue):
 	def onRename(self, old, new):
 		self.put(("delete", old))
 		self.put(("add", new))
-	def Deduplicate(self):
-		"""
-		Removes duplicate entries from the list.
-		"""
-		# suck everything into a non-synchronized list.
-		l = []
-		try:
-			while True:
-				l.append(self.get_nowait())
-		except queue.Empty as e:
-			pass
-		# Iterate through the list & put each tuple into a set. If the object is already in the set,
-		# then remove it from the list.
-		i = 0
-		s = set()
-		while i < len(l):
-			if l[i] not in s:
-				s.add(l[i])
-				i += 1
-			else:
-				del l[i]
-		# Push everything from our list back into the synchronized queue.
-		for x in l:
-			self.put(x)
 
 class Filter:
 	def __call__(self, filename):
 		return True
 
+	def version(self):
+		"""
+		:return: a value which changes whenever the filter's decisions might. Watchers which only see what the filter
+			accepted (inotify) rescan when it does.
+		"""
+		return None
+
 class FilterDotFiles(Filter):
 	def __call__(self, filename):
 		for dir in _split_path(filename):
@@ -109,22 +123,93 @@ class FilterDotFiles(Filter):
 				return False
 		return True
 
-class WatchForChanges(threading.Thread):
+def _stat_signature(stat):
 	"""
-	A thread which will watch for changes to files within a specific directory.
+	Reduces a stat result to the pieces which change when a file is modified.
 	"""
+	return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
 
-	def __init__(self, dir, callbacks = Callbacks(), filter = Filter(), **kwargs):
-		threading.Thread.__init__(self, **kwargs)
-		self.Directory = dir
-		self.Callbacks = callbacks
-		self.Filter = filter
-		self.Terminate = threading.Event()
-		self.setDaemon(True)
-		self.start()
+def _take_snapshot(directory, filter, snapshot = None, onDirectory = None):
+	"""
+	Walks a directory tree & records the state of everything within it.
+	:param directory: the directory to walk.
+	:param filter: a Filter; anything it rejects is skipped (including the contents of rejected directories).
+	:param snapshot: a dictionary to add entries to. If None, a new dictionary is made.
+	:param onDirectory: if given, called with the path of every directory which is walked.
+	:return: a map of path --> None (for directories) or the stat signature of the file.
+	"""
+	if snapshot is None:
+		snapshot = {}
+	stack = [directory]
+	while stack:
+		dir = stack.pop()
+		if onDirectory:
+			onDirectory(dir)
+		try:
+			entries = list(os.scandir(dir))
+		except OSError:
+			continue
+		for entry in entries:
+			if not filter(entry.path):
+				continue
+			try:
+				if entry.is_dir(follow_symlinks=False):
+					snapshot[entry.path] = None
+					stack.append(entry.path)
+				else:
+					snapshot[entry.path] = _stat_signature(entry.stat(follow_symlinks=False))
+			except OSError:
+				pass
+	return snapshot
 
-	def kill(self):
-		self.Terminate.set()
+def _diff_snapshots(old, new):
+	"""
+	Compares two snapshots made by _take_snapshot.
+	:return: a list of (mode, path) tuples where mode is one of "add", "delete" or "modify".
+	"""
+	changes = []
+	for path in sorted(old.keys() - new.keys(), reverse=True):
+		changes.append(("delete", path))
+	for path in sorted(new.keys() - old.keys()):
+		changes.append(("add", path))
+	for path in sorted(old.keys() & new.keys()):
+		if old[path] != new[path]:
+			if old[path] is None or new[path] is None:
+				# A file became a directory or vice versa.
+				changes.append(("delete", path))
+				changes.append(("add", path))
+			else:
+				changes.append(("modify", path))
+	return changes
+
+class Backend:
+	"""
+	A source of file change notifications. WatchForChanges runs its backend on its own thread; the
+	backend reports each change through WatchForChanges._Dispatch until Terminate is set.
+	"""
+	def __init__(self, watcher):
+		"""
+		:param watcher: the WatchForChanges which owns this backend.
+		"""
+		self.Watcher = watcher
+
+	@classmethod
+	def available(cls):
+		"""
+		Returns true if this backend can be used on the current platform.
+		"""
+		return True
+
+	def run(self):
+		raise NotImplementedError()
+
+class Win32Backend(Backend):
+	"""
+	Watches for changes using ReadDirectoryChangesW.
+	"""
+	@classmethod
+	def available(cls):
+		return win32file is not None
 
 	def run(self):
 		#
@@ -138,8 +223,9 @@ class WatchForChanges(threading.Thread):
 		# events when a large number of files were
 		# deleted at once.
 		#
+		watcher = self.Watcher
 		hDir = win32file.CreateFile(
-			self.Directory,
+			watcher.Directory,
 			FILE_LIST_DIRECTORY,
 			win32con.FILE_SHARE_READ | win32con.FILE_SHARE_WRITE | win32con.FILE_SHARE_DELETE,
 			None,
@@ -147,7 +233,7 @@ class WatchForChanges(threading.Thread):
 			win32con.FILE_FLAG_BACKUP_SEMANTICS,
 			None
 		)
-		while not self.Terminate.is_set():
+		while not watcher.Terminate.is_set():
 			results = win32file.ReadDirectoryChangesW(
 				hDir,
 				1024,
@@ -156,17 +242,686 @@ class WatchForChanges(threading.Thread):
 				None,
 				None
 			)
-			if self.Terminate.is_set():
+			if watcher.Terminate.is_set():
 				break
 			for action, file in results:
-				full_filename = os.path.join(self.Directory, file)
-				if self.Filter(full_filename):
-					if action == 1:
-						self.Callbacks.onAdd(full_filename)
-					elif action == 2:
-						self.Callbacks.onDelete(full_filename)
-					elif action == 3:
-						self.Callbacks.onModify(full_filename)
-					elif action == 4:
-						pass#self.Callbacks.onRename(full_filename)
+				full_filename = os.path.join(watcher.Directory, file)
+				if action == 1:
+					watcher._Dispatch("add", full_filename)
+				elif action == 2:
+					watcher._Dispatch("delete", full_filename)
+				elif action == 3:
+					watcher._Dispatch("modify", full_filename)
+				elif action == 4:
+					pass#watcher.Callbacks.onRename(full_filename)
+				elif action == 5:
+					# The new name of a renamed file; replacing a file this way (as an atomic save does) is
+					# reported as a delete then this, which coalesce into a modify.
+					watcher._Dispatch("add", full_filename)
+
+class PollingBackend(Backend):
+	"""
+	Watches for changes by periodically taking a snapshot of the directory tree & comparing it against
+	the previous snapshot. This works everywhere, but costs a stat of every file per interval.
+	"""
+	Interval = 1  # seconds between snapshots.
+
+	def run(self):
+		watcher = self.Watcher
+		snapshot = _take_snapshot(watcher.Directory, watcher.Filter)
+		while not watcher.Terminate.wait(self.Interval):
+			newSnapshot = _take_snapshot(watcher.Directory, watcher.Filter)
+			for (mode, path) in _diff_snapshots(snapshot, newSnapshot):
+				watcher._Dispatch(mode, path)
+			snapshot = newSnapshot
+
+class InotifyBackend(Backend):
+	"""
+	Watches for changes using Linux's inotify. inotify watches aren't recursive, so a watch is added for
+	every directory in the tree, including directories which are created while we're watching.
+
+	If the kernel's event queue overflows, events have been lost; a rescan is scheduled which compares the
+	tree against our snapshot of it & reports the difference.
+	"""
+	IN_MODIFY = 0x00000002
+	IN_MOVED_FROM = 0x00000040
+	IN_MOVED_TO = 0x00000080
+	IN_CREATE = 0x00000100
+	IN_DELETE = 0x00000200
+	IN_DELETE_SELF = 0x00000400
+	IN_MOVE_SELF = 0x00000800
+	IN_Q_OVERFLOW = 0x00004000
+	IN_IGNORED = 0x00008000
+	IN_ONLYDIR = 0x01000000
+	IN_ISDIR = 0x40000000
+	IN_NONBLOCK = 0o4000
+	IN_CLOEXEC = 0o2000000
+
+	Mask = IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+	EventHeader = struct.Struct("iIII")
+	BufferSize = 64 * 1024
+	SelectTimeout = .1  # How often (in seconds) we check if we've been asked to terminate.
+	RescanDelay = .5  # After an overflow, how long (in seconds) to let the burst of changes settle.
+
+	_libc = None
+
+	@classmethod
+	def _load_libc(cls):
+		if cls._libc is None and sys.platform.startswith("linux"):
+			import ctypes
+			import ctypes.util
+			try:
+				libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+				libc.inotify_init1.argtypes = [ctypes.c_int]
+				libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+				libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+				cls._libc = libc
+			except (OSError, AttributeError):
+				cls._libc = False
+		return cls._libc or None
+
+	@classmethod
+	def available(cls):
+		return cls._load_libc() is not None
+
+	def __init__(self, watcher):
+		Backend.__init__(self, watcher)
+		self._Fd = -1
+		self._Paths = {}  # A map of watch descriptor --> directory path.
+		self._Descriptors = {}  # A map of directory path --> watch descriptor.
+		self._Snapshot = {}
+		self._RescanAt = None
+
+	def _AddWatch(self, directory):
+		import ctypes
+		wd = self._libc.inotify_add_watch(self._Fd, os.fsencode(directory), self.Mask | self.IN_ONLYDIR)
+		if wd < 0:
+			errno = ctypes.get_errno()
+			if directory == self.Watcher.Directory:
+				raise OSError(errno, os.strerror(errno), directory)
+			logger.warning("Could not watch {}: {}", directory, os.strerror(errno))
+			return
+		self._Paths[wd] = directory
+		self._Descriptors[directory] = wd
+
+	def _AddTree(self, directory):
+		"""
+		Watches a directory & everything in it.
+		:return: the snapshot of everything that was found within the directory.
+		"""
+		found = _take_snapshot(directory, self.Watcher.Filter, onDirectory=self._AddWatch)
+		self._Snapshot.update(found)
+		return found
+
+	def _ForgetTree(self, directory):
+		"""
+		Stops watching a directory & everything in it, and drops it from our snapshot.
+		"""
+		prefix = os.path.join(directory, "")
+		for path in [path for path in self._Descriptors if path == directory or path.startswith(prefix)]:
+			wd = self._Descriptors.pop(path)
+			self._Paths.pop(wd, None)
+			self._libc.inotify_rm_watch(self._Fd, wd)
+		for path in [path for path in self._Snapshot if path.startswith(prefix)]:
+			del self._Snapshot[path]
+		self._Snapshot.pop(directory, None)
+
+	def _Rescan(self):
+		"""
+		Brings our watches & snapshot up to date with the filesystem, reporting any difference.
+		"""
+		old = self._Snapshot
+		self._Snapshot = {}
+		self._AddTree(self.Watcher.Directory)
+		# Drop the watches on directories which have gone, or which the filter now rejects.
+		for (path, wd) in list(self._Descriptors.items()):
+			if path != self.Watcher.Directory and path not in self._Snapshot:
+				del self._Descriptors[path]
+				self._Paths.pop(wd, None)
+				self._libc.inotify_rm_watch(self._Fd, wd)
+		for (mode, path) in _diff_snapshots(old, self._Snapshot):
+			self.Watcher._Dispatch(mode, path)
+
+	def _ReadEvents(self):
+		"""
+		Reads every event the kernel has queued up for us.
+		:return: a list of (wd, mask, name) tuples.
+		"""
+		events = []
+		while True:
+			try:
+				buffer = os.read(self._Fd, self.BufferSize)
+			except BlockingIOError:
+				break
+			offset = 0
+			while offset < len(buffer):
+				(wd, mask, cookie, length) = self.EventHeader.unpack_from(buffer, offset)
+				offset += self.EventHeader.size
+				name = buffer[offset:offset + length].rstrip(b"\0")
+				offset += length
+				events.append((wd, mask, os.fsdecode(name)))
+		return events
+
+	def _HandleEvent(self, wd, mask, name):
+		watcher = self.Watcher
+		if mask & self.IN_Q_OVERFLOW:
+			if self._RescanAt is None:
+				logger.warning("inotify queue overflowed; rescanning {}", watcher.Directory)
+				self._RescanAt = time.monotonic() + self.RescanDelay
+			return
+		directory = self._Paths.get(wd)
+		if directory is None:
+			return
+		if mask & self.IN_IGNORED:
+			del self._Paths[wd]
+			if self._Descriptors.get(directory) == wd:
+				del self._Descriptors[directory]
+			return
+		if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF) or not name:
+			return
+		path = os.path.join(directory, name)
+		if not watcher.Filter(path):
+			return
+		if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+			if mask & self.IN_ISDIR:
+				watcher._Dispatch("add", path)
+				# Anything created before our watch was in place would otherwise go unreported.
+				for child in sorted(self._AddTree(path)):
+					watcher._Dispatch("add", child)
+				self._Snapshot[path] = None
+			else:
+				# A file renamed over one we know of (as an atomic save does) has been modified, not added.
+				existed = self._Snapshot.get(path) is not None
+				self._Record(path)
+				watcher._Dispatch("modify" if existed else "add", path)
+		elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+			if mask & self.IN_ISDIR:
+				self._ForgetTree(path)
+			else:
+				self._Snapshot.pop(path, None)
+			watcher._Dispatch("delete", path)
+		elif mask & self.IN_MODIFY:
+			self._Record(path)
+			watcher._Dispatch("modify", path)
+
+	def _Record(self, path):
+		try:
+			self._Snapshot[path] = _stat_signature(os.stat(path, follow_symlinks=False))
+		except OSError:
+			self._Snapshot.pop(path, None)
+
+	def run(self):
+		watcher = self.Watcher
+		self._load_libc()
+		self._Fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+		if self._Fd < 0:
+			import ctypes
+			errno = ctypes.get_errno()
+			raise OSError(errno, os.strerror(errno))
+		try:
+			version = watcher.Filter.version()
+			self._AddTree(watcher.Directory)
+			while not watcher.Terminate.is_set():
+				if self._RescanAt is None and watcher.Filter.version() != version:
+					# Directories the filter used to reject may now need watching, & vice versa.
+					version = watcher.Filter.version()
+					self._RescanAt = time.monotonic()
+				timeout = self.SelectTimeout
+				if self._RescanAt is not None:
+					timeout = max(0, min(timeout, self._RescanAt - time.monotonic()))
+				(readable, _, _) = select.select([self._Fd], [], [], timeout)
+				if watcher.Terminate.is_set():
+					break
+				if readable:
+					for (wd, mask, name) in self._ReadEvents():
+						self._HandleEvent(wd, mask, name)
+				if self._RescanAt is not None and self._RescanAt <= time.monotonic():
+					self._RescanAt = None
+					# Drain anything still queued; the rescan will account for it.
+					self._ReadEvents()
+					self._Rescan()
+		finally:
+			os.close(self._Fd)
+			self._Fd = -1
+
+def DefaultBackend():
+	"""
+	Chooses the best backend which is available on this platform.
+	"""
+	for backend in (Win32Backend, InotifyBackend):
+		if backend.available():
+			return backend
+	return PollingBackend
+
+class WatchForChanges(threading.Thread):
+	"""
+	A thread which will watch for changes to files within a specific directory.
+	"""
+
+	def __init__(self, dir, callbacks = Callbacks(), filter = Filter(), backend = None, **kwargs):
+		"""
+		:param dir: the directory to watch (recursively).
+		:param callbacks: the Callbacks which are informed of each change.
+		:param filter: a Filter which decides which paths are reported.
+		:param backend: the Backend class to watch with; defaults to the best one for this platform.
+		"""
+		threading.Thread.__init__(self, **kwargs)
+		self.Directory = dir
+		self.Callbacks = callbacks
+		self.Filter = filter
+		self.Terminate = threading.Event()
+		self.Backend = (backend or DefaultBackend())(self)
+		self.setDaemon(True)
+		self.start()
+
+	def kill(self):
+		self.Terminate.set()
+
+	def _Dispatch(self, mode, full_filename):
+		"""
+		Informs our callbacks of a change, as long as our filter accepts the file.
+		:param mode: one of "add", "delete" or "modify".
+		:param full_filename: the path of the file which changed.
+		"""
+		if self.Filter(full_filename):
+			if mode == "add":
+				self.Callbacks.onAdd(full_filename)
+			elif mode == "delete":
+				self.Callbacks.onDelete(full_filename)
+			elif mode == "modify":
+				self.Callbacks.onModify(full_filename)
+
+	def run(self):
+		self.Backend.run()
+
+class EventRing(Callbacks):
+	"""
+	Callbacks which record file change notifications in a fixed-size ring buffer. Every notification is
+	numbered; readers keep their own cursor into the ring, so any number of readers can share one watcher.
+	"""
+	def __init__(self, size, start = 0):
+		"""
+		:param size: the number of notifications kept. A reader that falls further behind than this loses events.
+		:param start: the number given to the first notification.
+		"""
+		self._Events = collections.deque(maxlen=size)
+		self._Next = start
+		self.Condition = threading.Condition()
+		self._Waiters = set()  # Functions called (with Condition held) whenever a notification comes in.
+
+	@property
+	def Next(self):
+		"""
+		The number which will be given to the next notification.
+		"""
+		return self._Next
+
+	def _Append(self, mode, filename):
+		with self.Condition:
+			self._Events.append((mode, filename, time.monotonic()))
+			self._Next += 1
+			self.Condition.notify_all()
+			for waiter in self._Waiters:
+				waiter()
+
+	def addWaiter(self, waiter):
+		"""
+		Registers a function to call on every notification. It's called from the watcher's thread, so it mustn't block.
+		"""
+		with self.Condition:
+			self._Waiters.add(waiter)
+
+	def removeWaiter(self, waiter):
+		with self.Condition:
+			self._Waiters.discard(waiter)
+
+	def onAdd(self, filename):
+		self._Append("add", filename)
+	def onDelete(self, filename):
+		self._Append("delete", filename)
+	def onModify(self, filename):
+		self._Append("modify", filename)
+	def onRename(self, old, new):
+		self._Append("delete", old)
+		self._Append("add", new)
+
+	def read(self, cursor):
+		"""
+		Gets every notification from cursor onward.
+		:param cursor: the number of the first notification wanted.
+		:return: (events, next cursor, number of notifications which were dropped before they could be read), where
+			events are (mode, path, time) tuples and time is the time.monotonic() at which the watcher reported them.
+		"""
+		with self.Condition:
+			first = self._Next - len(self._Events)
+			lost = max(0, first - cursor)
+			start = max(cursor, first)
+			events = [self._Events[i - first] for i in range(start, self._Next)]
+			return (events, self._Next, lost)
+
+class SharedWatcher:
+	"""
+	A WatchForChanges which is shared by every session watching the same directory (or a directory
+	within it). This is reference counted by the WatcherPool which owns it.
+	"""
+	def __init__(self, directory, key, callbacks, filter, backend, ringSize, generation = 0):
+		self.Directory = directory
+		self.Key = key
+		self.References = 0
+		self.LingerTimer = None
+		self.Ring = EventRing(ringSize, generation)
+		self.Watcher = WatchForChanges(directory, MultiCallbacks(*callbacks, self.Ring), filter, backend)
+
+	def kill(self):
+		self.Watcher.kill()
+
+# How two changes to the same path combine into a single net change. None means the changes cancel out.
+_COALESCE = {
+	("add", "add"): "add",
+	("add", "modify"): "add",
+	("add", "delete"): None,
+	("modify", "add"): "modify",
+	("modify", "modify"): "modify",
+	("modify", "delete"): "delete",
+	("delete", "add"): "modify",
+	("delete", "modify"): "modify",
+	("delete", "delete"): "delete",
+}
+
+class Coalescer:
+	"""
+	Merges every change made to a path into one net change (e.g., add then modify is an add; add then delete
+	is nothing at all), and holds each change back until its path has gone SettleTime seconds without
+	changing again. This keeps us from reporting (and hashing) files which are still being written.
+	"""
+	def __init__(self, settleTime):
+		"""
+		:param settleTime: how many seconds a path must go unchanged before its change is released.
+		"""
+		self.SettleTime = settleTime
+		# A map of path --> [mode, time of the latest change]. Entries are kept in the order of their
+		# latest change, so the first entry is always the first to settle.
+		self._Changes = collections.OrderedDict()
+
+	def add(self, mode, path, now):
+		entry = self._Changes.get(path)
+		if entry is None:
+			self._Changes[path] = [mode, now]
+			return
+		merged = _COALESCE[(entry[0], mode)]
+		if merged is None:
+			del self._Changes[path]
+		else:
+			entry[0] = merged
+			entry[1] = now
+			self._Changes.move_to_end(path)
+
+	def pop(self, now):
+		"""
+		Removes & returns the oldest settled change as a (mode, path) tuple, or None if nothing has settled.
+		"""
+		if self._Changes:
+			(path, (mode, t)) = next(iter(self._Changes.items()))
+			if t + self.SettleTime <= now:
+				del self._Changes[path]
+				return (mode, path)
+		return None
+
+	def nextSettleTime(self):
+		"""
+		The time at which the next change settles, or None if there are no changes.
+		"""
+		if self._Changes:
+			return next(iter(self._Changes.values()))[1] + self.SettleTime
+		return None
+
+	def __len__(self):
+		return len(self._Changes)
+
+class Overflow(Exception):
+	"""
+	Raised by a Subscription which lost track of changes, either because it fell so far behind that its watcher
+	dropped them or because too many were pending. The subscription starts afresh from the latest change; whoever
+	reads it must resynchronize everything it knows about the directory.
+	"""
+
+class Subscription:
+	"""
+	A cursor into a SharedWatcher's events which sees only changes within a particular directory. Changes are
+	coalesced per path, so reading this gives one net change per path per settle window.
+	"""
+	def __init__(self, pool, watcher, directory, settleTime, maxPending):
+		"""
+		:param maxPending: the most paths with changes which may be waiting to be read; past this, the
+			subscription overflows.
+		"""
+		self._Pool = pool
+		self.Watcher = watcher
+		self.Directory = directory
+		self._Prefix = os.path.join(directory, "")
+		self._Cursor = watcher.Ring.Next
+		self._Pending = Coalescer(settleTime)
+		self._MaxPending = maxPending
+		self._Overflowed = False
+		self.Closed = False
+
+	def _Contains(self, path):
+		return path == self.Directory or path.startswith(self._Prefix)
+
+	def _Pull(self):
+		"""
+		Moves every notification this subscription hasn't seen yet into its pending changes.
+		"""
+		(events, self._Cursor, lost) = self.Watcher.Ring.read(self._Cursor)
+		if lost:
+			logger.warning("Subscription to {} fell behind; {} file changes were dropped", self.Directory, lost)
+			self._Overflow()
+			return
+		# Changes settle from when the watcher saw them, not from when this subscription got around to reading them.
+		for (mode, path, seen) in events:
+			if self._Contains(path):
+				self._Pending.add(mode, path, seen)
+		if len(self._Pending) > self._MaxPending:
+			logger.warning("Subscription to {} has more than {} pending changes", self.Directory, self._MaxPending)
+			self._Overflow()
+
+	def _Overflow(self):
+		self._Pending = Coalescer(self._Pending.SettleTime)
+		self._Overflowed = True
+
+	def _CheckOverflow(self):
+		if self._Overflowed:
+			self._Overflowed = False
+			raise Overflow()
+
+	def get(self, block = True, timeout = None):
+		"""
+		Removes & returns the next settled change as a (mode, path) tuple. Raises queue.Empty if there is none,
+		or Overflow if changes were lost.
+		"""
+		ring = self.Watcher.Ring
+		end_time = None if timeout is None else time.monotonic() + timeout
+		with ring.Condition:
+			while True:
+				self._Pull()
+				self._CheckOverflow()
+				now = time.monotonic()
+				change = self._Pending.pop(now)
+				if change is not None:
+					return change
+				if not block or (end_time is not None and end_time <= now):
+					raise queue.Empty()
+				wake_time = self._Pending.nextSettleTime()
+				if end_time is not None and (wake_time is None or end_time < wake_time):
+					wake_time = end_time
+				ring.Condition.wait(None if wake_time is None else wake_time - now)
+
+	def get_nowait(self):
+		return self.get(False)
+
+	@property
+	def Backlog(self):
+		"""
+		How many notifications are waiting for this subscription: those it hasn't read from the watcher yet, plus
+		changes it's holding until they settle.
+		"""
+		return max(0, self.Watcher.Ring.Next - self._Cursor) + len(self._Pending)
+
+	async def get_async(self, timeout = None):
+		"""
+		Like get, but for use on an asyncio event loop. Rather than blocking a thread, this waits on a future
+		which the watcher resolves when a notification comes in.
+		"""
+		ring = self.Watcher.Ring
+		loop = asyncio.get_running_loop()
+		end_time = None if timeout is None else time.monotonic() + timeout
+		while True:
+			future = loop.create_future()
+			def wake(future = future):
+				loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+			with ring.Condition:
+				self._Pull()
+				self._CheckOverflow()
+				now = time.monotonic()
+				change = self._Pending.pop(now)
+				if change is not None:
+					return change
+				if end_time is not None and end_time <= now:
+					raise queue.Empty()
+				wake_time = self._Pending.nextSettleTime()
+				if end_time is not None and (wake_time is None or end_time < wake_time):
+					wake_time = end_time
+				ring.addWaiter(wake)
+			try:
+				await asyncio.wait([future], timeout=None if wake_time is None else wake_time - now)
+			finally:
+				ring.removeWaiter(wake)
+
+	def close(self):
+		if not self.Closed:
+			self.Closed = True
+			self._Pool._Release(self)
+
+class WatcherPool:
+	"""
+	Hands out Subscriptions to directories while keeping at most one OS watch per directory tree. A
+	subscription to a directory within an already-watched directory reuses the existing watcher.
+
+	Every change a watcher sees is numbered with a generation. Generations only ever increase, even across
+	watchers (and, as they start from the current time, across restarts), so changes(directory, generation)
+	can tell whether the history it holds still reaches back to a generation a client saw earlier.
+	"""
+	RingSize = 10000
+	SettleTime = .1
+	MaxPending = 10000  # The most paths a subscription may have pending changes to; see Subscription.
+	LingerTime = 0
+
+	def __init__(self, callbacks = (), filter = Filter(), backend = None, settleTime = None, lingerTime = None):
+		"""
+		:param callbacks: additional Callbacks which every watcher informs of every change.
+		:param filter: a Filter which decides which paths are reported.
+		:param backend: the Backend class watchers are created with; defaults to the best one for this platform.
+		:param settleTime: how long (in seconds) a file must go unchanged before a change to it is reported.
+		:param lingerTime: how long (in seconds) a watcher keeps running after its last subscription closes,
+			which keeps its history around for clients that reconnect.
+		"""
+		if settleTime is not None:
+			self.SettleTime = settleTime
+		if lingerTime is not None:
+			self.LingerTime = lingerTime
+		self._Callbacks = tuple(callbacks)
+		self._Filter = filter
+		self._Backend = backend
+		self._Watchers = {}  # A map of canonical directory --> SharedWatcher
+		self._Lock = threading.Lock()
+		self._NextGeneration = 0  # No new watcher may number its changes below this.
+
+	@staticmethod
+	def _Canonical(directory):
+		return os.path.normcase(os.path.realpath(directory))
+
+	def _FindWatcher(self, key):
+		for (watcherKey, watcher) in self._Watchers.items():
+			if key == watcherKey or key.startswith(os.path.join(watcherKey, "")):
+				return watcher
+		return None
+
+	def subscribe(self, directory):
+		"""
+		Starts watching a directory.
+		:return: a Subscription which receives every change made within the directory.
+		"""
+		key = self._Canonical(directory)
+		with self._Lock:
+			watcher = self._FindWatcher(key)
+			if watcher is None:
+				logger.info("Starting watcher for {}", directory)
+				# Milliseconds keep generations small enough to survive being a Lua number.
+				# A new watcher's generations never overlap an old one's, so a generation always names one state.
+				generation = max(time.time_ns() // 10**6, self._NextGeneration + 1)
+				watcher = SharedWatcher(directory, key, self._Callbacks, self._Filter, self._Backend, self.RingSize, generation)
+				self._Watchers[key] = watcher
+			if watcher.LingerTimer is not None:
+				watcher.LingerTimer.cancel()
+				watcher.LingerTimer = None
+			watcher.References += 1
+			relative = os.path.relpath(key, watcher.Key)
+			subdirectory = watcher.Directory if relative == os.curdir else os.path.join(watcher.Directory, relative)
+			return Subscription(self, watcher, subdirectory, self.SettleTime, self.MaxPending)
+
+	def _Release(self, subscription):
+		watcher = subscription.Watcher
+		with self._Lock:
+			watcher.References -= 1
+			if watcher.References == 0:
+				if self.LingerTime > 0:
+					watcher.LingerTimer = threading.Timer(self.LingerTime, self._Expire, [watcher])
+					watcher.LingerTimer.daemon = True
+					watcher.LingerTimer.start()
+				else:
+					self._Stop(watcher)
+
+	def _Expire(self, watcher):
+		with self._Lock:
+			if watcher.References == 0 and self._Watchers.get(watcher.Key) is watcher:
+				self._Stop(watcher)
+
+	def _Stop(self, watcher):
+		logger.info("Stopping watcher for {}", watcher.Directory)
+		del self._Watchers[watcher.Key]
+		self._NextGeneration = max(self._NextGeneration, watcher.Ring.Next)
+		watcher.kill()
+
+	def generation(self, directory):
+		"""
+		Gets the generation a directory is at, starting to watch it if it isn't being watched already. Nothing
+		within the directory changes while its generation stays the same.
+		"""
+		subscription = self.subscribe(directory)
+		try:
+			return subscription.Watcher.Ring.Next
+		finally:
+			subscription.close()
+
+	def changes(self, directory, generation):
+		"""
+		Gets the net change to every path within a directory since a generation. This starts watching the
+		directory if it isn't being watched already.
+		:return: (changes, generation) where changes is a list of (mode, path) tuples, or None if the history no
+			longer reaches back to the generation; the generation is the one to ask for changes since next time.
+		"""
+		subscription = self.subscribe(directory)
+		try:
+			(events, next, lost) = subscription.Watcher.Ring.read(generation)
+			if lost or generation > next:
+				return (None, next)
+			pending = Coalescer(0)
+			for (mode, path, seen) in events:
+				if subscription._Contains(path):
+					pending.add(mode, path, 0)
+			return (list(iter(lambda: pending.pop(0), None)), next)
+		finally:
+			subscription.close()
 
+	def __len__(self):
+		return len(self._Watchers)
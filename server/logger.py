@@ -1,33 +1,68 @@
+import atexit
 import os
 import logging
+import logging.handlers
 import inspect
-import traceback
+import queue
+
+class BraceMessage:
+	"""
+	A log message formatted with str.format, but only when (and if) it's needed.
+	"""
+	__slots__ = ("fmt", "args", "kwargs", "_Formatted")
+
+	def __init__(self, fmt, args, kwargs):
+		self.fmt = fmt
+		self.args = args
+		self.kwargs = kwargs
+		self._Formatted = None  # Every handler which emits the record asks for the message.
+
+	def __str__(self):
+		if self._Formatted is None:
+			try:
+				self._Formatted = self.fmt.format(*self.args, **self.kwargs)
+			except (IndexError, KeyError):
+				self._Formatted = "Malformed print statement {!r} with arguments {!r}".format(self.fmt, self.args)
+		return self._Formatted
 
 class StyleAdapter(logging.LoggerAdapter):
+	# The keyword arguments which are meant for Logger._log rather than the message.
+	_LogParameters = tuple(name for name in inspect.signature(logging.Logger._log).parameters if name not in ("self", "level", "msg", "args"))
+
 	def __init__(self, logger):
 		self.logger = logger
 
 	def log(self, level, msg, *args, **kwargs):
 		if self.isEnabledFor(level):
 			log_kwargs = {}
-			log_sig = inspect.signature(self.logger._log)
-			for name in log_sig.parameters:
+			for name in self._LogParameters:
 				if kwargs.get(name):
-					log_kwargs[name] = kwargs[name]
-					del kwargs[name]
-			try:
-				self.logger._log(level, msg.format(*args, **kwargs), (), **log_kwargs)
-			except IndexError as e:
-				# we want a traceback, but the one this exception holds is uninteresting. We want the one of the caller.
-				frame = traceback.extract_stack()[-3]
-				self.logger.error("Malformed print statement at {}:{}".format(frame.filename, frame.lineno))
+					log_kwargs[name] = kwargs.pop(name)
+			# Report where the adapter was called from rather than the adapter itself.
+			log_kwargs["stacklevel"] = log_kwargs.get("stacklevel", 1) + 1
+			self.logger._log(level, BraceMessage(msg, args, kwargs), (), **log_kwargs)
 
-def CreateLogger(debug=False):
+class DeferredQueueHandler(logging.handlers.QueueHandler):
 	"""
-	Creates a logger which emits to the output console (for monitoring the state of the server).
+	A QueueHandler which leaves formatting to the QueueListener's handlers. The standard one formats every record
+	before queueing it, on the thread which logged it.
+
+	A record's arguments are formatted once the listener gets to it, so they shouldn't be changed after they're
+	logged.
+	"""
+	def prepare(self, record):
+		return record
+
+def CreateLogger(level=logging.INFO):
+	"""
+	Creates a logger which emits to the output console (for monitoring the state of the server) & server.log.
+
+	Records are put on a queue & written out by a QueueListener's thread, so no thread that logs ever waits on the
+	console or the disk.
+	:param level: the lowest level which is logged; see SetLevel to change it once the server has started.
 	"""
 	logger = logging.getLogger("SyncyTowne")
-	logger.setLevel(logging.DEBUG if debug else logging.INFO)
+	logger.setLevel(level)
 	formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 	log_to_console = logging.StreamHandler()
 	log_to_console.setFormatter(formatter)
@@ -35,8 +70,19 @@ def CreateLogger(debug=False):
 	commands_file = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "server.log"))
 	log_to_file = logging.FileHandler(commands_file)
 	log_to_file.setFormatter(formatter)
-	logger.addHandler(log_to_console)
-	logger.addHandler(log_to_file)
+	records = queue.SimpleQueue()
+	listener = logging.handlers.QueueListener(records, log_to_console, log_to_file, respect_handler_level=True)
+	listener.start()
+	# Write out whatever is still queued when the server exits.
+	atexit.register(listener.stop)
+	logger.addHandler(DeferredQueueHandler(records))
 	return StyleAdapter(logger)
 
-logger = CreateLogger(True)
+def SetLevel(level):
+	"""
+	Sets the lowest level which is logged.
+	:param level: a logging level, either as a number or a name such as "DEBUG".
+	"""
+	logger.setLevel(level.upper() if isinstance(level, str) else level)
+
+logger = CreateLogger()
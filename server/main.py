@@ -1,3 +1,4 @@
+import argparse
 import filewatch
 import threading
 import time
@@ -5,14 +6,35 @@ import server
 import os
 import logging
 import inspect
+import logger as logger_module
 from logger import logger
 import commandhandler
 
 def main():
+	parser = argparse.ArgumentParser(description="Runs the SyncyTowne server.")
+	parser.add_argument("--server", choices=["threaded", "async"], default="threaded",
+		help="threaded handles each request on its own thread; async handles every request on one asyncio event loop.")
+	parser.add_argument("--log-level", choices=["debug", "info", "warning", "error"], default="info",
+		help="the lowest level of message which is logged; debug logs every file which is hashed or parsed.")
+	parser.add_argument("--sync-writes", action="store_true",
+		help="fsync every write before acknowledging it, so it survives a crash or power loss.")
+	parser.add_argument("--write-behind", action="store_true",
+		help="acknowledge writes once they're queued & make them in the background; clients send flush to wait for them.")
+	parser.add_argument("--io-workers", type=int, default=None,
+		help="the number of threads read_many & write_many spread their files across; by default they use the request's thread.")
+	parser.add_argument("--hash-index", default=commandhandler.DEFAULT_HASH_INDEX_PATH,
+		help="the file the index of file hashes is kept in between runs; defaults to hashindex.json next to the server.")
+	args = parser.parse_args()
+	logger_module.SetLevel(args.log_level)
+
 	root = os.path.realpath(os.path.join(__file__, os.pardir, os.pardir, os.pardir))
-	commandvalidator = commandhandler.create_command_handler(root)
-	webman = server.HttpServer(commandvalidator)
-	logger.info("Starting Server; Parse Root: {}", root)
+	commandvalidator = commandhandler.create_command_handler(root, args.hash_index, ioWorkers=args.io_workers, syncWrites=args.sync_writes, writeBehind=args.write_behind)
+	if args.server == "async":
+		import asyncserver
+		webman = asyncserver.AsyncHttpServer(commandvalidator)
+	else:
+		webman = server.HttpServer(commandvalidator)
+	logger.info("Starting {} Server; Parse Root: {}", args.server, root)
 	webman.start()
 
 	while True:
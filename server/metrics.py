@@ -0,0 +1,167 @@
+"""
+Counters, gauges & histograms describing what the server is doing, rendered in the Prometheus text format (see
+https://prometheus.io/docs/instrumenting/exposition_formats/) for the servers' GET /metrics endpoint.
+
+Metrics live in a Registry; the CommandValidator owns the one its server exposes. Values which something else
+already keeps track of (e.g., the number of watchers) are read from a function whenever the metrics are rendered.
+"""
+
+import bisect
+import threading
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds (in seconds) of the latency histogram buckets. Long polls can take up to
+# FileWatchCommandHandler.POLL_TIMEOUT, so the buckets reach past it.
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+def _EscapeLabel(value):
+	return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _FormatLabels(names, values, extra = ""):
+	labels = ["{}=\"{}\"".format(name, _EscapeLabel(value)) for (name, value) in zip(names, values)]
+	if extra:
+		labels.append(extra)
+	return "{" + ",".join(labels) + "}" if labels else ""
+
+def _FormatValue(value):
+	if value == float("inf"):
+		return "+Inf"
+	if isinstance(value, float) and value.is_integer():
+		return str(int(value))
+	return repr(value) if isinstance(value, float) else str(value)
+
+class Metric:
+	Type = "untyped"
+
+	def __init__(self, name, help, labels = (), function = None):
+		"""
+		:param name: the name of the metric.
+		:param help: a description of the metric.
+		:param labels: the names of the metric's labels.
+		:param function: if given, the metric has no labels & its value is whatever this returns.
+		"""
+		self.Name = name
+		self.Help = help
+		self.Labels = tuple(labels)
+		self._Function = function
+		self._Values = {}  # A map of label values --> value
+		self._Lock = threading.Lock()
+
+	def _Samples(self):
+		"""
+		:return: a list of (suffix, labels, value) tuples.
+		"""
+		if self._Function is not None:
+			return [("", "", self._Function())]
+		with self._Lock:
+			values = sorted(self._Values.items())
+		return [("", _FormatLabels(self.Labels, labels), value) for (labels, value) in values]
+
+	def render(self):
+		lines = [
+			"# HELP {} {}".format(self.Name, self.Help.replace("\\", "\\\\").replace("\n", "\\n")),
+			"# TYPE {} {}".format(self.Name, self.Type),
+		]
+		for (suffix, labels, value) in self._Samples():
+			lines.append("{}{}{} {}".format(self.Name, suffix, labels, _FormatValue(value)))
+		return "\n".join(lines)
+
+class Counter(Metric):
+	Type = "counter"
+
+	def inc(self, *labels, amount = 1):
+		"""
+		Adds to the counter.
+		:param labels: a value for each of the metric's labels.
+		"""
+		with self._Lock:
+			self._Values[labels] = self._Values.get(labels, 0) + amount
+
+	def get(self, *labels):
+		with self._Lock:
+			return self._Values.get(labels, 0)
+
+class Gauge(Metric):
+	Type = "gauge"
+
+	def set(self, value, *labels):
+		with self._Lock:
+			self._Values[labels] = value
+
+class Histogram(Metric):
+	Type = "histogram"
+
+	def __init__(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+		Metric.__init__(self, name, help, labels)
+		self.Buckets = tuple(sorted(buckets))
+
+	def observe(self, value, *labels):
+		"""
+		Records a measurement.
+		:param labels: a value for each of the metric's labels.
+		"""
+		with self._Lock:
+			counts = self._Values.get(labels)
+			if counts is None:
+				# A count for each bucket (& one for +Inf), then the sum of every value.
+				counts = self._Values[labels] = [0] * (len(self.Buckets) + 1) + [0.0]
+			counts[bisect.bisect_left(self.Buckets, value)] += 1
+			counts[-1] += value
+
+	def _Samples(self):
+		with self._Lock:
+			values = sorted((labels, list(counts)) for (labels, counts) in self._Values.items())
+		samples = []
+		for (labels, counts) in values:
+			total = 0
+			for (bound, count) in zip(self.Buckets + (float("inf"),), counts):
+				total += count
+				samples.append(("_bucket", _FormatLabels(self.Labels, labels, "le=\"{}\"".format(_FormatValue(float(bound)))), total))
+			samples.append(("_sum", _FormatLabels(self.Labels, labels), counts[-1]))
+			samples.append(("_count", _FormatLabels(self.Labels, labels), total))
+		return samples
+
+class Registry:
+	"""
+	The set of metrics a server exposes. Asking for a metric which is already registered gives back the existing one.
+	"""
+	def __init__(self):
+		self._Metrics = {}  # A map of name --> Metric, in the order they were registered.
+		self._Lock = threading.Lock()
+
+	def _Register(self, metricClass, name, *args, **kwargs):
+		with self._Lock:
+			metric = self._Metrics.get(name)
+			if metric is None:
+				metric = self._Metrics[name] = metricClass(name, *args, **kwargs)
+			elif not isinstance(metric, metricClass):
+				raise ValueError("Metric {} is already registered as a {}".format(name, metric.Type))
+			return metric
+
+	def counter(self, name, help, labels = (), function = None):
+		return self._Register(Counter, name, help, labels, function)
+
+	def gauge(self, name, help, labels = (), function = None):
+		return self._Register(Gauge, name, help, labels, function)
+
+	def histogram(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+		return self._Register(Histogram, name, help, labels, buckets)
+
+	def render(self):
+		"""
+		:return: every metric in the Prometheus text format.
+		"""
+		with self._Lock:
+			metrics = list(self._Metrics.values())
+		return "".join(metric.render() + "\n" for metric in metrics)
+
+def traffic(registry):
+	"""
+	:return: (received, sent) counters which servers add the size of request & response bodies (as sent over the
+		wire) to.
+	"""
+	return (
+		registry.counter("syncytowne_received_bytes_total", "Bytes of request bodies received."),
+		registry.counter("syncytowne_sent_bytes_total", "Bytes of response bodies sent."),
+	)
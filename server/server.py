@@ -10,9 +10,14 @@ import re
 import functools
 import time
 import queue
+import selectors
+import socket
 import socketserver
 from logger import logger
 import commandhandler
+import compression
+import metrics
+import commandhandler.helpers as helpers
 
 ##############################
 # Helper Classes
@@ -49,6 +54,14 @@ class FixedLengthBufferReader:
 		self.characters_left -= size
 		return self.buffer.read(size).decode('utf-8')
 
+	def readbytes(self):
+		"""
+		Reads everything that's left without decoding it.
+		"""
+		size = self.characters_left
+		self.characters_left = 0
+		return self.buffer.read(size) if size else b""
+
 	def readline(self, size = -1):
 		if size is None or size == -1:
 			size = self.characters_left
@@ -63,6 +76,76 @@ class FixedLengthBufferReader:
 	def close(self):
 		self.buffer.close()
 
+class DisconnectMonitor(threading.Thread):
+	"""
+	Watches the connections of requests which are being handled. If a client disconnects before we've
+	responded, the request's CancellationToken is cancelled so the handler can stop early.
+	"""
+	Interval = .25  # How often (in seconds) we pick up newly registered connections.
+
+	def __init__(self):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self._Lock = threading.Lock()
+		self._Connections = {}  # A map of socket --> CancellationToken
+		self._Started = False
+
+	def register(self, connection, token):
+		with self._Lock:
+			self._Connections[connection] = token
+			if not self._Started:
+				self._Started = True
+				self.start()
+
+	def unregister(self, connection):
+		with self._Lock:
+			self._Connections.pop(connection, None)
+
+	def run(self):
+		selector = selectors.DefaultSelector()
+		watching = {}  # A map of socket --> token for every socket registered with the selector.
+		examined = {}  # A map of socket --> token for requests we've stopped watching.
+		while True:
+			with self._Lock:
+				connections = dict(self._Connections)
+			for connection in [c for c in watching if connections.get(c) is not watching[c]]:
+				del watching[connection]
+				try:
+					selector.unregister(connection)
+				except (KeyError, ValueError, OSError):
+					pass
+			for connection in [c for c in examined if connections.get(c) is not examined[c]]:
+				del examined[connection]
+			for (connection, token) in connections.items():
+				if connection not in watching and examined.get(connection) is not token:
+					try:
+						selector.register(connection, selectors.EVENT_READ)
+						watching[connection] = token
+					except (KeyError, ValueError, OSError):
+						pass
+			if not watching:
+				time.sleep(self.Interval)
+				continue
+			try:
+				events = selector.select(self.Interval)
+			except OSError:
+				continue
+			for (key, mask) in events:
+				connection = key.fileobj
+				token = watching.pop(connection)
+				selector.unregister(connection)
+				# Either way, there's nothing more to learn from this connection until the request is done.
+				examined[connection] = token
+				try:
+					disconnected = connection.recv(1, socket.MSG_PEEK) == b""
+				except BlockingIOError:
+					disconnected = False
+				except OSError:
+					disconnected = True
+				if disconnected:
+					logger.info("Client disconnected; cancelling its request")
+					token.cancel()
+
 ##############################
 # Request Handler
 ##############################
@@ -71,34 +154,187 @@ class CommandParserHandler(http.server.BaseHTTPRequestHandler):
 	"""
 	Parses the input for the SyncyTowne protocol & creates objects to handle the requests.
 	"""
-	def __init__(self, *args, commandvalidator, **kwargs):
+	# HTTP/1.1 gives us chunked responses & persistent connections, so clients needn't reconnect for every command.
+	protocol_version = "HTTP/1.1"
+	timeout = 60  # How long (in seconds) an idle connection is kept open.
+	# The headers & body go out in separate writes; with Nagle's algorithm, a persistent connection would stall
+	# on every response waiting for the client's delayed ACK.
+	disable_nagle_algorithm = True
+	MAX_REQUESTS_PER_CONNECTION = 1000  # The connection is closed after this many requests.
+	STREAM_CHUNK_SIZE = 16 * 1024  # Streamed responses are sent in chunks of at least this many bytes...
+	STREAM_FLUSH_INTERVAL = .05  # ...unless this many seconds pass first.
+
+	def __init__(self, *args, commandvalidator, disconnectmonitor = None, idletimeout = None, maxrequests = None, compressor = None, **kwargs):
 		self._command_validator = commandvalidator
+		self._disconnect_monitor = disconnectmonitor
+		self._compressor = compressor
+		self._stream_compressor = None
+		(self._received_bytes, self._sent_bytes) = metrics.traffic(commandvalidator.metrics)
+		if idletimeout is not None:
+			self.timeout = idletimeout
+		if maxrequests is not None:
+			self.MAX_REQUESTS_PER_CONNECTION = maxrequests
+		self._RequestCount = 0
 		http.server.BaseHTTPRequestHandler.__init__(self, *args, **kwargs)
 
+	def _CountRequest(self):
+		self._RequestCount += 1
+		if self._RequestCount >= self.MAX_REQUESTS_PER_CONNECTION:
+			self.close_connection = True
+
+	def do_GET(self):
+		self._CountRequest()
+		if self.path.partition("?")[0] != "/metrics":
+			self.send_error(404)
+			return
+		body = self._command_validator.metrics.render().encode()
+		self.send_response(200)
+		self.send_header("content-type", metrics.CONTENT_TYPE)
+		self.send_header("content-length", len(body))
+		self._SendConnectionHeader()
+		self.end_headers()
+		self.wfile.write(body)
+
 	def do_POST(self):
-		# If the client is expecting us to send a "continue", do it.
-		if self.headers.get("expect", "").lower() == "100-continue":
-			self.handle_expect_100()
+		self._CountRequest()
+		# An "Expect: 100-continue" has already been answered by parse_request.
 
 		# Let the CommandValidator handle the request.
+		# The request stays as bytes; the CommandValidator decodes only what it needs to.
 		rfile = FixedLengthBufferReader.from_http_request(self)
-		request = rfile.read()
+		request = rfile.readbytes()
+		self._received_bytes.inc(amount=len(request))
+		token = helpers.CancellationToken()
+		if self._disconnect_monitor is not None:
+			self._disconnect_monitor.register(self.connection, token)
 		try:
-			response = self._command_validator.handle(request)
+			# Streamed responses are generated as they're sent, so they need the token, too.
+			with helpers.Cancellation(token), helpers.Origin(self.headers.get(helpers.SESSION_HEADER)), helpers.HashAlgorithm(self.headers.get(helpers.HASH_ALGORITHM_HEADER)):
+				self._HandleRequest(request)
+		finally:
+			if self._disconnect_monitor is not None:
+				self._disconnect_monitor.unregister(self.connection)
+
+	def _HandleRequest(self, request):
+		coding = None
+		if self._compressor is not None:
+			coding = compression.negotiate(self.headers.get("accept-encoding"))
+		key = None
+		compressed = None
+		try:
+			request = compression.decode(request, self.headers.get("content-encoding"))
+			response = self._command_validator.handle_streaming(request)
+			if not isinstance(response, str):
+				if self.request_version == "HTTP/1.0":
+					# HTTP/1.0 clients don't understand chunked responses.
+					response = "".join(response)
+				elif coding is not None:
+					key = getattr(response, "CacheKey", None)
+					compressed = self._compressor.cached(key, coding) if key is not None else None
+					if compressed is not None:
+						# We've sent this very response before, so it needn't be generated again.
+						response.close()
+						response = b""
+					else:
+						# A stream which ends before it's worth compressing is sent whole.
+						(body, rest) = self._compressor.buffer(response)
+						response = rest if body is None else body
+		except helpers.Cancelled:
+			logger.info("Request cancelled; not responding")
+			self.close_connection = True
 		except commandhandler.HttpException as e:
 			logger.warning("", exc_info=e)
-			traceback.print_exception(e, "", e.__traceback__)
 			self.send_error(e.code, e.msg, e.explain)
 		except Exception as e:
 			logger.error("", exc_info=e)
-			traceback.print_exception(e, "", e.__traceback__)
 			self.send_error(500)
 		else:
-			self.send_response(200)
-			bytes = response.encode()
-			self.send_header("content-length", len(bytes))
-			self.end_headers()
-			self.wfile.write(bytes)
+			if isinstance(response, str):
+				self._SendBody(response.encode(), coding)
+			elif isinstance(response, bytes):
+				self._SendBody(response, coding, compressed)
+			else:
+				self._SendChunked(response, coding, key)
+
+	def _SendBody(self, body, coding = None, compressed = None):
+		"""
+		Sends a response all at once, compressing it if it's worth it.
+		:param coding: the content-coding the client asked for, or None.
+		:param compressed: the body already compressed with the coding, if it has been.
+		"""
+		if compressed is None and coding is not None:
+			compressed = self._compressor.compress(body, coding)
+		self.send_response(200)
+		if compressed is not None:
+			self.send_header("content-encoding", coding)
+			body = compressed
+		self.send_header("content-length", len(body))
+		self._SendConnectionHeader()
+		self.end_headers()
+		self.wfile.write(body)
+		self._sent_bytes.inc(amount=len(body))
+
+	def _SendChunked(self, pieces, coding = None, key = None):
+		"""
+		Sends a streamed response using chunked transfer encoding.
+		:param pieces: an iterator of strings (or bytes).
+		:param coding: the content-coding to compress the response with, or None.
+		:param key: the response's CacheKey, if it has one; see Compressor.stream.
+		"""
+		self._stream_compressor = self._compressor.stream(coding, key) if coding is not None else None
+		self.send_response(200)
+		if coding is not None:
+			self.send_header("content-encoding", coding)
+		self.send_header("transfer-encoding", "chunked")
+		self._SendConnectionHeader()
+		self.end_headers()
+		buffer = []
+		size = 0
+		flush_time = None
+		try:
+			for piece in pieces:
+				data = piece.encode() if isinstance(piece, str) else piece
+				if not data:
+					continue
+				buffer.append(data)
+				size += len(data)
+				if flush_time is None:
+					flush_time = time.monotonic() + self.STREAM_FLUSH_INTERVAL
+				if size >= self.STREAM_CHUNK_SIZE or time.monotonic() >= flush_time:
+					self._WriteChunk(b"".join(buffer))
+					buffer = []
+					size = 0
+					flush_time = None
+			if buffer:
+				self._WriteChunk(b"".join(buffer))
+			if self._stream_compressor is not None:
+				self._WriteChunk(self._stream_compressor.finish(), compress=False)
+			self.wfile.write(b"0\r\n\r\n")
+		except helpers.Cancelled:
+			logger.info("Request cancelled while streaming the response")
+			self.close_connection = True
+		except Exception as e:
+			# The status line is long gone; all we can do is cut the response short.
+			logger.error("Failed while streaming response", exc_info=e)
+			self.close_connection = True
+		finally:
+			if hasattr(pieces, "close"):
+				pieces.close()
+
+	def _SendConnectionHeader(self):
+		if self.close_connection:
+			self.send_header("connection", "close")
+		elif self.request_version == "HTTP/1.0":
+			# The client asked for keep-alive (or close_connection would be set); let it know it got it.
+			self.send_header("connection", "keep-alive")
+
+	def _WriteChunk(self, data, compress = True):
+		if compress and self._stream_compressor is not None:
+			data = self._stream_compressor.compress(data)
+		if not data:
+			return  # An empty chunk would end the response.
+		self.wfile.write(b"%x\r\n" % len(data) + data + b"\r\n")
+		self._sent_bytes.inc(amount=len(data))
 
 	def log_message(self, format, *args):
 		logger.info(format % args)
@@ -106,15 +342,28 @@ class CommandParserHandler(http.server.BaseHTTPRequestHandler):
 
 class ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
     """Handle requests in a separate thread."""
+    daemon_threads = True  # Idle keep-alive connections mustn't keep the process alive.
 
 class HttpServer(threading.Thread):
 	ParseRoot = "."
-	def __init__(self, commandvalidator):
+	def __init__(self, commandvalidator, port = 605, idleTimeout = None, maxRequestsPerConnection = None, compressor = None):
+		"""
+		:param commandvalidator: the CommandValidator which handles every request.
+		:param port: the port to listen on.
+		:param idleTimeout: how long (in seconds) an idle connection is kept open; see CommandParserHandler.timeout.
+		:param maxRequestsPerConnection: see CommandParserHandler.MAX_REQUESTS_PER_CONNECTION.
+		:param compressor: the compression.Compressor responses are compressed with; defaults to a new one.
+		"""
 		threading.Thread.__init__(self)
 		self.setDaemon(True)
+		disconnectmonitor = DisconnectMonitor()
+		self.Compressor = compressor or compression.Compressor()
+		commandvalidator.metrics.counter("syncytowne_compression_cache_hits_total", "Compressed responses served from the cache.",
+			function=lambda: self.Compressor.Hits)
 		def generateCommandParserHandler(*args, **kwargs):
-			return CommandParserHandler(*args, **kwargs, commandvalidator=commandvalidator)
-		self.server = ThreadedHTTPServer(("", 605), generateCommandParserHandler)
+			return CommandParserHandler(*args, **kwargs, commandvalidator=commandvalidator, disconnectmonitor=disconnectmonitor,
+				idletimeout=idleTimeout, maxrequests=maxRequestsPerConnection, compressor=self.Compressor)
+		self.server = ThreadedHTTPServer(("", port), generateCommandParserHandler)
 		self.server.daemon = True
 
 	def run(self):
@@ -122,4 +371,5 @@ class HttpServer(threading.Thread):
 
 	def kill(self):
 		self.server.shutdown()
+		self.server.server_close()
 
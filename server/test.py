@@ -9,6 +9,9 @@ import logging
 import filewatch
 import time
 import commandhandler
+import compression
+import queue
+import zlib
 
 VERSION_MAP = {
 	10: "HTTP/1.0",
@@ -26,6 +29,11 @@ class HttpResponse:
 		self.Content = ""
 		if self.Headers.get("content-length"):
 			self.Content = http.read(int(self.Headers['content-length']))
+		elif self.Headers.get("transfer-encoding") == "chunked":
+			self.Content = http.read()
+		if self.Content and self.Headers.get("content-encoding") in compression.CODINGS:
+			self.Content = zlib.decompress(self.Content, compression.CODINGS[self.Headers["content-encoding"]])
+		if isinstance(self.Content, bytes):
 			self.Content = self.Content.decode('utf-8')
 
 	def __str__(self):
@@ -40,7 +48,8 @@ class HttpResponse:
 class TestServer(unittest.TestCase):
 	def setUpClass():
 		commandHandler = commandhandler.create_command_handler(os.path.realpath(os.path.join(os.path.dirname(__file__), "testdir")))
-		TestServer.webman = server.HttpServer(commandHandler)
+		# A low threshold lets the compression tests use the (small) test directory.
+		TestServer.webman = server.HttpServer(commandHandler, compressor=compression.Compressor(threshold=32))
 		TestServer.webman.start()
 
 	def tearDownClass():
@@ -84,6 +93,133 @@ morefiles/file3.txt 0
 		response = self.get_response("parse\n\n1\nTrue")
 		self.assertEqual(response.Content, "file1.txt 6\n")
 
+	def test_hash_algorithm_is_per_request(self):
+		self.assertEqual(self.get_response("hash_algorithm\ncrc32 length").Content, "crc32")
+		# Agreeing upon an algorithm doesn't change it for other clients.
+		self.assertEqual(self.get_response("hash\nfoobar").Content, "6")
+		response = self.get_response("hash\nfoobar", {commandhandler.helpers.HASH_ALGORITHM_HEADER: "crc32"})
+		self.assertEqual(response.Content, "{:08x}".format(zlib.crc32(b"foobar")))
+
+	def test_streamed_parse(self):
+		response = self.get_response("parse\nmorefiles\n0\nTrue")
+		self.assertEqual(response.Headers.get("transfer-encoding"), "chunked")
+		self.assertEqual(response.Content, "morefiles/file2.txt 0\nmorefiles/file3.txt 0\n")
+
+	def test_streamed_read(self):
+		import commandhandler.readwritehandler as readwritehandler
+		contents = "0123456789abcdef\n" * (readwritehandler.RWCommandHandler.STREAM_THRESHOLD // 16)
+		self.get_response("write\nbigfile.txt\n" + contents)
+		try:
+			response = self.get_response("read\nbigfile.txt")
+			self.assertEqual(response.Headers.get("transfer-encoding"), "chunked")
+			self.assertEqual(response.Content, contents)
+		finally:
+			self.get_response("delete\nbigfile.txt")
+
+	def test_read_write_many(self):
+		response = self.get_response("write_many\nfile1.txt\n6\nfoobarmorefiles/file2.txt\n0\n")
+		self.assertEqual(response.Content, "file1.txt\nok\n0\nmorefiles/file2.txt\nok\n0\n")
+		response = self.get_response("read_many\nfile1.txt\nmorefiles/file2.txt")
+		self.assertEqual(response.Content, "file1.txt\nok\n6\nfoobarmorefiles/file2.txt\nok\n0\n")
+
+	def test_binary_write(self):
+		contents = bytes(range(256)) + b"a\nb\r\nc\xff\xfe\xc3("
+		try:
+			response = self.get_response(b"write\nasset.bin\n" + contents)
+			self.assertEqual(response.StatusCode, 200)
+			with open("testdir/asset.bin", "rb") as f:
+				self.assertEqual(f.read(), contents)
+		finally:
+			os.remove("testdir/asset.bin")
+
+	def test_compressed_response(self):
+		for coding in ("gzip", "deflate"):
+			response = self.get_response("parse\n\n0\nFalse", {"Accept-Encoding": "br;q=1, {};q=0.5".format(coding)})
+			self.assertEqual(response.Headers.get("content-encoding"), coding)
+			self.assertEqual(response.Content, "file1.txt\nmorefiles/file2.txt\nmorefiles/file3.txt\nsubdir1/subdir2/file4.txt\n")
+		# Nothing under the threshold is compressed.
+		response = self.get_response("hash\nfoo", {"Accept-Encoding": "gzip"})
+		self.assertIsNone(response.Headers.get("content-encoding"))
+		self.assertEqual(response.Content, "3")
+
+	def test_compressed_read_is_cached(self):
+		compressor = TestServer.webman.Compressor
+		self.get_response("write\nsmallfile.txt\n" + "print('hello world')\n" * 10)
+		try:
+			self.get_response("read\nsmallfile.txt", {"Accept-Encoding": "gzip"})
+			(hits, misses) = (compressor.Hits, compressor.Misses)
+			response = self.get_response("read\nsmallfile.txt", {"Accept-Encoding": "gzip"})
+			self.assertEqual(response.Headers.get("content-encoding"), "gzip")
+			self.assertEqual((compressor.Hits, compressor.Misses), (hits + 1, misses))
+		finally:
+			self.get_response("delete\nsmallfile.txt")
+
+	def test_compressed_parse_is_streamed(self):
+		response = self.get_response("parse\n\n0\nTrue", {"Accept-Encoding": "gzip"})
+		self.assertEqual(response.Headers.get("transfer-encoding"), "chunked")
+		self.assertEqual(response.Headers.get("content-encoding"), "gzip")
+		self.assertTrue(response.Content.startswith("file1.txt 6\n"))
+
+	def test_compressed_parse_is_cached(self):
+		compressor = TestServer.webman.Compressor
+		self.get_response("write\nfile1.txt\nfoobar")
+		first = self.get_response("parse\n\n0\nTrue", {"Accept-Encoding": "gzip"})
+		(hits, misses) = (compressor.Hits, compressor.Misses)
+		# An unchanged tree is sent from the cache, whole.
+		second = self.get_response("parse\n\n0\nTrue", {"Accept-Encoding": "gzip"})
+		self.assertEqual(compressor.Hits, hits + 1)
+		self.assertIsNone(second.Headers.get("transfer-encoding"))
+		self.assertEqual(second.Headers.get("content-encoding"), "gzip")
+		self.assertEqual(second.Content, first.Content)
+		# Once the tree changes, it's generated afresh.
+		try:
+			self.get_response("write\nfile1.txt\nfoo")
+			end_time = time.monotonic() + 2
+			while time.monotonic() < end_time:
+				third = self.get_response("parse\n\n0\nTrue", {"Accept-Encoding": "gzip"})
+				if third.Content != first.Content:
+					break
+				time.sleep(.05)
+			self.assertTrue(third.Content.startswith("file1.txt 3\n"))
+		finally:
+			self.get_response("write\nfile1.txt\nfoobar")
+
+	def test_compressed_streamed_read(self):
+		import commandhandler.readwritehandler as readwritehandler
+		contents = "print('hello world')\n" * (2 * readwritehandler.RWCommandHandler.STREAM_THRESHOLD // 20)
+		self.get_response("write\nbigfile.txt\n" + contents)
+		try:
+			response = self.get_response("read\nbigfile.txt", {"Accept-Encoding": "gzip"})
+			self.assertEqual(response.Headers.get("transfer-encoding"), "chunked")
+			self.assertEqual(response.Headers.get("content-encoding"), "gzip")
+			self.assertEqual(response.Content, contents)
+		finally:
+			self.get_response("delete\nbigfile.txt")
+
+	def test_compressed_request(self):
+		for (coding, wbits) in (("gzip", 31), ("deflate", 15), ("deflate", -15)):
+			compressor = zlib.compressobj(wbits=wbits)
+			body = compressor.compress(b"write\nfile1.txt\n" + coding.encode()) + compressor.flush()
+			self.assertEqual(self.get_response(body, {"Content-Encoding": coding}).StatusCode, 200)
+			self.assertEqual(self.get_response("read\nfile1.txt").Content, coding)
+		self.assertEqual(self.get_response("write\nfile1.txt\nfoo", {"Content-Encoding": "br"}).StatusCode, 415)
+		self.assertEqual(self.get_response("write\nfile1.txt\nfoo", {"Content-Encoding": "gzip"}).StatusCode, 400)
+
+	def test_metrics(self):
+		self.get_response("hash\nfoo")
+		self.get_response("no_such_command\n")
+		self.cxn.request("GET", "/metrics")
+		response = HttpResponse(self.cxn.getresponse())
+		self.assertEqual(response.StatusCode, 200)
+		self.assertTrue(response.Headers["content-type"].startswith("text/plain; version=0.0.4"))
+		lines = response.Content.splitlines()
+		self.assertIn("# TYPE syncytowne_request_duration_seconds histogram", lines)
+		self.assertTrue(any(line.startswith('syncytowne_requests_total{command="hash",code="200"} ') for line in lines))
+		self.assertTrue(any(line.startswith('syncytowne_requests_total{command="unknown",code="400"} ') for line in lines))
+		self.assertTrue(any(line.startswith("syncytowne_received_bytes_total ") for line in lines))
+		self.cxn.request("GET", "/")
+		self.assertEqual(HttpResponse(self.cxn.getresponse()).StatusCode, 404)
+
 	def test_read_with_leading_slash(self):
 		response = self.get_response("read\n/morefiles/file2.txt")
 		self.assertEqual(response.Content, "")
@@ -99,15 +235,32 @@ morefiles/file3.txt 0
 		f.write("foobar")
 		f.close()
 		response = self.get_response("watch_poll\n{}".format(id))
-		self.assertEqual(response.Content, "modify file1.txt 6")
+		self.assertEqual(response.Content, "modify 'file1.txt' 6")
 		f = open("testdir/morefiles/file2.txt", "w")
 		f.write("")
 		f.close()
 		response = self.get_response("watch_poll\n{}".format(id))
-		self.assertEqual(response.Content, "modify morefiles/file2.txt 0")
+		self.assertEqual(response.Content, "modify 'morefiles/file2.txt' 0")
 		response = self.get_response("watch_stop\n{}".format(id))
 		self.assertEqual(response.StatusCode, 200)
 
+	def test_no_self_echo(self):
+		writer = int(self.get_response("watch_start\n").Content)
+		other = int(self.get_response("watch_start\n").Content)
+		try:
+			time.sleep(.2)  # Give the watcher a moment to start.
+			self.get_response("write\nfile1.txt\nfoobar", {"X-SyncyTowne-Session": str(writer)})
+			response = self.get_response("watch_poll_batch\n{}\n0".format(other))
+			self.assertEqual(response.Content, "modify 'file1.txt' 6")
+			with open("testdir/morefiles/file2.txt", "w") as f:
+				f.write("")
+			# The writer only hears about the change it didn't make.
+			response = self.get_response("watch_poll_batch\n{}\n0".format(writer))
+			self.assertEqual(response.Content, "modify 'morefiles/file2.txt' 0")
+		finally:
+			self.get_response("watch_stop\n{}".format(writer))
+			self.get_response("watch_stop\n{}".format(other))
+
 	def test_proper_speed(self):
 		"""
 		Tests that invocations to the server are handled at the correct clip and don't have
@@ -127,6 +280,258 @@ morefiles/file3.txt 0
 		response = self.get_response("hash\n", {"Expect": "100-continue"})
 		# This doesn't really test much except that the server doesn't crash and burn.
 
+class TestKeepAlive(unittest.TestCase):
+	Port = 608
+
+	def setUpClass():
+		commandHandler = commandhandler.create_command_handler(os.path.realpath(os.path.join(os.path.dirname(__file__), "testdir")))
+		TestKeepAlive.webman = server.HttpServer(commandHandler, TestKeepAlive.Port, idleTimeout=.3, maxRequestsPerConnection=3)
+		TestKeepAlive.webman.start()
+
+	def tearDownClass():
+		TestKeepAlive.webman.kill()
+
+	def setUp(self):
+		self.cxn = http.client.HTTPConnection("127.0.0.1", self.Port)
+
+	def tearDown(self):
+		self.cxn.close()
+
+	def get_response(self, body):
+		self.cxn.request("POST", "/", body)
+		return HttpResponse(self.cxn.getresponse())
+
+	def test_connection_is_reused(self):
+		self.get_response("hash\nfoo")
+		sock = self.cxn.sock
+		response = self.get_response("parse\nmorefiles\n0\nTrue")
+		self.assertIs(self.cxn.sock, sock)
+		self.assertEqual(response.Content, "morefiles/file2.txt 0\nmorefiles/file3.txt 0\n")
+		self.assertIsNone(response.Headers.get("connection"))
+
+	def test_errors_keep_the_framing(self):
+		self.assertEqual(self.get_response("no_such_command\n").StatusCode, 400)
+		self.assertEqual(self.get_response("hash\nfoo").Content, "3")
+
+	def test_request_limit(self):
+		for i in range(2):
+			self.assertIsNone(self.get_response("hash\nfoo").Headers.get("connection"))
+		self.assertEqual(self.get_response("hash\nfoo").Headers.get("connection"), "close")
+
+	def test_expect_continue_is_answered_once(self):
+		import socket
+		with socket.create_connection(("127.0.0.1", self.Port)) as sock:
+			reader = sock.makefile("rb")
+			sock.sendall(b"POST / HTTP/1.1\r\nHost: localhost\r\nContent-Length: 8\r\nExpect: 100-continue\r\n\r\n")
+			self.assertEqual(reader.readline(), b"HTTP/1.1 100 Continue\r\n")
+			self.assertEqual(reader.readline(), b"\r\n")
+			sock.sendall(b"hash\nfoo")
+			self.assertEqual(reader.readline(), b"HTTP/1.1 200 OK\r\n")
+			while reader.readline() != b"\r\n":
+				pass
+			self.assertEqual(reader.read(1), b"3")
+			# Nothing else is waiting to be read as the response to the next request.
+			sock.sendall(b"POST / HTTP/1.1\r\nHost: localhost\r\nContent-Length: 8\r\n\r\nhash\nfoo")
+			self.assertEqual(reader.readline(), b"HTTP/1.1 200 OK\r\n")
+
+	def test_idle_timeout(self):
+		self.get_response("hash\nfoo")
+		time.sleep(.6)
+		self.assertEqual(self.cxn.sock.recv(1), b"")
+
+class TestAsyncServer(unittest.TestCase):
+	Port = 606
+
+	def setUpClass():
+		import asyncserver
+		commandHandler = commandhandler.create_command_handler(os.path.realpath(os.path.join(os.path.dirname(__file__), "testdir")))
+		TestAsyncServer.webman = asyncserver.AsyncHttpServer(commandHandler, TestAsyncServer.Port, workers=2)
+		TestAsyncServer.webman.start()
+
+	def tearDownClass():
+		TestAsyncServer.webman.kill()
+
+	def setUp(self):
+		self.cxn = http.client.HTTPConnection("127.0.0.1", self.Port)
+
+	def tearDown(self):
+		self.cxn.close()
+
+	def get_response(self, body, headers={}):
+		self.cxn.close()
+		self.cxn.request("POST", "/", body, headers)
+		return HttpResponse(self.cxn.getresponse())
+
+	def test_write_read(self):
+		self.get_response("write\nfile1.txt\nfoobar")
+		response = self.get_response("read\nfile1.txt")
+		self.assertEqual(response.Content, "foobar")
+
+	def test_streamed_parse(self):
+		response = self.get_response("parse\nmorefiles\n0\nTrue")
+		self.assertEqual(response.Headers.get("transfer-encoding"), "chunked")
+		self.assertEqual(response.Content, "morefiles/file2.txt 0\nmorefiles/file3.txt 0\n")
+
+	def test_bad_command(self):
+		response = self.get_response("no_such_command\n")
+		self.assertEqual(response.StatusCode, 400)
+
+	def test_hash_algorithm_header(self):
+		response = self.get_response("parse\n\n1\nTrue", {commandhandler.helpers.HASH_ALGORITHM_HEADER: "crc32"})
+		self.assertEqual(response.Content, "file1.txt {:08x}\n".format(zlib.crc32(b"foobar")))
+		self.assertEqual(self.get_response("parse\n\n1\nTrue").Content, "file1.txt 6\n")
+
+	def test_compression(self):
+		TestAsyncServer.webman.Compressor.Threshold = 32
+		try:
+			body = zlib.compress(b"write\nfile1.txt\nfoobar")
+			self.assertEqual(self.get_response(body, {"Content-Encoding": "deflate"}).StatusCode, 200)
+			response = self.get_response("parse\n\n0\nTrue", {"Accept-Encoding": "gzip"})
+			self.assertEqual(response.Headers.get("content-encoding"), "gzip")
+			self.assertEqual(response.Content, "file1.txt 6\nmorefiles/file2.txt 0\nmorefiles/file3.txt 0\nsubdir1/subdir2/file4.txt 0\n")
+			# The same tree again comes from the cache.
+			hits = TestAsyncServer.webman.Compressor.Hits
+			again = self.get_response("parse\n\n0\nTrue", {"Accept-Encoding": "gzip"})
+			self.assertEqual(TestAsyncServer.webman.Compressor.Hits, hits + 1)
+			self.assertEqual(again.Content, response.Content)
+		finally:
+			del TestAsyncServer.webman.Compressor.Threshold
+
+	def test_metrics(self):
+		self.get_response("hash\nfoo")
+		self.cxn.close()
+		self.cxn.request("GET", "/metrics")
+		response = HttpResponse(self.cxn.getresponse())
+		self.assertEqual(response.StatusCode, 200)
+		self.assertIn('syncytowne_requests_total{command="hash",code="200"}', response.Content)
+
+	def test_long_polls_share_the_loop(self):
+		import concurrent.futures
+		ids = [int(self.get_response("watch_start\n").Content) for i in range(8)]
+		def poll(id):
+			cxn = http.client.HTTPConnection("127.0.0.1", self.Port)
+			try:
+				cxn.request("POST", "/", "watch_poll_batch\n{}\n0".format(id))
+				return HttpResponse(cxn.getresponse()).Content
+			finally:
+				cxn.close()
+		# More polls than the server has worker threads are parked at once, yet ordinary requests still go through.
+		with concurrent.futures.ThreadPoolExecutor(len(ids)) as pool:
+			polls = [pool.submit(poll, id) for id in ids]
+			time.sleep(.3)
+			self.assertEqual(self.get_response("read\nmorefiles/file2.txt").Content, "")
+			self.cxn.close()
+			self.cxn.request("GET", "/metrics")
+			self.assertIn("\nsyncytowne_long_polls_active {}\n".format(len(ids)), HttpResponse(self.cxn.getresponse()).Content)
+			f = open("testdir/file1.txt", "w")
+			f.write("foobar")
+			f.close()
+			for future in polls:
+				self.assertEqual(future.result(timeout=5), "modify 'file1.txt' 6")
+		for id in ids:
+			self.get_response("watch_stop\n{}".format(id))
+
+class TestCompression(unittest.TestCase):
+	def test_negotiate(self):
+		self.assertEqual(compression.negotiate(None), None)
+		self.assertEqual(compression.negotiate("identity"), None)
+		self.assertEqual(compression.negotiate("deflate, gzip"), "gzip")
+		self.assertEqual(compression.negotiate("gzip;q=0.5, deflate"), "deflate")
+		self.assertEqual(compression.negotiate("gzip;q=0, *"), "deflate")
+		self.assertEqual(compression.negotiate("br, *;q=0"), None)
+
+	def test_decode_limit(self):
+		body = zlib.compress(b"a" * 1000)
+		self.assertEqual(compression.decode(body, "deflate", 1000), b"a" * 1000)
+		with self.assertRaises(commandhandler.HttpException) as context:
+			compression.decode(body, "deflate", 999)
+		self.assertEqual(context.exception.code, 413)
+
+	def test_cache_eviction(self):
+		compressor = compression.Compressor(threshold=0, cacheSize=100)
+		bodies = [os.urandom(60) for i in range(3)]
+		for body in bodies:
+			self.assertEqual(zlib.decompress(compressor.compress(body, "deflate")), body)
+		self.assertEqual(len(compressor._Cache), 1)
+		compressor.compress(bodies[-1], "deflate")
+		self.assertEqual((compressor.Hits, compressor.Misses), (1, 3))
+
+	def test_buffer(self):
+		compressor = compression.Compressor(threshold=10)
+		self.assertEqual(compressor.buffer(iter(["abc", "def"])), (b"abcdef", None))
+		pulled = []
+		def pieces():
+			for piece in ("abcdef", "ghijkl", "mno"):
+				pulled.append(piece)
+				yield piece
+		(body, rest) = compressor.buffer(pieces())
+		self.assertIsNone(body)
+		# Nothing past the threshold is read ahead of sending.
+		self.assertEqual(pulled, ["abcdef", "ghijkl"])
+		self.assertEqual(b"".join(piece if isinstance(piece, bytes) else piece.encode() for piece in rest), b"abcdefghijklmno")
+
+class TestMetrics(unittest.TestCase):
+	def test_render(self):
+		import metrics
+		registry = metrics.Registry()
+		counter = registry.counter("requests_total", "Requests.", ("command",))
+		counter.inc("read")
+		counter.inc('say "hi"', amount=2)
+		self.assertIs(registry.counter("requests_total", "Requests.", ("command",)), counter)
+		histogram = registry.histogram("latency_seconds", "Latency.", buckets=(.1, 1))
+		histogram.observe(.1)
+		histogram.observe(.5)
+		histogram.observe(5)
+		registry.gauge("things", "Things.", function=lambda: 3)
+		self.assertEqual(registry.render(), "\n".join([
+			"# HELP requests_total Requests.",
+			"# TYPE requests_total counter",
+			'requests_total{command="read"} 1',
+			'requests_total{command="say \\"hi\\""} 2',
+			"# HELP latency_seconds Latency.",
+			"# TYPE latency_seconds histogram",
+			'latency_seconds_bucket{le="0.1"} 1',
+			'latency_seconds_bucket{le="1"} 2',
+			'latency_seconds_bucket{le="+Inf"} 3',
+			"latency_seconds_sum 5.6",
+			"latency_seconds_count 3",
+			"# HELP things Things.",
+			"# TYPE things gauge",
+			"things 3",
+			""]))
+
+class TestLogger(unittest.TestCase):
+	def test_formatting_is_deferred(self):
+		import logger
+		formatted = []
+		class Argument:
+			def __format__(self, spec):
+				formatted.append(spec)
+				return "argument"
+		logger.logger.debug("{}", Argument())
+		self.assertEqual(formatted, [])
+		self.assertEqual(str(logger.BraceMessage("{} & {x}", (Argument(),), {"x": 1})), "argument & 1")
+		self.assertIn("Malformed", str(logger.BraceMessage("{} {}", (1,), {})))
+
+	def test_queue_handler_does_not_format(self):
+		import logger
+		import logging
+		import queue
+		formatted = []
+		class Argument:
+			def __format__(self, spec):
+				formatted.append(spec)
+				return "argument"
+		records = queue.SimpleQueue()
+		record = logging.LogRecord("SyncyTowne", logging.INFO, __file__, 1, logger.BraceMessage("{}", (Argument(),), {}), (), None)
+		logger.DeferredQueueHandler(records).handle(record)
+		# The record is formatted by the listener's handlers, not on the thread which logged it...
+		self.assertIs(records.get_nowait(), record)
+		self.assertEqual(formatted, [])
+		# ...& only once, however many handlers there are.
+		self.assertEqual((record.getMessage(), record.getMessage()), ("argument", "argument"))
+		self.assertEqual(len(formatted), 1)
+
 class FileWatch(unittest.TestCase):
 	class LogCallbacks(filewatch.Callbacks):
 		List = []
@@ -141,6 +546,7 @@ class FileWatch(unittest.TestCase):
 		def onRename(self, filename):
 			self.List.append(("onRename", filename))
 
+	@unittest.skipUnless(filewatch.Win32Backend.available(), "requires ReadDirectoryChangesW")
 	def test_straight_api(self):
 		callbacks = FileWatch.LogCallbacks()
 		watcher = filewatch.WatchForChanges("testdir", callbacks)
@@ -152,3 +558,123 @@ class FileWatch(unittest.TestCase):
 		self.assertEqual(len(callbacks.List), 1)
 		self.assertEqual(callbacks.List[0][0], "onModify")
 		self.assertEqual(callbacks.List[0][1], "testdir\\file5.txt")
+
+	def assertBackendReportsChanges(self, backend):
+		callbacks = FileWatch.LogCallbacks()
+		watcher = filewatch.WatchForChanges("testdir", callbacks, backend=backend)
+		time.sleep(.2)
+		os.makedirs("testdir/newdir")
+		f = open("testdir/newdir/file5.txt", "w")
+		f.write("foobar")
+		f.close()
+		time.sleep(.5)
+		os.remove("testdir/newdir/file5.txt")
+		os.rmdir("testdir/newdir")
+		time.sleep(.5)
+		watcher.kill()
+		self.assertIn(("onAdd", os.path.join("testdir", "newdir")), callbacks.List)
+		self.assertIn(("onAdd", os.path.join("testdir", "newdir", "file5.txt")), callbacks.List)
+		self.assertIn(("onDelete", os.path.join("testdir", "newdir", "file5.txt")), callbacks.List)
+		self.assertIn(("onDelete", os.path.join("testdir", "newdir")), callbacks.List)
+
+	@unittest.skipUnless(filewatch.InotifyBackend.available(), "requires inotify")
+	def test_inotify_backend(self):
+		self.assertBackendReportsChanges(filewatch.InotifyBackend)
+
+	@unittest.skipUnless(filewatch.InotifyBackend.available(), "requires inotify")
+	def test_inotify_backend_filter(self):
+		class SkipFilter(filewatch.Filter):
+			Skip = "skipped"
+			def __call__(self, filename):
+				return os.path.basename(filename) != self.Skip
+			def version(self):
+				return self.Skip
+		skipped = os.path.join("testdir", "skipped")
+		os.makedirs(skipped)
+		try:
+			callbacks = FileWatch.LogCallbacks()
+			filter = SkipFilter()
+			watcher = filewatch.WatchForChanges("testdir", callbacks, filter, backend=filewatch.InotifyBackend)
+			time.sleep(.2)
+			# A directory the filter rejects is never watched...
+			self.assertNotIn(skipped, watcher.Backend._Descriptors)
+			self.assertIn(os.path.join("testdir", "morefiles"), watcher.Backend._Descriptors)
+			# ...until the filter changes its mind.
+			filter.Skip = "morefiles"
+			time.sleep(.5)
+			watcher.kill()
+			self.assertIn(skipped, watcher.Backend._Descriptors)
+			self.assertNotIn(os.path.join("testdir", "morefiles"), watcher.Backend._Descriptors)
+			self.assertIn(("onAdd", skipped), callbacks.List)
+		finally:
+			os.rmdir(skipped)
+
+	def test_polling_backend(self):
+		class FastPollingBackend(filewatch.PollingBackend):
+			Interval = .1
+		self.assertBackendReportsChanges(FastPollingBackend)
+
+	def test_shared_watcher(self):
+		pool = filewatch.WatcherPool()
+		outer = pool.subscribe("testdir")
+		inner = pool.subscribe(os.path.join("testdir", "morefiles"))
+		again = pool.subscribe("testdir")
+		self.assertEqual(len(pool), 1)
+		time.sleep(.2)
+		f = open("testdir/morefiles/file2.txt", "w")
+		f.write("")
+		f.close()
+		f = open("testdir/file1.txt", "w")
+		f.write("foobar")
+		f.close()
+		path = os.path.join("testdir", "morefiles", "file2.txt")
+		self.assertEqual(("modify", path), outer.get(timeout=1))
+		self.assertEqual(("modify", path), again.get(timeout=1))
+		self.assertEqual(("modify", path), inner.get(timeout=1))
+		self.assertRaises(queue.Empty, inner.get, timeout=.2)
+		for subscription in (outer, inner, again):
+			subscription.close()
+		self.assertEqual(len(pool), 0)
+
+	def test_lingering_watcher(self):
+		pool = filewatch.WatcherPool(lingerTime=.3)
+		(changes, generation) = pool.changes("testdir", 0)
+		self.assertIsNone(changes)
+		self.assertEqual(len(pool), 1)
+		time.sleep(.2)
+		f = open("testdir/file1.txt", "w")
+		f.write("foobar")
+		f.close()
+		time.sleep(.05)
+		(changes, next) = pool.changes("testdir", generation)
+		self.assertEqual(changes, [("modify", os.path.join("testdir", "file1.txt"))])
+		time.sleep(.5)
+		self.assertEqual(len(pool), 0)
+		# A new watcher's history doesn't reach back to the old one's generations.
+		(changes, newNext) = pool.changes("testdir", next)
+		self.assertIsNone(changes)
+		self.assertGreaterEqual(newNext, next)
+
+	def test_coalescer(self):
+		coalescer = filewatch.Coalescer(1)
+		for mode in ("add", "modify", "delete"):
+			coalescer.add(mode, "created-and-deleted", 0)
+		coalescer.add("delete", "replaced", 0)
+		coalescer.add("add", "replaced", 0)
+		coalescer.add("modify", "modified", 0)
+		coalescer.add("modify", "modified", 2)
+		self.assertEqual(len(coalescer), 2)
+		self.assertEqual(None, coalescer.pop(.5))
+		self.assertEqual(("modify", "replaced"), coalescer.pop(1))
+		self.assertEqual(None, coalescer.pop(2.5))
+		self.assertEqual(3, coalescer.nextSettleTime())
+		self.assertEqual(("modify", "modified"), coalescer.pop(3))
+
+	def test_settles_from_when_seen(self):
+		ring = filewatch.EventRing(16)
+		watcher = collections.namedtuple("Watcher", "Ring")(ring)
+		subscription = filewatch.Subscription(None, watcher, "testdir", .2, 16)
+		ring.onModify(os.path.join("testdir", "file1.txt"))
+		time.sleep(.3)
+		# The change settled while nobody was reading, so it's ready the moment it's read.
+		self.assertEqual(("modify", os.path.join("testdir", "file1.txt")), subscription.get_nowait())